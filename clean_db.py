@@ -5,22 +5,36 @@ DB_PATH = os.getenv("DB_PATH", "kairos.db")
 
 print(f"Cleaning Kairos database at: {DB_PATH}")
 
-conn = sqlite3.connect(DB_PATH)
+# Autocommit mode so the transaction below is explicit and VACUUM can run after it
+conn = sqlite3.connect(DB_PATH, isolation_level=None)
 cursor = conn.cursor()
 
-# Clear all tables
-for table in ["todos", "audit_logs", "patterns", "insights"]:
-    try:
-        cursor.execute(f"DELETE FROM {table}")
-        print(f"[OK] Cleared {cursor.rowcount} rows from {table}")
-    except sqlite3.OperationalError as exc:
-        print(f"[WARNING] Could not clear {table}: {exc}")
+try:
+    cursor.execute("BEGIN")
 
-# Reset auto-increment counters
-cursor.execute("DELETE FROM sqlite_sequence")
-print("[OK] Reset auto-increment counters")
+    # Clear all tables (no WHERE clause: truncate fast path, except todos whose FTS triggers must fire)
+    for table in ["todos", "audit_logs", "patterns", "insights"]:
+        try:
+            cursor.execute(f"DELETE FROM {table}")
+            print(f"[OK] Cleared {cursor.rowcount} rows from {table}")
+        except sqlite3.OperationalError as exc:
+            print(f"[WARNING] Could not clear {table}: {exc}")
+
+    # Reset auto-increment counters
+    cursor.execute("DELETE FROM sqlite_sequence")
+    print("[OK] Reset auto-increment counters")
+
+    cursor.execute("COMMIT")
+except Exception as exc:
+    cursor.execute("ROLLBACK")
+    conn.close()
+    print(f"[ERROR] Cleanup failed, changes rolled back: {exc}")
+    raise SystemExit(1)
+
+# Reclaim the freed pages
+cursor.execute("VACUUM")
+print("[OK] Vacuumed database")
 
-conn.commit()
 conn.close()
 
 print("[SUCCESS] Database cleanup complete")
@@ -4,6 +4,7 @@ import sqlite3
 DB_PATH = os.getenv("DB_PATH", "kairos.db")
 
 conn = sqlite3.connect(DB_PATH)
+conn.row_factory = sqlite3.Row
 cursor = conn.cursor()
 
 cursor.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
@@ -17,8 +18,9 @@ if "todos" in tables:
     columns = [col[1] for col in cursor.fetchall()]
     print("Columns:", columns)
 
-    cursor.execute("SELECT * FROM todos ORDER BY id DESC LIMIT 20")
-    for row in cursor.fetchall():
-        print(row)
+    # Explicit columns; ORDER BY id walks the rowid b-tree backwards, no sort needed
+    cursor.execute("SELECT id, task, category, priority, status FROM todos ORDER BY id DESC LIMIT 20")
+    for row in cursor:
+        print(tuple(row))
 
 conn.close()
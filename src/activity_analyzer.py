@@ -1,73 +1,211 @@
 """
 ActivityAnalyzer: Uses Gemini Flash to analyze hourly activities
 """
+import asyncio
 import logging
 import json
 import os
-from datetime import datetime
+import threading
+import time
+from collections import namedtuple
 import google.generativeai as genai
-from src.database import get_connection
+from src.context_manager import load_context_map
+from src.db_pool import read_conn, write_txn
+from src.llm_cache import LLMCache, make_cache_key
+from src.utils import configure_genai, parse_json_response, unwrap_json_fence
 from dotenv import load_dotenv
 
-load_dotenv()
-
 logger = logging.getLogger(__name__)
 
-# Configure Gemini
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+EMBEDDING_MODEL = "models/text-embedding-004"
+GEMINI_TIMEOUT_SECONDS = 30
+
+Todo = namedtuple("Todo", "id task category priority")
+
+# Structured output: Gemini returns bare JSON matching this schema (no markdown fences)
+ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "activity_summary": {"type": "STRING"},
+        "productivity_type": {"type": "STRING"},
+        "matched_todo_id": {"type": "INTEGER", "nullable": True},
+        "alignment_score": {"type": "INTEGER"},
+        "category": {"type": "STRING"},
+        "reasoning": {"type": "STRING"},
+        "feedback": {"type": "STRING"},
+    },
+    "required": [
+        "activity_summary", "productivity_type", "matched_todo_id",
+        "alignment_score", "category", "reasoning", "feedback",
+    ],
+}
+
+ANALYSIS_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": ANALYSIS_SCHEMA,
+    "temperature": 0,
+}
+
+_ENV_LOADED = False
+_MODEL = None
+_MODEL_LOCK = threading.Lock()
+
+def _ensure_env():
+    """Load .env and configure Gemini once per process (caller holds _MODEL_LOCK)"""
+    global _ENV_LOADED
+    if _ENV_LOADED:
+        return
+    load_dotenv()
+    if os.getenv("GEMINI_API_KEY"):
+        configure_genai()
+    _ENV_LOADED = True
+
+def _get_model():
+    """Build the shared Gemini model handle once per process"""
+    global _MODEL
+    if _MODEL is None:
+        with _MODEL_LOCK:
+            if _MODEL is None:
+                _ensure_env()
+                _MODEL = genai.GenerativeModel(
+                    'gemini-1.5-flash',
+                    system_instruction=ActivityAnalyzer._STATIC_PREFIX,
+                    generation_config=ANALYSIS_GENERATION_CONFIG
+                )
+    return _MODEL
+
+def repair_truncated_json(text: str) -> str:
+    """
+    Close any string, array or object left open by a truncated LLM response
+    so it can still be parsed instead of falling back to a neutral analysis.
+    """
+    closers = []
+    in_string = False
+    escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            closers.append("}")
+        elif ch == "[":
+            closers.append("]")
+        elif ch in "}]" and closers:
+            closers.pop()
+
+    repaired = text
+    if in_string:
+        repaired += '"'
+    repaired = repaired.rstrip()
+    if repaired.endswith(","):
+        repaired = repaired[:-1]
+    elif repaired.endswith(":"):
+        repaired += " null"
+    return repaired + "".join(reversed(closers))
 
 class ActivityAnalyzer:
+    # Invariant instructions are sent as the system instruction so every call
+    # shares a byte-identical prefix; only _dynamic_suffix varies per check-in.
+    _STATIC_PREFIX = """You are an AI productivity coach analyzing hourly activity logs.
+
+You will be given the USER CONTEXT, the ACTIVE TODO LIST and the USER'S HOURLY ACTIVITY.
+
+TASK:
+Analyze this activity and determine:
+1. Is it directly working on a todo? If yes, which one (provide ID)?
+2. Productivity type:
+   - "aligned": Working on a specific todo from the list
+   - "beneficial": Productive and goal-aligned but not on todo list
+   - "wasted": Unproductive time not contributing to goals
+3. Alignment score: 0-10 (0=totally wasted, 10=perfectly aligned with primary goal)
+4. Category: Career, Fitness, Personal, Entertainment, etc.
+5. Brief reasoning
+6. Encouraging feedback message (1-2 sentences)
+
+IMPORTANT:
+- Be honest about "wasted" time - YouTube/social media/gaming should be marked as wasted unless directly work-related
+- Only mark as "aligned" if it directly matches a todo
+- Be encouraging but truthful
+
+Respond ONLY with valid JSON (no markdown, no extra text):
+{
+  "activity_summary": "Brief summary of what user did",
+  "productivity_type": "aligned|beneficial|wasted",
+  "matched_todo_id": 15 or null,
+  "alignment_score": 7,
+  "category": "Career",
+  "reasoning": "Why you categorized it this way",
+  "feedback": "Encouraging message for user"
+}"""
+
+    _DYNAMIC_TEMPLATE = """USER CONTEXT:
+- Primary Goal: {primary_goal}
+- Priorities: {priorities}
+
+ACTIVE TODO LIST:
+{todos_text}
+
+USER'S HOURLY ACTIVITY:
+"{user_response}\""""
+
     def __init__(self):
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.model = _get_model()
+        self.cache = LLMCache()
 
     async def analyze_activity(self, user_response: str, check_in_id: int):
         """
         Analyze user's hourly activity against their todo list
         Returns dict with analysis results
         """
+        # Unix seconds, like the check_ins times it is compared with
+        now_ts = int(time.time())
         try:
-            # Load active todos
-            active_todos = self._load_active_todos()
-
-            # Load user context
-            user_context = self._load_user_context()
-
-            # Build prompt
-            prompt = self._build_analysis_prompt(user_response, active_todos, user_context)
-
-            # Call Gemini Flash
-            response = self.model.generate_content(prompt)
-            response_text = response.text.strip()
-
-            # Parse JSON response
-            try:
-                # Extract JSON from markdown code blocks if present
-                if "```json" in response_text:
-                    response_text = response_text.split("```json")[1].split("```")[0].strip()
-                elif "```" in response_text:
-                    response_text = response_text.split("```")[1].split("```")[0].strip()
-
-                analysis = json.loads(response_text)
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse Gemini response: {e}\nResponse: {response_text}")
-                # Fallback to neutral categorization
-                analysis = {
-                    "activity_summary": user_response[:100],
-                    "productivity_type": "beneficial",
-                    "matched_todo_id": None,
-                    "alignment_score": 5,
-                    "category": "Unknown",
-                    "reasoning": "Analysis pending - manual review required",
-                    "feedback": "Activity logged. I had trouble analyzing it automatically."
-                }
-
-            # Save to database
-            self._save_activity_log(check_in_id, user_response, analysis)
-
-            # Update check-in status
-            self._update_check_in_status(check_in_id, 'completed')
+            # Load active todos and user context concurrently (one DB read, one file read)
+            active_todos, user_context = await asyncio.gather(
+                asyncio.to_thread(self._load_active_todos),
+                asyncio.to_thread(self._load_user_context)
+            )
+
+            # Check the response cache before paying for a Gemini round-trip
+            primary_goal = user_context.get("primary_goal", "Career Growth")
+            todo_ids = [todo.id for todo in active_todos]
+            scope = make_cache_key({"todos": todo_ids, "goal": primary_goal})
+            cache_key = make_cache_key({"resp": user_response, "todos": todo_ids, "goal": primary_goal})
+
+            # Cache lookups hit SQLite, so they run in worker threads like the other DB reads
+            analysis = await asyncio.to_thread(self.cache.get, cache_key)
+            embedding = None
+            if analysis is None:
+                embedding = await self._embed(user_response)
+                if embedding is not None:
+                    analysis = await asyncio.to_thread(self.cache.get_similar, scope, embedding)
+
+            if analysis is None:
+                analysis = await self._generate_analysis(user_response, active_todos, user_context)
+                if analysis is not None:
+                    await asyncio.to_thread(self.cache.set, cache_key, analysis, scope=scope, embedding=embedding)
+                else:
+                    # Fallback to neutral categorization
+                    analysis = {
+                        "activity_summary": user_response[:100],
+                        "productivity_type": "beneficial",
+                        "matched_todo_id": None,
+                        "alignment_score": 5,
+                        "category": "Unknown",
+                        "reasoning": "Analysis pending - manual review required",
+                        "feedback": "Activity logged. I had trouble analyzing it automatically."
+                    }
+            else:
+                logger.info(f"Using cached analysis for check-in {check_in_id}")
+
+            # Save activity log and mark check-in completed
+            await asyncio.to_thread(self._persist_analysis, check_in_id, user_response, analysis, now_ts)
 
             return analysis
 
@@ -84,150 +222,125 @@ class ActivityAnalyzer:
                 "feedback": "Activity logged successfully."
             }
 
+    async def _generate_analysis(self, user_response: str, active_todos: list, user_context: dict):
+        """Call Gemini Flash and parse its JSON analysis. Returns None on parse failure."""
+        # Build prompt (static instructions live in the model's system instruction)
+        prompt = self._dynamic_suffix(user_response, active_todos, user_context)
+
+        # Call Gemini Flash without blocking the event loop
+        try:
+            response = await asyncio.wait_for(
+                self.model.generate_content_async(prompt),
+                timeout=GEMINI_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Gemini analysis timed out after {GEMINI_TIMEOUT_SECONDS}s")
+            return None
+        # Structured output should already be bare JSON; fences are unwrapped defensively
+        response_text = response.text
+        try:
+            return parse_json_response(response_text)
+        except json.JSONDecodeError:
+            response_text = unwrap_json_fence(response_text)
+
+        try:
+            analysis = json.loads(repair_truncated_json(response_text))
+            logger.warning("Recovered truncated Gemini response")
+            # Fields cut off by the truncation fall back to neutral values
+            analysis.setdefault("activity_summary", user_response[:100])
+            analysis.setdefault("productivity_type", "beneficial")
+            analysis.setdefault("matched_todo_id", None)
+            analysis.setdefault("alignment_score", 5)
+            analysis.setdefault("category", "Unknown")
+            analysis.setdefault("reasoning", "Partially recovered analysis")
+            analysis.setdefault("feedback", "Activity logged.")
+            return analysis
+        except (json.JSONDecodeError, AttributeError) as e:
+            logger.error(f"Failed to parse Gemini response: {e}\nResponse: {response_text}")
+            return None
+
+    async def _embed(self, text: str):
+        """Embed text for semantic cache lookups. Returns None if unavailable."""
+        try:
+            result = await asyncio.to_thread(genai.embed_content, model=EMBEDDING_MODEL, content=text)
+            return result["embedding"]
+        except Exception as e:
+            logger.warning(f"Embedding failed, skipping semantic cache: {e}")
+            return None
+
     def _load_active_todos(self):
         """Load active high/medium priority todos"""
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                """SELECT id, task, category, priority, due_date
-                   FROM todos
-                   WHERE status = 'Pending'
-                     AND priority IN ('HIGH', 'MEDIUM')
-                   ORDER BY priority DESC, due_date ASC
-                   LIMIT 20"""
-            )
-            rows = cursor.fetchall()
-            conn.close()
-
-            todos = []
-            for row in rows:
-                todos.append({
-                    "id": row[0],
-                    "task": row[1],
-                    "category": row[2],
-                    "priority": row[3],
-                    "due_date": row[4]
-                })
-            return todos
+            with read_conn() as conn:
+                rows = conn.execute(
+                    """SELECT id, task, category, priority
+                       FROM todos
+                       WHERE status = 'Pending'
+                         AND priority IN ('HIGH', 'MEDIUM')
+                       ORDER BY priority DESC, due_date ASC
+                       LIMIT 20"""
+                ).fetchall()
+            return list(map(Todo._make, rows))
 
         except Exception as e:
             logger.error(f"Failed to load todos: {e}")
             return []
 
     def _load_user_context(self):
-        """Load user context from context_map.json"""
+        """Load user context from context_map.json (cached until the file changes)"""
         try:
-            context_path = "src/data/context_map.json"
-            if os.path.exists(context_path):
-                with open(context_path, 'r') as f:
-                    return json.load(f)
-            return {}
+            return load_context_map() or {}
         except Exception as e:
             logger.error(f"Failed to load user context: {e}")
             return {}
 
-    def _build_analysis_prompt(self, user_response: str, active_todos: list, user_context: dict):
-        """Build structured prompt for Gemini"""
+    def _dynamic_suffix(self, user_response: str, active_todos: list, user_context: dict):
+        """Build the per-call part of the prompt (context, todos, activity)"""
         # Extract key context
-        primary_goal = user_context.get("primary_goal", "Career Growth")
         priorities = user_context.get("priorities", [])
 
         # Format todos
-        todos_text = ""
-        if active_todos:
-            for todo in active_todos:
-                todos_text += f"- [ID: {todo['id']}] {todo['task']} (Category: {todo['category']}, Priority: {todo['priority']})\n"
-        else:
-            todos_text = "No active high-priority todos found."
-
-        prompt = f"""You are an AI productivity coach analyzing hourly activity logs.
-
-USER CONTEXT:
-- Primary Goal: {primary_goal}
-- Priorities: {', '.join(priorities) if priorities else 'Career, Fitness, Personal Development'}
-
-ACTIVE TODO LIST:
-{todos_text}
-
-USER'S HOURLY ACTIVITY:
-"{user_response}"
-
-TASK:
-Analyze this activity and determine:
-1. Is it directly working on a todo? If yes, which one (provide ID)?
-2. Productivity type:
-   - "aligned": Working on a specific todo from the list
-   - "beneficial": Productive and goal-aligned but not on todo list
-   - "wasted": Unproductive time not contributing to goals
-3. Alignment score: 0-10 (0=totally wasted, 10=perfectly aligned with primary goal)
-4. Category: Career, Fitness, Personal, Entertainment, etc.
-5. Brief reasoning
-6. Encouraging feedback message (1-2 sentences)
-
-IMPORTANT:
-- Be honest about "wasted" time - YouTube/social media/gaming should be marked as wasted unless directly work-related
-- Only mark as "aligned" if it directly matches a todo
-- Be encouraging but truthful
-
-Respond ONLY with valid JSON (no markdown, no extra text):
-{{
-  "activity_summary": "Brief summary of what user did",
-  "productivity_type": "aligned|beneficial|wasted",
-  "matched_todo_id": 15 or null,
-  "alignment_score": 7,
-  "category": "Career",
-  "reasoning": "Why you categorized it this way",
-  "feedback": "Encouraging message for user"
-}}"""
-
-        return prompt
-
-    def _save_activity_log(self, check_in_id: int, user_response: str, analysis: dict):
-        """Save activity analysis to database"""
+        todos_text = "\n".join(
+            f"- [ID: {todo.id}] {todo.task} (Category: {todo.category}, Priority: {todo.priority})"
+            for todo in active_todos
+        ) or "No active high-priority todos found."
+
+        return self._DYNAMIC_TEMPLATE.format_map({
+            "primary_goal": user_context.get("primary_goal", "Career Growth"),
+            "priorities": ', '.join(priorities) if priorities else 'Career, Fitness, Personal Development',
+            "todos_text": todos_text,
+            "user_response": user_response,
+        })
+
+    def _persist_analysis(self, check_in_id: int, user_response: str, analysis: dict, now_ts: int):
+        """Save the activity log and complete the check-in in one transaction"""
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-
-            cursor.execute(
-                """INSERT INTO activity_logs
-                   (timestamp, user_response, activity_summary, productivity_type,
-                    alignment_score, matched_todo_id, category, reasoning, check_in_id)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (
-                    datetime.now(),
-                    user_response,
-                    analysis.get('activity_summary'),
-                    analysis.get('productivity_type'),
-                    analysis.get('alignment_score'),
-                    analysis.get('matched_todo_id'),
-                    analysis.get('category'),
-                    analysis.get('reasoning'),
-                    check_in_id
+            with write_txn() as conn:
+                # A real reply replaces any placeholder (e.g. 'Sleeping') logged for this check-in
+                conn.execute(
+                    """INSERT OR REPLACE INTO activity_logs
+                       (timestamp, user_response, activity_summary, productivity_type,
+                        alignment_score, matched_todo_id, category, reasoning, check_in_id)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (
+                        now_ts,
+                        user_response,
+                        analysis.get('activity_summary'),
+                        analysis.get('productivity_type'),
+                        analysis.get('alignment_score'),
+                        analysis.get('matched_todo_id'),
+                        analysis.get('category'),
+                        analysis.get('reasoning'),
+                        check_in_id
+                    )
                 )
-            )
 
-            conn.commit()
-            conn.close()
+                conn.execute(
+                    "UPDATE check_ins SET status = ?, response_time = ? WHERE id = ?",
+                    ('completed', now_ts, check_in_id)
+                )
             logger.info(f"Activity log saved for check-in {check_in_id}")
 
         except Exception as e:
             logger.error(f"Failed to save activity log: {e}")
             raise
-
-    def _update_check_in_status(self, check_in_id: int, status: str):
-        """Update check-in status"""
-        try:
-            conn = get_connection()
-            cursor = conn.cursor()
-
-            cursor.execute(
-                "UPDATE check_ins SET status = ?, response_time = ? WHERE id = ?",
-                (status, datetime.now(), check_in_id)
-            )
-
-            conn.commit()
-            conn.close()
-
-        except Exception as e:
-            logger.error(f"Failed to update check-in status: {e}")
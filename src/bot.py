@@ -1,73 +1,313 @@
 import os
+import asyncio
 import logging
-import json
-from datetime import datetime
+import re
+import sqlite3
+import functools
+import weakref
+from string import Template
+from datetime import datetime, date, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, BotCommand
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from dotenv import load_dotenv
-from src.utils import log_audit, ensure_dirs, get_temp_path, get_connection
+from src.utils import log_audit, flush_audit_log, ensure_dirs, get_temp_path, parse_json_response
+from src.db_pool import read_conn, write_txn, fetch_one, fetch_all, execute_write, close_all
 from src.check_in_scheduler import CheckInScheduler
 from src.check_in_manager import CheckInManager
 from src.activity_analyzer import ActivityAnalyzer
 from src.productivity_reporter import ProductivityReporter
 
+# --- SQL statements ---
+# Reused verbatim so every call hits the connection's prepared-statement cache
+SQL_GET_TASK = "SELECT task FROM todos WHERE id = ?"
+SQL_GET_RAW_INPUT = "SELECT raw_input FROM todos WHERE id = ?"
+SQL_GET_TASK_AND_INPUT = "SELECT task, raw_input FROM todos WHERE id = ?"
+SQL_GET_RECURRENCE = "SELECT recurrence FROM todos WHERE id = ?"
+SQL_SEARCH_PENDING = "SELECT id, task, raw_input FROM todos WHERE status='Pending' AND task LIKE ? ORDER BY created_at DESC LIMIT 5"
+SQL_SEARCH_PENDING_FTS = "SELECT t.id, t.task, t.raw_input FROM todos_fts f JOIN todos t ON t.id = f.rowid WHERE todos_fts MATCH ? AND t.status='Pending' ORDER BY t.created_at DESC LIMIT 5"
+SQL_RECENT_TASKS = "SELECT task, priority, due_date FROM todos ORDER BY created_at DESC LIMIT ?"
+SQL_LIST_UNSCHEDULED = "SELECT id, task, priority, category FROM todos WHERE is_scheduled=0 AND status='Pending' ORDER BY created_at DESC"
+SQL_INSERT_TODO = "INSERT INTO todos (task, raw_input, category, priority, due_date, due_time, is_scheduled, reasoning, status, recurrence) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+# Copies the completed task into its next occurrence without a Python-side round-trip
+SQL_INSERT_RECURRING = "INSERT INTO todos (task, raw_input, category, priority, due_date, due_time, is_scheduled, reasoning, status, recurrence) SELECT task, 'Recurring: ' || task, category, priority, ?, NULL, 1, ?, 'Pending', recurrence FROM todos WHERE id = ? RETURNING id"
+SQL_UPDATE_TODO = "UPDATE todos SET task=?, raw_input=?, category=?, priority=?, due_date=?, due_time=?, is_scheduled=?, reasoning=?, recurrence=?, status='Pending', updated_at=CURRENT_TIMESTAMP WHERE id=?"
+SQL_MARK_DONE = "UPDATE todos SET status = 'Completed', completed_at = ? WHERE id = ?"
+SQL_SCHEDULE = "UPDATE todos SET due_date=?, due_time=?, is_scheduled=1, updated_at=CURRENT_TIMESTAMP WHERE id=?"
+SQL_UNSCHEDULE = "UPDATE todos SET is_scheduled=0, due_date=NULL, due_time=NULL, updated_at=CURRENT_TIMESTAMP WHERE id=? RETURNING id, task AS task_name, category, priority, due_date, due_time, is_scheduled, reasoning"
+SQL_GET_USER_CONFIG = "SELECT id FROM user_config WHERE chat_id = ?"
+SQL_INSERT_USER_CONFIG = "INSERT INTO user_config (chat_id, check_ins_enabled, updated_at) VALUES (?, 1, CAST(strftime('%s', 'now') AS INTEGER))"
+
+# Active tasks (newest first) then the 10 most recently completed, in one round-trip
+SQL_SYNC_SNAPSHOT = """
+SELECT * FROM (
+    SELECT id, task AS task_name, category, priority, due_date, due_time, is_scheduled,
+           reasoning, status, recurrence, completed_at, created_at AS sort_ts
+    FROM todos WHERE status = 'Pending'
+)
+UNION ALL
+SELECT * FROM (
+    SELECT id, task AS task_name, category, priority, due_date, due_time, is_scheduled,
+           reasoning, status, recurrence, completed_at, completed_at AS sort_ts
+    FROM todos WHERE status = 'Completed'
+    ORDER BY completed_at DESC LIMIT 10
+)
+ORDER BY status DESC, sort_ts DESC
+"""
+
+# Shared by /query and the Query Vault button
+QUERY_PROMPT = Template("""
+You are Kairos, a strategic advisor. Answer the following question based on the user's vault context and recent tasks.
+
+VAULT CONTEXT:
+$vault_context
+
+$db_context
+
+USER QUESTION:
+$query_text
+
+Provide a concise, helpful answer. If the answer is in the recent tasks, highlight that.
+""")
+
+# Fallback date parse for /schedule; the input goes last so the prefix is identical all day
+SCHEDULE_PARSE_PROMPT = Template("""
+Parse the following date/time string and return JSON.
+Current date: $today
+
+Return ONLY valid JSON:
+{
+  "due_date": "YYYY-MM-DD",
+  "due_time": "HH:MM" or null if no time specified
+}
+
+Input: "$text"
+""")
+
+_TODAY_CACHE = (None, None)  # (date, ISO string)
+
+def _today_iso() -> str:
+    """Today's date as YYYY-MM-DD, formatted once per day."""
+    global _TODAY_CACHE
+    today = date.today()
+    if _TODAY_CACHE[0] != today:
+        _TODAY_CACHE = (today, today.isoformat())
+    return _TODAY_CACHE[1]
+
+# Check-in reply, filled from the analysis dict
+_EMOJI_MAP = {
+    'aligned': '✅',
+    'beneficial': '💡',
+    'wasted': '⚠️',
+    'missed': '❌',
+    'sleeping': '😴'
+}
+_CHECKIN_TEMPLATE = (
+    "{emoji} **Activity Logged**\n\n"
+    "**Summary:** {activity_summary}\n"
+    "**Type:** {type_title}\n"
+    "**Alignment Score:** {alignment_score}/10\n"
+    "**Category:** {category}\n\n"
+    "💬 {feedback}"
+)
+
+# --- Recurrence rules ---
+# One scan picks the rule; lastgroup names the matching alternative
+_RECUR_RE = re.compile(r'\b(?P<daily>daily|every\s+day)\b|\b(?P<weekly>weekly|every\s+week)\b|\bevery\s+(?P<n>\d+)\s+days?\b', re.I)
+_RECUR_DELTAS = {
+    "daily": lambda m: timedelta(days=1),
+    "weekly": lambda m: timedelta(days=7),
+    "n": lambda m: timedelta(days=int(m["n"])),
+}
+
+def next_recurrence_delta(recurrence: str):
+    """Return the timedelta to the next occurrence, or None if the rule isn't recognised"""
+    m = _RECUR_RE.search(recurrence)
+    return _RECUR_DELTAS[m.lastgroup](m) if m else None
+
+# Clarification replies that explicitly ask for no due date (matched against the lowercased reply)
+_UNSCHEDULED_RE = re.compile(
+    r"\b(?:unscheduled|no date|backlog|no deadline|add to backlog|put in backlog"
+    r"|skip scheduling|don't schedule|no due date)\b"
+)
+
 # --- Date/Time Formatting Helpers ---
+# English names indexed by date.weekday() / date.month - 1 (same as strftime's %a/%b in the C locale)
+_WDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+def _format_short_date(d) -> str:
+    """date -> 'Fri, Jan 30' without going through strftime"""
+    return f"{_WDAYS[d.weekday()]}, {_MONTHS[d.month - 1]} {d.day:02d}"
+
+def _format_ymd(s: str) -> str:
+    """YYYY-MM-DD -> DD-MM-YYYY by slicing; other shapes go through strptime (ValueError if invalid)"""
+    if len(s) == 10 and s[4] == s[7] == "-":
+        return f"{s[8:10]}-{s[5:7]}-{s[0:4]}"
+    return datetime.strptime(s, "%Y-%m-%d").strftime("%d-%m-%Y")
+
+def _format_hm(s: str) -> str:
+    """HH:MM -> 2:30 PM with integer math; other shapes go through strptime (ValueError if invalid)"""
+    if len(s) == 5 and s[2] == ":":
+        h, m = int(s[0:2]), int(s[3:5])
+        if not (0 <= h <= 23 and 0 <= m <= 59):
+            raise ValueError(s)
+    else:
+        t = datetime.strptime(s, "%H:%M")
+        h, m = t.hour, t.minute
+    return f"{h % 12 or 12}:{m:02d} {'AM' if h < 12 else 'PM'}"
+
+# "<day> [time]" forms /schedule can resolve without Gemini
+_SCHEDULE_RE = re.compile(
+    r"^\s*(?:on\s+)?(?P<day>today|tomorrow|tmrw|day after tomorrow|\d{4}-\d{2}-\d{2}"
+    r"|mon(?:day)?|tue(?:s|sday)?|wed(?:nesday)?|thu(?:rs?|rsday)?|fri(?:day)?|sat(?:urday)?|sun(?:day)?)"
+    r"(?:\s*,?\s*(?:at\s+|@\s*)?(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<ampm>am|pm)?)?\s*$",
+    re.I,
+)
+_WEEKDAY_INDEX = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
+_RELATIVE_DAYS = {"today": 0, "tomorrow": 1, "tmrw": 1, "day after tomorrow": 2}
+
+def parse_schedule_text(text: str, today: date = None):
+    """Resolve 'friday 3pm', 'tomorrow', '2026-02-01 14:00' etc. to (YYYY-MM-DD, HH:MM or None).
+
+    Returns None for anything else (including a bare hour like 'friday 3') so the caller can ask Gemini.
+    """
+    m = _SCHEDULE_RE.match(text)
+    if not m:
+        return None
+    today = today or date.today()
+
+    day = m["day"].lower()
+    if day in _RELATIVE_DAYS:
+        due = today + timedelta(days=_RELATIVE_DAYS[day])
+    elif day[0].isdigit():
+        try:
+            due = date.fromisoformat(day)
+        except ValueError:
+            return None
+    else:
+        # A bare weekday means its next occurrence after today
+        due = today + timedelta(days=(_WEEKDAY_INDEX[day[:3]] - today.weekday() - 1) % 7 + 1)
+
+    if m["hour"] is None:
+        return due.isoformat(), None
+    if m["minute"] is None and m["ampm"] is None:
+        return None
+    hour, minute = int(m["hour"]), int(m["minute"] or 0)
+    if m["ampm"]:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if m["ampm"].lower() == "pm" else 0)
+    if hour > 23 or minute > 59:
+        return None
+    return due.isoformat(), f"{hour:02d}:{minute:02d}"
+
 def format_due_date_display(due_date: str, due_time: str, is_scheduled: bool = True) -> str:
     """Convert YYYY-MM-DD HH:MM to user-friendly format: 29-01-2026 @ 2:30 PM"""
     if not is_scheduled or not due_date:
         return "📅 Unscheduled"
     
     try:
-        d = datetime.strptime(due_date, "%Y-%m-%d")
-        date_str = d.strftime("%d-%m-%Y")
+        date_str = _format_ymd(due_date)
     except ValueError:
         date_str = due_date
     
     if due_time:
         try:
-            t = datetime.strptime(due_time, "%H:%M")
-            time_str = t.strftime("%I:%M %p").lstrip("0")  # 2:30 PM
+            time_str = _format_hm(due_time)  # 2:30 PM
             return f"{date_str} @ {time_str}"
         except ValueError:
             return f"{date_str} @ {due_time}"
     return date_str
 
-async def mark_task_complete(query, context, task_id: str, custom_time: str = None):
+# key=value names accepted by /edit -> todos column
+_EDIT_FIELDS = {
+    "task_name": "task", "task": "task", "category": "category", "priority": "priority",
+    "due_date": "due_date", "due_time": "due_time", "reasoning": "reasoning",
+}
+
+_PRIORITIES = frozenset(("HIGH", "MEDIUM", "LOW"))
+_CATEGORIES = {c.lower(): c for c in ("Career", "Fitness", "Projects", "Personal", "Hobby")}
+_HM_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+
+def _normalize_due_date(value: str):
+    """YYYY-MM-DD for a date-only value ('2026-02-01', 'friday', 'tomorrow'), else None"""
+    parsed = parse_schedule_text(value)
+    return parsed[0] if parsed and parsed[1] is None else None
+
+def _normalize_due_time(value: str):
+    m = _HM_RE.match(value)
+    return f"{int(m[1]):02d}:{m[2]}" if m else None
+
+# Columns whose /edit values must be normalized the way triage would return them;
+# each returns the stored value, or None if it isn't valid
+_EDIT_NORMALIZERS = {
+    "priority": lambda value: value.upper() if value.upper() in _PRIORITIES else None,
+    "category": lambda value: _CATEGORIES.get(value.lower()),
+    "due_date": _normalize_due_date,
+    "due_time": _normalize_due_time,
+}
+
+def parse_direct_edits(tokens) -> dict:
+    """{column: value} when every token is a known, valid key=value pair, else {} (needs triage)"""
+    edits = {}
+    for token in tokens:
+        key, sep, value = token.partition("=")
+        column = _EDIT_FIELDS.get(key.lower())
+        if not sep or not column or not value:
+            return {}
+        normalize = _EDIT_NORMALIZERS.get(column)
+        if normalize:
+            value = normalize(value)
+            if value is None:
+                return {}
+        edits[column] = value
+    return edits
+
+def _parse_task_id(text: str):
+    """Return a typed task ID as an int, or None if it isn't a number"""
+    try:
+        return int(text.strip())
+    except ValueError:
+        return None
+
+def format_unscheduled(rows) -> str:
+    """Backlog listing for /unscheduled and the Unscheduled button, built in one join."""
+    return "".join((
+        "📋 **Unscheduled Tasks (Backlog)**\n\n",
+        *(f"**[ID: {tid}]** {task}\n   └─ {category} | {priority} priority\n\n" for tid, task, priority, category in rows),
+        "_Use `/schedule <id> <date> [time]` to schedule a task._",
+    ))
+
+async def mark_task_complete(query, context, task_id: int, custom_time: str = None):
     """Mark a task as complete in the database."""
-    from datetime import datetime
-    from src.database import get_connection
-    
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # Get task details first
-        cursor.execute("SELECT task FROM todos WHERE id = ?", (task_id,))
-        row = cursor.fetchone()
-        if not row:
-            await query.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_inline_menu())
-            conn.close()
-            return
-        
-        task_name = row[0]
+        # The name was stashed when the ID was validated; only stale buttons need a lookup
+        task_name = None
+        if context.user_data.get("pending_done_id") == task_id:
+            task_name = context.user_data.get("pending_task_name")
+        if task_name is None:
+            row = await fetch_one(SQL_GET_TASK, (task_id,))
+            if not row:
+                await query.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_inline_menu())
+                return
+            task_name = row[0]
         
         # Determine completion time
         if custom_time:
             completed_at = custom_time  # Will be parsed by caller
         else:
-            completed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            completed_at = datetime.now().isoformat(sep=" ", timespec="seconds")
         
         # Update task
-        cursor.execute(
-            "UPDATE todos SET status = 'Completed', completed_at = ? WHERE id = ?",
-            (completed_at, task_id)
-        )
-        conn.commit()
-        conn.close()
+        updated = await execute_write(SQL_MARK_DONE, (completed_at, task_id))
+        if not updated:  # deleted since the name was stashed
+            await query.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_inline_menu())
+            return
         
         # Reset state
         context.user_data["state"] = None
         context.user_data["pending_done_id"] = None
+        context.user_data["pending_task_name"] = None
         
         await query.message.reply_text(
             f"🎉 **Task Completed!**\n\n"
@@ -77,6 +317,7 @@ async def mark_task_complete(query, context, task_id: str, custom_time: str = No
             reply_markup=get_inline_menu()
         )
         log_audit("task_completed", f"Task {task_id} marked complete")
+        request_obsidian_sync()
         
         # Check for recurrence
         await check_and_regenerate_recurring(query, context, task_id)
@@ -88,51 +329,34 @@ async def mark_task_complete(query, context, task_id: str, custom_time: str = No
 async def check_and_regenerate_recurring(update: Update, context: ContextTypes.DEFAULT_TYPE, task_id: int):
     """Checks if a completed task is recurring and creates the next instance."""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        
         # Fetch recurrence rules from the COMPLETED task
-        cursor.execute("SELECT task, category, priority, recurrence, reasoning FROM todos WHERE id = ?", (task_id,))
-        row = cursor.fetchone()
+        row = await fetch_one(SQL_GET_RECURRENCE, (task_id,))
         
-        if not row or not row[3]: # No recurrence
-            conn.close()
+        if not row or not row[0]: # No recurrence
             return
             
-        task_name, category, priority, recurrence, reasoning = row
-        recurrence = recurrence.lower()
+        recurrence = row[0].lower()
         
         # Calculate next due date
-        import datetime as dt
-        from datetime import timedelta
-        today = dt.date.today()
-        next_due = None
-        
-        if "daily" in recurrence or "every day" in recurrence:
-            next_due = today + timedelta(days=1)
-        elif "weekly" in recurrence:
-             next_due = today + timedelta(days=7)
-        # Add more parsing logic here as needed (e.g. regex for "every X days")
+        delta = next_recurrence_delta(recurrence)
+        next_due = date.today() + delta if delta else None
         
         if next_due: 
             # Create NEW task
-            cursor.execute(
-                "INSERT INTO todos (task, raw_input, category, priority, due_date, due_time, is_scheduled, reasoning, status, recurrence) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (task_name, f"Recurring: {task_name}", category, priority, next_due.strftime("%Y-%m-%d"), None, 1, f"Regenerated from Task {task_id} ({recurrence})", "Pending", row[3]) # Keep original recurrence string
+            (new_id,) = await execute_write(
+                SQL_INSERT_RECURRING,
+                (next_due.isoformat(), f"Regenerated from Task {task_id} ({recurrence})", task_id), # Keeps original recurrence string
+                returning=True
             )
-            new_id = cursor.lastrowid
-            conn.commit()
             
             # Notify User
-            next_due_str = next_due.strftime("%a, %b %d")
+            next_due_str = _format_short_date(next_due)
             await update.message.reply_text(
                 f"🔄 **Recurring Task Regenerated!**\n"
                 f"📅 Next due: {next_due_str}\n"
                 f"🆔 New ID: {new_id}",
                 parse_mode="Markdown"
             )
-            
-        conn.close()
         
     except Exception as e:
         logger.error(f"Regeneration failed: {e}")
@@ -142,12 +366,12 @@ load_dotenv(override=True)
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 VAULT_PATH = os.getenv("OBSIDIAN_VAULT_PATH")
 
-from src.triage_engine import TriageEngine
+from src.triage_engine import get_triage_engine
 from src.context_manager import ContextManager
 from src.obsidian_writer import ObsidianWriter
 
 # Initialize Engines
-triage_engine = TriageEngine()
+triage_engine = get_triage_engine()
 context_manager = ContextManager()
 obsidian_writer = ObsidianWriter(VAULT_PATH) if VAULT_PATH else None
 
@@ -164,67 +388,81 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def _fetch_sync_snapshot():
+    """Read active + recently completed tasks (runs in a worker thread)."""
+    active_tasks, completed_tasks = [], []
+    buckets = {"Pending": active_tasks, "Completed": completed_tasks}
+    with read_conn() as conn:
+        # One pass over the cursor; rows are sqlite3.Row and the writer uses .get(), so hand it dicts
+        for r in conn.execute(SQL_SYNC_SNAPSHOT):
+            buckets[r["status"]].append(dict(r))
+    return active_tasks, completed_tasks
+
+# Held across a full sync's snapshot+write and across process_task's DB+row writes, so a
+# sync can't read the DB before a task is saved and then overwrite that task's fresh row
+_obsidian_lock = asyncio.Lock()
+
 async def execute_full_sync():
     """Performs a full sync of active and completed tasks to Obsidian."""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # Fetch Active
-        cursor.execute("SELECT id, task, category, priority, due_date, due_time, is_scheduled, reasoning, status, recurrence FROM todos WHERE status='Pending' ORDER BY created_at DESC")
-        active_rows = cursor.fetchall()
-        active_tasks = []
-        for r in active_rows:
-            active_tasks.append({
-                "id": r[0], "task_name": r[1], "category": r[2], "priority": r[3],
-                "due_date": r[4], "due_time": r[5], "is_scheduled": r[6] == 1,
-                "reasoning": r[7], "status": r[8], "recurrence": r[9]
-            })
-            
-        # Fetch Recently Completed
-        cursor.execute("SELECT id, task, category, priority, completed_at FROM todos WHERE status='Completed' ORDER BY completed_at DESC LIMIT 10")
-        comp_rows = cursor.fetchall()
-        completed_tasks = []
-        for r in comp_rows:
-            completed_tasks.append({
-                "id": r[0], "task_name": r[1], "category": r[2], "priority": r[3],
-                "completed_at": r[4]
-            })
-        
-        conn.close()
-        
-        if obsidian_writer:
-            obsidian_writer.sync_all_tasks(active_tasks, completed_tasks)
+        if not obsidian_writer:
+            return False
+
+        # Neither the DB read nor the file writes run on the event loop
+        async with _obsidian_lock:
+            active_tasks, completed_tasks = await asyncio.to_thread(_fetch_sync_snapshot)
+            synced = await obsidian_writer.sync_all_tasks_async(active_tasks, completed_tasks)
+        if synced:
             logger.info("Obsidian full sync completed.")
-            return True
-        return False
+        return synced
             
     except Exception as e:
         logger.error(f"Sync failed: {e}")
         return False
 
+# --- Debounced Obsidian sync ---
+# Changes to existing tasks mark the vault stale; one full sync runs once a burst settles
+SYNC_DEBOUNCE_SECONDS = 2.0
+_sync_requested = asyncio.Event()
+_sync_worker_task = None
+
+def request_obsidian_sync():
+    """Mark the Obsidian lists stale; returns immediately."""
+    _sync_requested.set()
+
+async def _obsidian_sync_worker():
+    """Coalesce sync requests: wait for the first, let the burst settle, sync once."""
+    while True:
+        await _sync_requested.wait()
+        await asyncio.sleep(SYNC_DEBOUNCE_SECONDS)
+        _sync_requested.clear()
+        await execute_full_sync()
+
+# Menus are built once: PTB markups are frozen after construction and only serialized on send
 # Main Menu Keyboard (Reply keyboard - bottom bar)
-def get_main_menu_keyboard():
-    keyboard = [
-        ["🏁 Start", "📋 Unscheduled"],
-        ["✅ Done", "📈 Stats"],
-        ["🔄 Refresh Context"]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+_MAIN_MENU = ReplyKeyboardMarkup([
+    ["🏁 Start", "📋 Unscheduled"],
+    ["✅ Done", "📈 Stats"],
+    ["🔄 Refresh Context"]
+], resize_keyboard=True)
 
 # Main Menu - Inline Keyboard (appears in message)
+_INLINE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Add Task", callback_data="menu_add"),
+     InlineKeyboardButton("✏️ Edit Task", callback_data="menu_edit"),
+    InlineKeyboardButton("✅ Done", callback_data="menu_done")],
+    [InlineKeyboardButton("🔍 Query Vault", callback_data="menu_query")],
+    [InlineKeyboardButton("📋 Unscheduled", callback_data="menu_unscheduled"),
+     InlineKeyboardButton("📅 Schedule", callback_data="menu_schedule")],
+    [InlineKeyboardButton("🔄 Refresh", callback_data="menu_refresh")]
+])
+
+def get_main_menu_keyboard():
+    return _MAIN_MENU
+
 def get_inline_menu():
     """Returns an InlineKeyboardMarkup with main action buttons."""
-    keyboard = [
-        [InlineKeyboardButton("➕ Add Task", callback_data="menu_add"),
-         InlineKeyboardButton("✏️ Edit Task", callback_data="menu_edit"),
-        InlineKeyboardButton("✅ Done", callback_data="menu_done")],
-        [InlineKeyboardButton("🔍 Query Vault", callback_data="menu_query")],
-        [InlineKeyboardButton("📋 Unscheduled", callback_data="menu_unscheduled"),
-         InlineKeyboardButton("📅 Schedule", callback_data="menu_schedule")],
-        [InlineKeyboardButton("🔄 Refresh", callback_data="menu_refresh")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _INLINE_MENU
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command."""
@@ -233,23 +471,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Auto-save chat_id to user_config on first start
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM user_config WHERE chat_id = ?", (chat_id,))
-        if not cursor.fetchone():
+        if not await fetch_one(SQL_GET_USER_CONFIG, (chat_id,)):
             # First time - create config
-            cursor.execute(
-                "INSERT INTO user_config (chat_id, check_ins_enabled) VALUES (?, 1)",
-                (chat_id,)
-            )
-            conn.commit()
+            await execute_write(SQL_INSERT_USER_CONFIG, (chat_id,))
             logger.info(f"✅ Auto-configured check-ins for chat_id: {chat_id}")
+            if check_in_manager:
+                check_in_manager.config_version += 1  # drop the scheduler's cached "no chat yet"
 
             # Start scheduler now that config exists
             global check_in_scheduler
             if check_in_scheduler and not check_in_scheduler.scheduler.running:
-                check_in_scheduler.start()
-        conn.close()
+                await check_in_scheduler.start()
     except Exception as e:
         logger.error(f"Failed to setup user config: {e}")
 
@@ -285,7 +517,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show daily productivity statistics."""
     log_audit("command", f"/stats by {update.effective_user.id}")
 
-    report = productivity_reporter.format_daily_report()
+    report = await asyncio.to_thread(productivity_reporter.format_daily_report)
 
     await update.message.reply_text(
         report,
@@ -293,30 +525,47 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_menu_keyboard()
     )
 
+_WORD_RE = re.compile(r"\w+")
+
+def _fts_prefix_query(search_term: str) -> str:
+    """Turn free text into quoted FTS5 prefix terms (call mom -> "call"* "mom"*)"""
+    return " ".join(f'"{word}"*' for word in _WORD_RE.findall(search_term))
+
 async def query_task_db(search_term: str):
     """Helper to search pending tasks by keyword."""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, task FROM todos WHERE status='Pending' AND task LIKE ? ORDER BY created_at DESC LIMIT 5", (f"%{search_term}%",))
-        rows = cursor.fetchall()
-        conn.close()
-        return rows
+        match = _fts_prefix_query(search_term)
+        if match:
+            try:
+                rows = await fetch_all(SQL_SEARCH_PENDING_FTS, (match,))
+                # FTS matches whole-word prefixes only; a substring ('all' in 'call') still needs the scan
+                if rows:
+                    return rows
+            except sqlite3.OperationalError:
+                pass  # No todos_fts table (FTS5 missing); fall back to a scan
+        return await fetch_all(SQL_SEARCH_PENDING, (f"%{search_term}%",))
     except Exception as e:
         logger.error(f"Search failed: {e}")
         return []
 
+async def refresh_and_sync() -> bool:
+    """Regenerate the context map and full-sync Obsidian side by side; True if both succeeded."""
+    # The vault scan and the DB->Obsidian sync are independent, so overlap them
+    # (sync first: it hands its work to threads before the scan takes the loop)
+    sync_success, result = await asyncio.gather(
+        execute_full_sync(), context_manager.generate_context_map(), return_exceptions=True
+    )
+    for outcome in (result, sync_success):
+        if isinstance(outcome, BaseException):
+            logger.error(f"Refresh failed: {outcome}")
+    return not isinstance(result, BaseException) and bool(result) and sync_success is True
+
 async def refresh_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Triggers a deep vault scan."""
     log_audit("command", f"/refresh_context by {update.effective_user.id}")
     await update.message.reply_text("🔍 Starting deep vault scan... this take a minute.")
-    
-    result = await context_manager.generate_context_map()
-    
-    # Trigger full sync to Obsidian
-    sync_success = await execute_full_sync()
 
-    if result and sync_success:
+    if await refresh_and_sync():
         await update.message.reply_text("✅ Context update & Obsidian Sync complete!", reply_markup=get_main_menu_keyboard())
     else:
         await update.message.reply_text("⚠️ Context refresh failed or Sync failed.", reply_markup=get_main_menu_keyboard())
@@ -346,6 +595,18 @@ async def query_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
+    await _run_vault_query(update, query_text, db_limit=10)
+
+def _recent_tasks_lines(limit: int) -> str:
+    """Recent tasks as prompt lines, joined straight off the cursor (runs in a worker thread)."""
+    with read_conn() as conn:
+        return "\n".join(
+            f"- [{priority}] {task} (Due: {due_date or 'Unscheduled'})"
+            for task, priority, due_date in conn.execute(SQL_RECENT_TASKS, (limit,))
+        )
+
+async def _run_vault_query(update: Update, query_text: str, *, db_limit: int = 10):
+    """Answer a question from the vault context plus the most recent tasks."""
     log_audit("query", f"User {update.effective_user.id}: {query_text}")
     status_msg = await update.message.reply_text("🔍 Searching personal knowledge base...")
     
@@ -355,31 +616,14 @@ async def query_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 2. Load Recent Tasks from DB
     db_context = "No recent tasks found in database."
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT task, category, priority, due_date, reasoning FROM todos ORDER BY created_at DESC LIMIT 10")
-        rows = cursor.fetchall()
-        conn.close()
-        if rows:
-            tasks = [f"- {r[0]} (Priority: {r[2]}, Due: {r[3]})" for r in rows]
-            db_context = "RECENT TASKS FROM DATABASE:\n" + "\n".join(tasks)
+        tasks = await asyncio.to_thread(_recent_tasks_lines, db_limit)
+        if tasks:
+            db_context = "RECENT TASKS FROM DATABASE:\n" + tasks
     except Exception as e:
         logger.error(f"DB Query failed: {e}")
 
-    prompt = f"""
-You are Kairos, a strategic advisor. Answer the following question based on the user's vault context and recent tasks.
-
-VAULT CONTEXT:
-{vault_context}
-
-{db_context}
-
-USER QUESTION:
-{query_text}
-
-Provide a concise, helpful answer. If the answer is in the recent tasks, highlight that.
-"""
-    response = triage_engine.model.generate_content(prompt)
+    prompt = QUERY_PROMPT.substitute(vault_context=vault_context, db_context=db_context, query_text=query_text)
+    response = await triage_engine.model.generate_content_async(prompt)
     await status_msg.edit_text(response.text, reply_markup=get_main_menu_keyboard())
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -391,7 +635,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # PRIORITY 1: Check for pending check-in response
     # Only if user is NOT in another conversation flow
     if not current_state and check_in_manager:
-        pending_check_in_id = check_in_manager.get_pending_check_in()
+        pending_check_in_id = await check_in_manager.get_pending_check_in()
 
         if pending_check_in_id:
             # User is responding to check-in
@@ -403,24 +647,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Clear pending check-in
                 check_in_manager.clear_pending_check_in()
 
-                # Emoji mapping
-                emoji_map = {
-                    'aligned': '✅',
-                    'beneficial': '💡',
-                    'wasted': '⚠️',
-                    'missed': '❌',
-                    'sleeping': '😴'
-                }
-                emoji = emoji_map.get(analysis['productivity_type'], '📝')
-
-                response = (
-                    f"{emoji} **Activity Logged**\n\n"
-                    f"**Summary:** {analysis['activity_summary']}\n"
-                    f"**Type:** {analysis['productivity_type'].title()}\n"
-                    f"**Alignment Score:** {analysis['alignment_score']}/10\n"
-                    f"**Category:** {analysis['category']}\n\n"
-                    f"💬 {analysis['feedback']}"
-                )
+                productivity_type = analysis['productivity_type']
+                response = _CHECKIN_TEMPLATE.format_map(analysis | {
+                    "emoji": _EMOJI_MAP.get(productivity_type, '📝'),
+                    "type_title": productivity_type.title(),
+                })
 
                 if analysis.get('matched_todo_id'):
                     response += f"\n\n✓ Matched to Task ID: {analysis['matched_todo_id']}"
@@ -435,216 +666,219 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 check_in_manager.clear_pending_check_in()
                 return
 
-    # PRIORITY 2: Check for keyboard shortcuts (these always work regardless of state)
-    if text == "✅ Done":
-        # Trigger same logic as /done command (interactive)
-        context.args = [] # No ID provided
-        await done_command(update, context)
-        return
-    elif text == "🏁 Start":
-        await start(update, context)
-        return
-    elif text == "📋 Unscheduled":
-        await list_unscheduled_command(update, context)
-        return
-    elif text == "🔄 Refresh Context":
-        user_data["state"] = None
-        await refresh_context(update, context)
-        return
-    elif text == "📈 Stats":
+    # PRIORITY 2: Keyboard shortcuts (these always work regardless of state)
+    shortcut = _SHORTCUTS.get(text)
+    if shortcut:
         user_data["state"] = None
-        await stats_command(update, context)
+        context.args = []  # Shortcuts behave like the bare command
+        await shortcut(update, context)
         return
 
-    # Handle state-based input
-    if current_state == "AWAITING_ADD_TASK":
-        user_data["state"] = None
-        await process_task(update, context, text)
+    # PRIORITY 3: Reply to whatever the conversation is waiting for
+    state_handler = _STATE_HANDLERS.get(current_state)
+    if state_handler:
+        await state_handler(update, context, text)
         return
 
-    if current_state == "AWAITING_DONE_ID":
-        task_id = text.strip()
-        # Verify ID exists first
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT task FROM todos WHERE id = ?", (task_id,))
-        row = cursor.fetchone()
-        conn.close()
-        
-        if not row:
-            await update.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_inline_menu())
-            user_data["state"] = None
-            return
-
-        # Ask for completion time
-        user_data["pending_done_id"] = task_id
-        user_data["state"] = None # Clear state so buttons work
-        
-        keyboard = [
-            [InlineKeyboardButton("✅ Completed Now", callback_data=f"complete_now_{task_id}"),
-             InlineKeyboardButton("📝 Custom Time", callback_data=f"complete_custom_{task_id}")]
-        ]
+    # Default: if it looks like they tried to add a task, prompt them
+    if len(text.split()) > 3:
         await update.message.reply_text(
-            f"✅ Found: **{row[0]}**\n\n🕐 **When did you complete it?**",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            "💡 It looks like you want to add a task. Tap **➕ Add Task** or type `/add`",
+            parse_mode="Markdown", reply_markup=get_main_menu_keyboard()
         )
-        return
-
-    if current_state == "AWAITING_DONE_SEARCH":
-        user_data["state"] = None
-        search_query = text
-        rows = await query_task_db(search_query)
-        
-        if not rows:
-            await update.message.reply_text(f"❌ No pending tasks found matching '{search_query}'.", reply_markup=get_inline_menu())
-            return
-            
-        keyboard = []
-        for r in rows:
-            # r = (id, task)
-            btn_text = f"{r[1]} [ID: {r[0]}]"
-            # Truncate if too long
-            if len(btn_text) > 40:
-                btn_text = btn_text[:37] + "..."
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"done_task_{row[0]}")])
-            
+    else:
         await update.message.reply_text(
-            f"🔍 **Search Results for '{search_query}':**",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            "I didn't quite get that. Use the menu button (/) or tap a button below.",
+            reply_markup=get_main_menu_keyboard()
         )
-        return
 
-    # --- Edit States ---
-    if current_state == "AWAITING_EDIT_ID":
-        task_id = text.strip()
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT task FROM todos WHERE id = ?", (task_id,))
-        row = cursor.fetchone()
-        conn.close()
-        
-        if not row:
-            await update.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_main_menu_keyboard())
-            user_data["state"] = None
-            return
-            
-        user_data["pending_edit_id"] = task_id
-        user_data["state"] = "AWAITING_EDIT_INSTRUCTION"
-        await update.message.reply_text(
-            f"✏️ **Editing Task {task_id}:** {row[0]}\n\nTell me your edits (e.g., 'Change priority to HIGH', 'due friday')",
-            parse_mode="Markdown"
-        )
-        return
+# --- Conversation state handlers (dispatched from handle_text) ---
+async def _on_add_task(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Triage the task sent after tapping Add Task."""
+    user_data = context.user_data
+    user_data["state"] = None
+    await process_task(update, context, text)
 
-    if current_state == "AWAITING_EDIT_SEARCH":
+async def _on_done_id(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Look up the task ID to complete and ask when it was done."""
+    user_data = context.user_data
+    task_id = _parse_task_id(text)
+    # Verify ID exists first
+    row = await fetch_one(SQL_GET_TASK, (task_id,)) if task_id is not None else None
+    
+    if not row:
+        await update.message.reply_text(f"❌ Task ID {text.strip()} not found.", reply_markup=get_inline_menu())
         user_data["state"] = None
-        search_query = text
-        rows = await query_task_db(search_query)
-        
-        if not rows:
-            await update.message.reply_text(f"❌ No pending tasks found matching '{search_query}'.", reply_markup=get_inline_menu())
-            return
-            
-        keyboard = []
-        for r in rows:
-            btn_text = f"{r[1]} [ID: {r[0]}]"
-            if len(btn_text) > 40:
-                btn_text = btn_text[:37] + "..."
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"edit_task_{r[0]}")])
-            
-        await update.message.reply_text(
-            f"🔍 **Select Task to Edit:**",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
         return
 
-    if current_state == "AWAITING_EDIT_INSTRUCTION":
-        user_data["state"] = None
-        task_id = user_data.get("pending_edit_id")
-        if not task_id:
-            await update.message.reply_text("❌ Error: Lost task ID.", reply_markup=get_main_menu_keyboard())
-            return
-            
-        instruction = text
-        # Fetch original task for context
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT raw_input FROM todos WHERE id = ?", (task_id,))
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            combined_text = f"Original task: {row[0]}\nEdit instruction: {instruction}"
-            await update.message.reply_text(f"🔄 Applying edit to Task {task_id}...")
-            await process_task(update, context, combined_text, update_id=int(task_id))
-        else:
-             await update.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_main_menu_keyboard())
-        return
+    # Ask for completion time
+    user_data["pending_done_id"] = task_id
+    user_data["pending_task_name"] = row[0]
+    user_data["state"] = None # Clear state so buttons work
+    
+    keyboard = [
+        [InlineKeyboardButton("✅ Completed Now", callback_data=f"complete_now_{task_id}"),
+         InlineKeyboardButton("📝 Custom Time", callback_data=f"complete_custom_{task_id}")]
+    ]
+    await update.message.reply_text(
+        f"✅ Found: **{row[0]}**\n\n🕐 **When did you complete it?**",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-    if current_state == "AWAITING_CUSTOM_COMPLETE_TIME":
-        task_id = user_data.get("pending_done_id")
-        if task_id:
-            await mark_task_complete(update, context, task_id, text.strip())
-        else:
-            await update.message.reply_text("❌ Session expired. Please start again.", reply_markup=get_inline_menu())
+async def _on_done_search(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Offer matching pending tasks to mark complete."""
+    user_data = context.user_data
+    user_data["state"] = None
+    search_query = text
+    rows = await query_task_db(search_query)
+    
+    if not rows:
+        await update.message.reply_text(f"❌ No pending tasks found matching '{search_query}'.", reply_markup=get_inline_menu())
         return
+        
+    # Remember the names so the picked button needn't look its task up again
+    user_data["done_name_cache"] = {r[0]: r[1] for r in rows}
+    keyboard = []
+    for r in rows:
+        # r = (id, task, raw_input)
+        btn_text = f"{r[1]} [ID: {r[0]}]"
+        # Truncate if too long
+        if len(btn_text) > 40:
+            btn_text = btn_text[:37] + "..."
+        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"done_task_{r[0]}")])
+        
+    await update.message.reply_text(
+        f"🔍 **Search Results for '{search_query}':**",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def _on_edit_id(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Look up the task ID to edit and ask for the change."""
+    user_data = context.user_data
+    task_id = _parse_task_id(text)
+    row = await fetch_one(SQL_GET_TASK_AND_INPUT, (task_id,)) if task_id is not None else None
     
-    if current_state == "AWAITING_QUERY":
+    if not row:
+        await update.message.reply_text(f"❌ Task ID {text.strip()} not found.", reply_markup=get_main_menu_keyboard())
         user_data["state"] = None
-        # Process the query (reuse logic from query_command)
-        log_audit("query", f"User {update.effective_user.id}: {text}")
-        status_msg = await update.message.reply_text("🔍 Searching personal knowledge base...")
-        vault_context = triage_engine._load_context()
-        db_context = "No recent tasks found in database."
-        try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT task, priority, due_date FROM todos ORDER BY created_at DESC LIMIT 5")
-            rows = cursor.fetchall()
-            conn.close()
-            if rows:
-                db_context = "RECENT TASKS:\n" + "\n".join([f"- [{r[1]}] {r[0]} (Due: {r[2] or 'Unscheduled'})" for r in rows])
-        except Exception as e:
-            logger.error(f"DB Query failed: {e}")
-        
-        prompt = f"""You are Kairos, a strategic advisor. Answer the following question based on the user's vault context and recent tasks.
-VAULT CONTEXT:\n{vault_context}\n{db_context}\nUSER QUESTION:\n{text}\nProvide a concise, helpful answer."""
-        response = triage_engine.model.generate_content(prompt)
-        await status_msg.edit_text(response.text, reply_markup=get_main_menu_keyboard())
         return
+        
+    user_data["pending_edit_id"] = task_id
+    user_data["pending_raw_input"] = row[1]
+    user_data["state"] = "AWAITING_EDIT_INSTRUCTION"
+    await update.message.reply_text(
+        f"✏️ **Editing Task {task_id}:** {row[0]}\n\nTell me your edits (e.g., 'Change priority to HIGH', 'due friday')",
+        parse_mode="Markdown"
+    )
+
+async def _on_edit_search(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Offer matching pending tasks to edit."""
+    user_data = context.user_data
+    user_data["state"] = None
+    search_query = text
+    rows = await query_task_db(search_query)
     
-    if current_state == "AWAITING_SCHEDULE":
-        # Parse schedule input: "<id> <date> [time]"
-        user_data["state"] = None
-        parts = text.split(maxsplit=1)
-        if len(parts) < 2:
-            await update.message.reply_text("❌ Please provide: `<task_id> <date>`\nExample: `15 Friday 3pm`", parse_mode="Markdown")
-            return
-        # Reuse schedule logic
-        context.args = parts  # Simulate args for schedule_task_command
-        await schedule_task_command(update, context)
+    if not rows:
+        await update.message.reply_text(f"❌ No pending tasks found matching '{search_query}'.", reply_markup=get_inline_menu())
         return
+        
+    user_data["edit_name_cache"] = {r[0]: (r[1], r[2]) for r in rows}
+    keyboard = []
+    for r in rows:
+        btn_text = f"{r[1]} [ID: {r[0]}]"
+        if len(btn_text) > 40:
+            btn_text = btn_text[:37] + "..."
+        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"edit_task_{r[0]}")])
+        
+    await update.message.reply_text(
+        f"🔍 **Select Task to Edit:**",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-    # Check for Clarification State
-    if current_state == "AWAITING_CLARIFICATION":
-        todo_id = user_data.get("pending_todo_id")
-        await process_clarification(update, context, todo_id, text)
+async def _on_edit_instruction(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Re-triage the task with the user's edit instruction."""
+    user_data = context.user_data
+    user_data["state"] = None
+    task_id = user_data.get("pending_edit_id")
+    if not task_id:
+        await update.message.reply_text("❌ Error: Lost task ID.", reply_markup=get_main_menu_keyboard())
         return
+        
+    instruction = text
+    # Original input was stashed when the task was picked
+    if "pending_raw_input" in user_data:
+        row = (user_data.pop("pending_raw_input"),)
+    else:
+        row = await fetch_one(SQL_GET_RAW_INPUT, (task_id,))
+    
+    if row:
+        combined_text = f"Original task: {row[0]}\nEdit instruction: {instruction}"
+        await update.message.reply_text(f"🔄 Applying edit to Task {task_id}...")
+        await process_task(update, context, combined_text, update_id=task_id)
+    else:
+         await update.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_main_menu_keyboard())
 
-    # Default: if it looks like they tried to add a task, prompt them
-    if len(text.split()) > 3:
-        await update.message.reply_text(
-            "💡 It looks like you want to add a task. Tap **➕ Add Task** or type `/add`",
-            parse_mode="Markdown", reply_markup=get_main_menu_keyboard()
-        )
+async def _on_custom_complete_time(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Complete the pending task at the time the user gave."""
+    user_data = context.user_data
+    task_id = user_data.get("pending_done_id")
+    if task_id:
+        await mark_task_complete(update, context, task_id, text.strip())
     else:
-        await update.message.reply_text(
-            "I didn't quite get that. Use the menu button (/) or tap a button below.",
-            reply_markup=get_main_menu_keyboard()
-        )
+        await update.message.reply_text("❌ Session expired. Please start again.", reply_markup=get_inline_menu())
+
+async def _on_query(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Answer a vault question sent after tapping Query Vault."""
+    user_data = context.user_data
+    user_data["state"] = None
+    await _run_vault_query(update, text, db_limit=5)
+
+async def _on_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Schedule a task from '<id> <date> [time]'."""
+    user_data = context.user_data
+    # Parse schedule input: "<id> <date> [time]"
+    user_data["state"] = None
+    parts = text.split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("❌ Please provide: `<task_id> <date>`\nExample: `15 Friday 3pm`", parse_mode="Markdown")
+        return
+    # Reuse schedule logic
+    context.args = parts  # Simulate args for schedule_task_command
+    await schedule_task_command(update, context)
+
+async def _on_clarification(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Apply the user's reply to the pending clarification."""
+    user_data = context.user_data
+    todo_id = user_data.get("pending_todo_id")
+    await process_clarification(update, context, todo_id, text)
+
+def _persist_db(triage: dict, text: str, is_scheduled: int, update_id: int = None):
+    """Insert or update the triaged task and return its ID (runs in a worker thread)."""
+    try:
+        with write_txn() as conn:
+            if update_id:
+                conn.execute(
+                    SQL_UPDATE_TODO,
+                    (triage.get("task_name", text), text, triage.get("category"), triage.get("priority"), triage.get("due_date"), triage.get("due_time"), is_scheduled, triage.get("reasoning"), triage.get("recurrence"), update_id)
+                )
+                return update_id
+            cursor = conn.execute(
+                SQL_INSERT_TODO,
+                (triage.get("task_name", text), text, triage.get("category"), triage.get("priority"), triage.get("due_date"), triage.get("due_time"), is_scheduled, triage.get("reasoning"), "Pending", triage.get("recurrence"))
+            )
+            return cursor.lastrowid
+    except Exception as e:
+        logger.error(f"Failed to save/update todos: {e}")
+        return update_id
+
+_SYNC_FIELDS = ("task_name", "priority", "category", "due_date", "due_time", "is_scheduled", "reasoning")
+
+def _sync_fingerprint(task: dict) -> tuple:
+    """(id, hash of the fields written to the Obsidian row) for skipping repeat writes."""
+    return task.get("id"), hash(tuple(task.get(k) for k in _SYNC_FIELDS))
 
 async def process_task(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, update_id: int = None):
     """Common logic for triaging a task. Supports updating existing tasks."""
@@ -659,26 +893,27 @@ async def process_task(update: Update, context: ContextTypes.DEFAULT_TYPE, text:
     if not has_due_date and not triage.get("clarification_needed") and not triage.get("scheduling_unclear"):
         triage["clarification_needed"] = "When would you like to complete this? Give me a date (e.g., 'Friday'), date+time (e.g., 'tomorrow at 3pm'), or say 'unscheduled' to add to backlog."
     
-    # DB Logic: Update or Insert
-    todo_id = update_id
-    try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        if update_id:
-            cursor.execute(
-                "UPDATE todos SET task=?, raw_input=?, category=?, priority=?, due_date=?, due_time=?, is_scheduled=?, reasoning=?, recurrence=?, status='Pending', updated_at=CURRENT_TIMESTAMP WHERE id=?",
-                (triage.get("task_name", text), text, triage.get("category"), triage.get("priority"), triage.get("due_date"), triage.get("due_time"), is_scheduled, triage.get("reasoning"), triage.get("recurrence"), update_id)
-            )
+    # Prepare triage data for Obsidian sync with is_scheduled
+    triage["is_scheduled"] = is_scheduled == 1
+    sync_obsidian = obsidian_writer and triage.get("priority") != "LOW" and not triage.get("clarification_needed")
+
+    # Persist to DB and Obsidian off the event loop
+    synced = False
+    db_write = asyncio.to_thread(_persist_db, triage, text, is_scheduled, update_id)
+    async with _obsidian_lock:
+        if update_id and sync_obsidian:
+            # The ID is known, so the DB row and this task's vault row are written side by side
+            # (full sync stays on /refresh_context)
+            triage["id"] = update_id
+            todo_id, synced = await asyncio.gather(db_write, asyncio.to_thread(obsidian_writer.upsert_task, triage))
         else:
-            cursor.execute(
-                "INSERT INTO todos (task, raw_input, category, priority, due_date, due_time, is_scheduled, reasoning, status, recurrence) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (triage.get("task_name", text), text, triage.get("category"), triage.get("priority"), triage.get("due_date"), triage.get("due_time"), is_scheduled, triage.get("reasoning"), "Pending", triage.get("recurrence"))
-            )
-            todo_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Failed to save/update todos: {e}")
+            # New tasks need the DB-assigned ID in their Obsidian row
+            todo_id = await db_write
+            triage["id"] = todo_id
+            if sync_obsidian:
+                synced = await asyncio.to_thread(obsidian_writer.append_task, triage)
+    if synced:
+        context.user_data["last_sync_state"] = _sync_fingerprint(triage)
 
     # Format response with user-friendly date/time
     is_update = "Updated" if update_id else "Captured"
@@ -692,24 +927,8 @@ async def process_task(update: Update, context: ContextTypes.DEFAULT_TYPE, text:
     ]
     if triage.get("recurrence"):
         response_parts.append(f"🔁 **Recurrence**: {triage.get('recurrence')}")
-    
-    # Prepare triage data for Obsidian sync with is_scheduled
-    triage["is_scheduled"] = is_scheduled == 1
-    triage["id"] = todo_id
-    
-    # Sync to Obsidian
-    synced = False
-    if obsidian_writer and triage.get("priority") != "LOW" and not triage.get("clarification_needed"):
-        if update_id:
-            # For updates, perform full sync to avoid duplicates
-            await execute_full_sync()
-            response_parts.append("📝 *Synced to Obsidian (Updated)*")
-            synced = True
-        else:
-            # For new tasks, safe to append
-            if obsidian_writer.append_task(triage):
-                response_parts.append("📝 *Synced to Obsidian*")
-                synced = True
+    if synced:
+        response_parts.append("📝 *Synced to Obsidian (Updated)*" if update_id else "📝 *Synced to Obsidian*")
 
     response_parts.append(f"\n**Reasoning**: {triage.get('reasoning')}")
     
@@ -728,7 +947,6 @@ async def process_task(update: Update, context: ContextTypes.DEFAULT_TYPE, text:
         context.user_data["pending_todo_id"] = todo_id
         response_parts.append(f"\n_(I'm waiting for your reply regarding Task {todo_id})_")
 
-    inline_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
     inline_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
     await status_msg.edit_text("\n".join(response_parts), parse_mode="Markdown", reply_markup=inline_markup)
     # await update.message.reply_text("Options:", reply_markup=get_main_menu_keyboard())
@@ -742,39 +960,29 @@ async def process_clarification(update: Update, context: ContextTypes.DEFAULT_TY
     # Check if user EXPLICITLY wants to mark as unscheduled
     # Only match if the reply is primarily about not scheduling (not just contains "not sure" in a date context)
     reply_lower = reply.lower().strip()
-    explicit_unscheduled = [
-        "unscheduled", "no date", "backlog", "no deadline", 
-        "add to backlog", "put in backlog", "skip scheduling",
-        "don't schedule", "no due date"
-    ]
     
     # Only trigger if the reply is SHORT and matches unscheduled intent
     # Avoid triggering on "I'll do it tomorrow, but not sure about the time"
     is_unscheduled_intent = (
         len(reply_lower.split()) <= 5 and 
-        any(kw in reply_lower for kw in explicit_unscheduled)
+        _UNSCHEDULED_RE.search(reply_lower) is not None
     )
     
     if is_unscheduled_intent:
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("UPDATE todos SET is_scheduled=0, due_date=NULL, due_time=NULL, updated_at=CURRENT_TIMESTAMP WHERE id=?", (todo_id,))
-            conn.commit()
-            
-            # Fetch task details for Obsidian sync
-            cursor.execute("SELECT task, category, priority, reasoning FROM todos WHERE id=?", (todo_id,))
-            row = cursor.fetchone()
-            conn.close()
-            
-            # Sync to Obsidian ONLY HERE (final state)
-            if row and obsidian_writer:
-                triage_data = {
-                    "id": todo_id,
-                    "task_name": row[0], "category": row[1], "priority": row[2],
-                    "due_date": None, "due_time": None, "is_scheduled": False, "reasoning": row[3]
-                }
-                obsidian_writer.append_task(triage_data)
+            async with _obsidian_lock:
+                # The UPDATE hands back the task details for Obsidian sync
+                row = await execute_write(SQL_UNSCHEDULE, (todo_id,), returning=True)
+                
+                # Sync to Obsidian ONLY HERE (final state)
+                if row and obsidian_writer:
+                    # Columns are named after the writer's keys, so the row is the task dict
+                    task = dict(row)
+                    state = _sync_fingerprint(task)
+                    if context.user_data.get("last_sync_state") != state:
+                        # Rewrite the task's row if it's already in the list rather than appending a duplicate
+                        if await asyncio.to_thread(obsidian_writer.upsert_task, task):
+                            context.user_data["last_sync_state"] = state
             
             await update.message.reply_text(
                 f"📋 **Task {todo_id} moved to Unscheduled backlog.**\nUse `/schedule {todo_id} <date> [time]` when you're ready to schedule it.",
@@ -786,11 +994,7 @@ async def process_clarification(update: Update, context: ContextTypes.DEFAULT_TY
     
     # Otherwise, re-triage with the clarification info
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT raw_input FROM todos WHERE id = ?", (todo_id,))
-        original_input = cursor.fetchone()[0]
-        conn.close()
+        original_input = (await fetch_one(SQL_GET_RAW_INPUT, (todo_id,)))[0]
         
         combined_text = f"Original task: {original_input}\nClarification info: {reply}"
         await update.message.reply_text(f"🔄 Refining Task {todo_id} with your reply...")
@@ -799,271 +1003,257 @@ async def process_clarification(update: Update, context: ContextTypes.DEFAULT_TY
         logger.error(f"Clarification failed: {e}")
         await update.message.reply_text("❌ Error updating task.", reply_markup=get_main_menu_keyboard())
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+async def _refresh_in_background(status_msg):
+    """Regenerate the context map and full-sync, then report on the status message."""
+    if await refresh_and_sync():
+        await status_msg.edit_text("✅ Context update & Obsidian Sync complete!", reply_markup=get_inline_menu())
+    else:
+        await status_msg.edit_text("⚠️ Context refresh failed or Sync failed.", reply_markup=get_inline_menu())
 
-    # Handle Sleep/Wake buttons (add at start)
-    if query.data == "checkin_sleep":
-        await check_in_manager.handle_sleep_button(update.effective_chat.id)
-        await query.message.reply_text(
-            "😴 **Sleep mode activated**\n\n"
-            "I'll pause check-ins until you press ☀️ Wake.\n"
-            "Sleep well!",
-            parse_mode="Markdown"
-        )
-        return
+async def _force_sync_in_background(status_msg):
+    """Full-sync to Obsidian, then report on the status message."""
+    # Full sync reads pending + recent completed in one snapshot query
+    if await execute_full_sync():
+        await status_msg.edit_text("🚀 **Force Sync Complete!**", parse_mode="Markdown", reply_markup=get_inline_menu())
+    else:
+        await status_msg.edit_text("❌ Sync failed.", reply_markup=get_inline_menu())
+
+# --- Inline button handlers (dispatched from button_callback) ---
+async def _cb_sleep(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Pause check-ins until the user wakes."""
+    await check_in_manager.handle_sleep_button(update.effective_chat.id)
+    await query.message.reply_text(
+        "😴 **Sleep mode activated**\n\n"
+        "I'll pause check-ins until you press ☀️ Wake.\n"
+        "Sleep well!",
+        parse_mode="Markdown"
+    )
 
-    elif query.data == "checkin_wake":
-        hours_slept = await check_in_manager.handle_wake_button(update.effective_chat.id)
-        await query.message.reply_text(
-            f"☀️ **Welcome back!**\n\n"
-            f"You slept for ~{hours_slept} hours.\n"
-            f"Check-ins resumed. Let's make today count!",
-            parse_mode="Markdown"
-        )
-        return
+async def _cb_wake(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Resume check-ins and report hours slept."""
+    hours_slept = await check_in_manager.handle_wake_button(update.effective_chat.id)
+    await query.message.reply_text(
+        f"☀️ **Welcome back!**\n\n"
+        f"You slept for ~{hours_slept} hours.\n"
+        f"Check-ins resumed. Let's make today count!",
+        parse_mode="Markdown"
+    )
 
-    # Handle inline menu buttons
-    if query.data == "menu_add":
-        context.user_data["state"] = "AWAITING_ADD_TASK"
-        await query.message.reply_text(
-            "➕ **What task would you like to add?**\n\n_Send me the task description (e.g., 'Submit application by Friday')_",
-            parse_mode="Markdown"
-        )
-        return
-    elif query.data == "menu_query":
-        context.user_data["state"] = "AWAITING_QUERY"
-        await query.message.reply_text(
-            "🔍 **What would you like to know?**\n\n_Ask me about your goals, recent tasks, or vault content._",
-            parse_mode="Markdown"
-        )
-        return
-    elif query.data == "menu_unscheduled":
-        # Fetch and display unscheduled tasks
-        try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, task, priority, category FROM todos WHERE is_scheduled=0 AND status='Pending' ORDER BY created_at DESC")
-            rows = cursor.fetchall()
-            conn.close()
-            
-            if not rows:
-                await query.message.reply_text("✅ No unscheduled tasks! All tasks have due dates.", reply_markup=get_inline_menu())
-                return
-            
-            response = "📋 **Unscheduled Tasks (Backlog)**\n\n"
-            for row in rows:
-                response += f"**[ID: {row[0]}]** {row[1]}\n   └─ {row[3]} | {row[2]} priority\n\n"
-            
-            response += "_Use `/schedule <id> <date> [time]` to schedule a task._"
-            await query.message.reply_text(response, parse_mode="Markdown", reply_markup=get_inline_menu())
-        except Exception as e:
-            logger.error(f"Failed to list unscheduled: {e}")
-        return
-    elif query.data == "menu_schedule":
-        context.user_data["state"] = "AWAITING_SCHEDULE"
-        await query.message.reply_text(
-            "📅 **Schedule a Task**\n\n"
-            "Send me the task ID and date:\n"
-            "`<task_id> <date> [time]`\n\n"
-            "Examples:\n• `30 Friday`\n• `30 tomorrow 3pm`",
-            parse_mode="Markdown"
-        )
-        return
-    elif query.data == "menu_done":
-        # Done button - show options to enter ID or search
-        keyboard = [
-            [InlineKeyboardButton("📝 Enter Task ID", callback_data="done_enter_id"),
-             InlineKeyboardButton("🔍 Search Tasks", callback_data="done_search")]
-        ]
-        await query.message.reply_text(
-            "✅ **Mark Task as Complete**\n\n"
-            "Which task did you complete?",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
-    
-    # --- Edit Button Handlers ---
-    elif query.data == "menu_edit":
-        context.user_data["state"] = None
-        keyboard = [
-            [InlineKeyboardButton("📝 Enter Task ID", callback_data="edit_enter_id"),
-             InlineKeyboardButton("🔍 Search Tasks", callback_data="edit_search")]
-        ]
-        await query.message.reply_text(
-            "✏️ **Edit Task**\n\n"
-            "Which task do you want to edit?",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return 
-    elif query.data == "edit_enter_id":
-        context.user_data["state"] = "AWAITING_EDIT_ID"
-        await query.message.reply_text(
-            "📝 **Enter Task ID to Edit**:\n\n_Send the number (e.g., 21)_",
-            parse_mode="Markdown"
-        )
-        return
-    elif query.data == "edit_search":
-        context.user_data["state"] = "AWAITING_EDIT_SEARCH"
-        await query.message.reply_text(
-            "🔍 **Search Task to Edit**:\n\n_Type a keyword (e.g., 'call', 'apply')_",
-            parse_mode="Markdown"
-        )
-        return
-    elif query.data.startswith("edit_task_"):
-        task_id = query.data.split("_")[2]
-        context.user_data["pending_edit_id"] = task_id
-        context.user_data["state"] = "AWAITING_EDIT_INSTRUCTION"
-        
-        # Fetch task name
-        task_name = "Task"
-        try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT task FROM todos WHERE id=?", (task_id,))
-            row = cursor.fetchone()
-            if row:
-                task_name = row[0]
-            conn.close()
-        except:
-            pass
+async def _cb_add(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Ask for a task to add."""
+    context.user_data["state"] = "AWAITING_ADD_TASK"
+    await query.message.reply_text(
+        "➕ **What task would you like to add?**\n\n_Send me the task description (e.g., 'Submit application by Friday')_",
+        parse_mode="Markdown"
+    )
 
-        await query.message.reply_text(
-            f"✏️ **Editing: {task_name} [ID: {task_id}]**\n\n"
-            "Tell me your edits (e.g., 'Change priority to HIGH', 'due friday')",
-            parse_mode="Markdown"
-        )
-        return
+async def _cb_query(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Ask for a vault question."""
+    context.user_data["state"] = "AWAITING_QUERY"
+    await query.message.reply_text(
+        "🔍 **What would you like to know?**\n\n_Ask me about your goals, recent tasks, or vault content._",
+        parse_mode="Markdown"
+    )
 
-    elif query.data == "done_enter_id":
-        context.user_data["state"] = "AWAITING_DONE_ID"
-        await query.message.reply_text(
-            "📝 **Enter the Task ID** you completed:\n\n"
-            "_Send the number (e.g., 21)_",
-            parse_mode="Markdown"
-        )
-        return
-    elif query.data == "done_search":
-        context.user_data["state"] = "AWAITING_DONE_SEARCH"
-        await query.message.reply_text(
-            "🔍 **Search for your task**\n\n"
-            "_Type a keyword to search (e.g., 'call', 'apply')_",
-            parse_mode="Markdown"
-        )
-        return
-    elif query.data.startswith("done_task_"):
-        # User selected a task from search results
-        task_id = query.data.split("_")[2]
-        context.user_data["pending_done_id"] = task_id
-        keyboard = [
-            [InlineKeyboardButton("✅ Completed Now", callback_data=f"complete_now_{task_id}"),
-             InlineKeyboardButton("📝 Custom Time", callback_data=f"complete_custom_{task_id}")]
-        ]
-        await query.message.reply_text(
-            f"🕐 **When did you complete Task ID: {task_id}?**",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
-    elif query.data.startswith("complete_now_"):
-        task_id = query.data.split("_")[2]
-        # Mark complete with current timestamp
-        await mark_task_complete(query, context, task_id, None)
-        return
-    elif query.data.startswith("complete_custom_"):
-        task_id = query.data.split("_")[2]
-        context.user_data["state"] = "AWAITING_CUSTOM_COMPLETE_TIME"
-        context.user_data["pending_done_id"] = task_id
-        await query.message.reply_text(
-            "📝 **When was it completed?**\n\n"
-            "_Send the date/time (e.g., 'yesterday 3pm', 'Jan 28 2pm')_",
-            parse_mode="Markdown"
-        )
-        return
-    elif query.data == "menu_stats":
-        await query.message.reply_text("📈 Stats feature coming soon in Phase 4!", reply_markup=get_inline_menu())
-        return
-    elif query.data == "menu_refresh":
-        await query.message.reply_text("🔍 Starting deep vault scan & full sync... this may take a minute.")
-        # 1. Update Context
-        result = await context_manager.generate_context_map()
-        # 2. Full Obsidian Sync
-        sync_success = await execute_full_sync()
-        if result and sync_success:
-            await query.message.reply_text("✅ Context update & Obsidian Sync complete!", reply_markup=get_inline_menu())
-        else:
-            await query.message.reply_text("⚠️ Context refresh failed or Sync failed.", reply_markup=get_inline_menu())
-        return
+async def _cb_unscheduled(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """List the unscheduled backlog."""
+    try:
+        rows = await fetch_all(SQL_LIST_UNSCHEDULED)
 
-    # Force Sync Button Handler
-    elif query.data.startswith("sync_"):
-        todo_id = query.data.split("_")[1]
-        try:
-            # Trigger full sync
-            await execute_full_sync()
-            await query.message.reply_text("🚀 **Force Sync Complete!**", reply_markup=get_inline_menu())
-        except Exception as e:
-            logger.error(f"Force sync failed: {e}")
-            await query.message.reply_text("❌ Sync failed.", reply_markup=get_inline_menu())
-        return
-        return
-    elif query.data == "menu_stats":
-        await query.message.reply_text("📈 Stats feature coming soon in Phase 4!", reply_markup=get_inline_menu())
-        return
-    elif query.data == "menu_refresh":
-        await query.message.reply_text("🔍 Starting deep vault scan & full sync... this may take a minute.")
-        
-        # 1. Update Context
-        result = await context_manager.generate_context_map()
-        
-        # 2. Full Obsidian Sync
-        sync_success = await execute_full_sync()
-        
-        if result and sync_success:
-            await query.message.reply_text("✅ Context update & Obsidian Sync complete!", reply_markup=get_inline_menu())
-        else:
-            await query.message.reply_text("⚠️ Context refresh failed or Sync failed.", reply_markup=get_inline_menu())
+        if not rows:
+            await query.message.reply_text("✅ No unscheduled tasks! All tasks have due dates.", reply_markup=get_inline_menu())
+            return
+
+        response = format_unscheduled(rows)
+        await query.message.reply_text(response, parse_mode="Markdown", reply_markup=get_inline_menu())
+    except Exception as e:
+        logger.error(f"Failed to list unscheduled: {e}")
+
+async def _cb_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Ask for '<id> <date> [time]'."""
+    context.user_data["state"] = "AWAITING_SCHEDULE"
+    await query.message.reply_text(
+        "📅 **Schedule a Task**\n\n"
+        "Send me the task ID and date:\n"
+        "`<task_id> <date> [time]`\n\n"
+        "Examples:\n• `30 Friday`\n• `30 tomorrow 3pm`",
+        parse_mode="Markdown"
+    )
+
+async def _cb_done(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Offer to complete a task by ID or by search."""
+    keyboard = [
+        [InlineKeyboardButton("📝 Enter Task ID", callback_data="done_enter_id"),
+         InlineKeyboardButton("🔍 Search Tasks", callback_data="done_search")]
+    ]
+    await query.message.reply_text(
+        "✅ **Mark Task as Complete**\n\n"
+        "Which task did you complete?",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def _cb_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Offer to edit a task by ID or by search."""
+    context.user_data["state"] = None
+    keyboard = [
+        [InlineKeyboardButton("📝 Enter Task ID", callback_data="edit_enter_id"),
+         InlineKeyboardButton("🔍 Search Tasks", callback_data="edit_search")]
+    ]
+    await query.message.reply_text(
+        "✏️ **Edit Task**\n\n"
+        "Which task do you want to edit?",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def _cb_edit_enter_id(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Ask for the ID of the task to edit."""
+    context.user_data["state"] = "AWAITING_EDIT_ID"
+    await query.message.reply_text(
+        "📝 **Enter Task ID to Edit**:\n\n_Send the number (e.g., 21)_",
+        parse_mode="Markdown"
+    )
+
+async def _cb_edit_search(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Ask for a keyword to find the task to edit."""
+    context.user_data["state"] = "AWAITING_EDIT_SEARCH"
+    await query.message.reply_text(
+        "🔍 **Search Task to Edit**:\n\n_Type a keyword (e.g., 'call', 'apply')_",
+        parse_mode="Markdown"
+    )
+
+async def _cb_done_enter_id(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Ask for the ID of the completed task."""
+    context.user_data["state"] = "AWAITING_DONE_ID"
+    await query.message.reply_text(
+        "📝 **Enter the Task ID** you completed:\n\n"
+        "_Send the number (e.g., 21)_",
+        parse_mode="Markdown"
+    )
+
+async def _cb_done_search(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Ask for a keyword to find the completed task."""
+    context.user_data["state"] = "AWAITING_DONE_SEARCH"
+    await query.message.reply_text(
+        "🔍 **Search for your task**\n\n"
+        "_Type a keyword to search (e.g., 'call', 'apply')_",
+        parse_mode="Markdown"
+    )
+
+async def _cb_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Stats placeholder."""
+    await query.message.reply_text("📈 Stats feature coming soon in Phase 4!", reply_markup=get_inline_menu())
+
+async def _cb_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Start a context refresh + full sync in the background."""
+    status_msg = await query.message.reply_text("🔍 Starting deep vault scan & full sync... this may take a minute.")
+    # Runs after the callback returns, so the ack and other updates aren't held up
+    context.application.create_task(_refresh_in_background(status_msg), update=update)
+
+async def _cb_edit_task(update: Update, context: ContextTypes.DEFAULT_TYPE, query, arg: str):
+    """Start editing a task picked from search results."""
+    task_id = int(arg)
+    context.user_data["pending_edit_id"] = task_id
+    context.user_data["state"] = "AWAITING_EDIT_INSTRUCTION"
+    context.user_data.pop("pending_raw_input", None)
+
+    # Task name (and the original input the edit will be applied to), from the search if possible
+    task_name = "Task"
+    try:
+        row = context.user_data.get("edit_name_cache", {}).get(task_id)
+        if row is None:
+            row = await fetch_one(SQL_GET_TASK_AND_INPUT, (task_id,))
+        if row:
+            task_name = row[0]
+            context.user_data["pending_raw_input"] = row[1]
+    except:
+        pass
+
+    await query.message.reply_text(
+        f"✏️ **Editing: {task_name} [ID: {task_id}]**\n\n"
+        "Tell me your edits (e.g., 'Change priority to HIGH', 'due friday')",
+        parse_mode="Markdown"
+    )
+
+async def _cb_done_task(update: Update, context: ContextTypes.DEFAULT_TYPE, query, arg: str):
+    """Ask when a task picked from search results was completed."""
+    task_id = int(arg)
+    context.user_data["pending_done_id"] = task_id
+    context.user_data["pending_task_name"] = context.user_data.get("done_name_cache", {}).get(task_id)
+    keyboard = [
+        [InlineKeyboardButton("✅ Completed Now", callback_data=f"complete_now_{task_id}"),
+         InlineKeyboardButton("📝 Custom Time", callback_data=f"complete_custom_{task_id}")]
+    ]
+    await query.message.reply_text(
+        f"🕐 **When did you complete Task ID: {task_id}?**",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def _cb_complete_now(update: Update, context: ContextTypes.DEFAULT_TYPE, query, arg: str):
+    """Mark complete with the current timestamp."""
+    await mark_task_complete(query, context, int(arg), None)
+
+async def _cb_complete_custom(update: Update, context: ContextTypes.DEFAULT_TYPE, query, arg: str):
+    """Ask for the completion time."""
+    task_id = int(arg)
+    context.user_data["state"] = "AWAITING_CUSTOM_COMPLETE_TIME"
+    if context.user_data.get("pending_done_id") != task_id:
+        context.user_data["pending_task_name"] = None
+    context.user_data["pending_done_id"] = task_id
+    await query.message.reply_text(
+        "📝 **When was it completed?**\n\n"
+        "_Send the date/time (e.g., 'yesterday 3pm', 'Jan 28 2pm')_",
+        parse_mode="Markdown"
+    )
+
+async def _cb_force_sync(update: Update, context: ContextTypes.DEFAULT_TYPE, query, arg: str):
+    """Force Sync button: full-sync in the background."""
+    status_msg = await query.message.reply_text("🚀 Syncing to Obsidian...")
+    context.application.create_task(_force_sync_in_background(status_msg), update=update)
+
+# callback_data -> handler
+_CALLBACK_HANDLERS = {
+    "checkin_sleep": _cb_sleep,
+    "checkin_wake": _cb_wake,
+    "menu_add": _cb_add,
+    "menu_query": _cb_query,
+    "menu_unscheduled": _cb_unscheduled,
+    "menu_schedule": _cb_schedule,
+    "menu_done": _cb_done,
+    "menu_edit": _cb_edit,
+    "edit_enter_id": _cb_edit_enter_id,
+    "edit_search": _cb_edit_search,
+    "done_enter_id": _cb_done_enter_id,
+    "done_search": _cb_done_search,
+    "menu_stats": _cb_stats,
+    "menu_refresh": _cb_refresh,
+}
+
+# callback_data prefix -> handler, called with the text after the prefix
+_CALLBACK_PREFIXES = (
+    ("edit_task_", _cb_edit_task),
+    ("done_task_", _cb_done_task),
+    ("complete_now_", _cb_complete_now),
+    ("complete_custom_", _cb_complete_custom),
+    ("sync_", _cb_force_sync),
+)
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    data = query.data
+    handler = _CALLBACK_HANDLERS.get(data)
+    if handler:
+        await handler(update, context, query)
         return
-    
-    # Handle sync buttons
-    if query.data.startswith("sync_"):
-        todo_id = query.data.split("_")[1]
-        try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT task, category, priority, due_date, due_time, is_scheduled, reasoning FROM todos WHERE id = ?", (todo_id,))
-            row = cursor.fetchone()
-            conn.close()
-            if row:
-                # Use sync_all_tasks logic instead of append to preserve file structure
-                cursor.execute("SELECT id, task, category, priority, due_date, due_time, is_scheduled, reasoning, status, recurrence FROM todos WHERE status='Pending' ORDER BY created_at DESC")
-                active_rows = cursor.fetchall()
-                active_tasks = []
-                for r in active_rows:
-                    active_tasks.append({
-                        "id": r[0], "task_name": r[1], "category": r[2], "priority": r[3],
-                        "due_date": r[4], "due_time": r[5], "is_scheduled": r[6] == 1,
-                        "reasoning": r[7], "status": r[8], "recurrence": r[9]
-                    })
-                    
-                cursor.execute("SELECT id, task, category, priority, completed_at FROM todos WHERE status='Completed' ORDER BY completed_at DESC LIMIT 10")
-                comp_rows = cursor.fetchall()
-                completed_tasks = []
-                for r in comp_rows:
-                    completed_tasks.append({
-                        "id": r[0], "task_name": r[1], "category": r[2], "priority": r[3],
-                        "completed_at": r[4]
-                    })
-                
-                if obsidian_writer:
-                    obsidian_writer.sync_all_tasks(active_tasks, completed_tasks)
-                    await query.edit_message_text(text=query.message.text + "\n\n🚀 **Force Synced!**", parse_mode="Markdown")
-                    await triage_engine.pm.analyze_overrides()
-        except Exception as e:
-            logger.error(f"Force sync failed: {e}")
+
+    for prefix, handler in _CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            await handler(update, context, query, data[len(prefix):])
+            return
 
 # --- New Commands for Scheduling ---
 async def list_unscheduled_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1071,21 +1261,13 @@ async def list_unscheduled_command(update: Update, context: ContextTypes.DEFAULT
     log_audit("command", f"/unscheduled by {update.effective_user.id}")
     
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, task, priority, category FROM todos WHERE is_scheduled=0 AND status='Pending' ORDER BY created_at DESC")
-        rows = cursor.fetchall()
-        conn.close()
+        rows = await fetch_all(SQL_LIST_UNSCHEDULED)
         
         if not rows:
             await update.message.reply_text("✅ No unscheduled tasks! All tasks have due dates.", reply_markup=get_main_menu_keyboard())
             return
         
-        response = "📋 **Unscheduled Tasks (Backlog)**\n\n"
-        for row in rows:
-            response += f"**[ID: {row[0]}]** {row[1]}\n   └─ {row[3]} | {row[2]} priority\n\n"
-        
-        response += "_Use `/schedule <id> <date> [time]` to schedule a task._"
+        response = format_unscheduled(rows)
         await update.message.reply_text(response, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
     except Exception as e:
         logger.error(f"Failed to list unscheduled: {e}")
@@ -1115,46 +1297,28 @@ async def schedule_task_command(update: Update, context: ContextTypes.DEFAULT_TY
         todo_id = int(args[0])
         date_time_str = " ".join(args[1:])
         
-        # Let Gemini parse the natural language date/time
-        parse_prompt = f"""
-Parse the following date/time string and return JSON:
-Input: "{date_time_str}"
-Current date: {datetime.now().strftime('%Y-%m-%d')}
-
-Return ONLY valid JSON:
-{{
-  "due_date": "YYYY-MM-DD",
-  "due_time": "HH:MM" or null if no time specified
-}}
-"""
-        response = triage_engine.model.generate_content(parse_prompt)
-        text = response.text
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0].strip()
-        elif "```" in text:
-            text = text.split("```")[1].split("```")[0].strip()
-        
-        parsed = json.loads(text)
-        due_date = parsed.get("due_date")
-        due_time = parsed.get("due_time")
+        # Common forms resolve locally; only free-form phrasing costs a Gemini round-trip
+        local = parse_schedule_text(date_time_str)
+        if local:
+            due_date, due_time = local
+        else:
+            # Let Gemini parse the natural language date/time
+            parse_prompt = SCHEDULE_PARSE_PROMPT.substitute(today=_today_iso(), text=date_time_str)
+            response = await triage_engine.model.generate_content_async(parse_prompt)
+            parsed = parse_json_response(response.text)
+            due_date = parsed.get("due_date")
+            due_time = parsed.get("due_time")
         
         if not due_date:
             await update.message.reply_text("❌ Couldn't parse that date. Try: `/schedule 30 2026-02-01`", parse_mode="Markdown")
             return
         
         # Update DB
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE todos SET due_date=?, due_time=?, is_scheduled=1, updated_at=CURRENT_TIMESTAMP WHERE id=?",
-            (due_date, due_time, todo_id)
-        )
-        if cursor.rowcount == 0:
+        updated = await execute_write(SQL_SCHEDULE, (due_date, due_time, todo_id))
+        if updated == 0:
             await update.message.reply_text(f"❌ Task ID {todo_id} not found.", reply_markup=get_main_menu_keyboard())
-            conn.close()
             return
-        conn.commit()
-        conn.close()
+        request_obsidian_sync()
         
         due_display = format_due_date_display(due_date, due_time, True)
         await update.message.reply_text(
@@ -1185,21 +1349,18 @@ async def done_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Handle direct ID: /done 21
-    task_id = context.args[0]
+    task_id = _parse_task_id(context.args[0])
     
     # Verify ID exists first
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT task FROM todos WHERE id = ?", (task_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = await fetch_one(SQL_GET_TASK, (task_id,)) if task_id is not None else None
     
     if not row:
-        await update.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_inline_menu())
+        await update.message.reply_text(f"❌ Task ID {context.args[0]} not found.", reply_markup=get_inline_menu())
         return
 
     # Ask for completion time
     context.user_data["pending_done_id"] = task_id
+    context.user_data["pending_task_name"] = row[0]
     
     keyboard = [
         [InlineKeyboardButton("✅ Completed Now", callback_data=f"complete_now_{task_id}"),
@@ -1235,92 +1396,48 @@ async def edit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: `/edit <id> <instruction>` or `/edit` (interactive)", parse_mode="Markdown")
         return
 
-    task_id = context.args[0]
+    task_id = _parse_task_id(context.args[0])
     instruction = " ".join(context.args[1:])
     
     # Check if task exists
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT raw_input FROM todos WHERE id = ?", (task_id,))
-    row = cursor.fetchone()
-    conn.close() # Close connection explicitly
+    row = await fetch_one(SQL_GET_RAW_INPUT, (task_id,)) if task_id is not None else None
     
     if not row:
-        await update.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_main_menu_keyboard())
+        await update.message.reply_text(f"❌ Task ID {context.args[0]} not found.", reply_markup=get_main_menu_keyboard())
+        return
+
+    # Plain key=value edits (e.g. 'priority=HIGH due_date=2026-02-01') skip re-triage
+    direct_edits = parse_direct_edits(context.args[1:])
+    if direct_edits:
+        await apply_direct_edits(update, task_id, direct_edits)
         return
 
     combined_text = f"Original task: {row[0]}\nEdit instruction: {instruction}"
     await update.message.reply_text(f"🔄 Applying edit to Task {task_id}...")
-    await process_task(update, context, combined_text, update_id=int(task_id))
-    
-    # 1. Try simple key=value parsing first
-    if "=" in instruction and " " not in instruction: # Simple case like priority=HIGH
-        try:
-            key, val = instruction.split("=", 1)
-            edits[key.lower()] = val
-        except:
-            pass
-            
-    # 2. If not simple, use LLM
-    if not edits:
-        msg = await update.message.reply_text("🤔 Parsing edits...")
-        edits = await triage_engine.parse_edit_request(instruction)
-        await msg.delete()
-    
-    if not edits:
-        await update.message.reply_text("❌ Could not understand the edit request.", reply_markup=get_inline_menu())
-        conn.close()
-        return
+    await process_task(update, context, combined_text, update_id=task_id)
 
-    # Apply updates
-    fields = []
-    values = []
-    
-    valid_fields = ["task_name", "category", "priority", "due_date", "due_time", "reasoning"]
-    field_map = {"task_name": "task"} # Map JSON field to DB column if different
-    
-    for k, v in edits.items():
-        db_col = field_map.get(k, k)
-        if db_col in ["task", "category", "priority", "due_date", "due_time", "reasoning"]:
-            fields.append(f"{db_col}=?")
-            values.append(v)
-            
-    if not fields:
-        await update.message.reply_text("❌ No valid fields to update.", reply_markup=get_inline_menu())
-        conn.close()
-        return
-        
-    values.append(task_id) # For WHERE clause
-    
+async def apply_direct_edits(update: Update, task_id: int, edits: dict):
+    """Write key=value edits straight to the task, then queue an Obsidian sync."""
     try:
-        query = f"UPDATE todos SET {', '.join(fields)}, updated_at=CURRENT_TIMESTAMP WHERE id=?"
-        cursor.execute(query, tuple(values))
-        conn.commit()
-        
-        # Fetch updated row for sync
-        cursor.execute("SELECT task, category, priority, due_date, due_time, is_scheduled, reasoning FROM todos WHERE id = ?", (task_id,))
-        new_row = cursor.fetchone()
-        conn.close()
-        
-        # Sync to Obsidian
-        if new_row and obsidian_writer:
-             triage_data = {
-                "task_name": new_row[0], "category": new_row[1], "priority": new_row[2],
-                "due_date": new_row[3], "due_time": new_row[4], "is_scheduled": new_row[5] == 1, "reasoning": new_row[6]
-            }
-             # Note: append_task appends. Ideally we should update. 
-             # For now, append_task will add a new entry. In a real update, we might need a dedicated update method in ObsidianWriter.
-             # Given current scope, we'll re-append with a note or just accept append.
-             # Better: just append as a "Correction" or "Update".
-             obsidian_writer.append_task(triage_data)
-
-        # Confirm to user
-        changes = "\n".join([f"• {k}: {v}" for k, v in edits.items()])
-        await update.message.reply_text(f"✅ **Task {task_id} Updated!**\n{changes}", parse_mode="Markdown", reply_markup=get_inline_menu())
-        
+        columns = list(edits)
+        if "due_date" in edits:
+            columns.append("is_scheduled")
+        assignments = ", ".join(f"{col}=?" for col in columns)
+        values = [edits[col] for col in edits] + ([1] if "due_date" in edits else [])
+        updated = await execute_write(
+            f"UPDATE todos SET {assignments}, updated_at=CURRENT_TIMESTAMP WHERE id=?",
+            (*values, task_id)
+        )
+        if updated == 0:
+            await update.message.reply_text(f"❌ Task ID {task_id} not found.", reply_markup=get_main_menu_keyboard())
+            return
+        request_obsidian_sync()
+
+        changes = "\n".join(f"• {k}: {v}" for k, v in edits.items())
+        await update.message.reply_text(f"✅ **Task {task_id} Updated!**\n{changes}", parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
     except Exception as e:
         logger.error(f"Edit failed: {e}")
-        await update.message.reply_text(f"❌ Edit failed: {e}", reply_markup=get_inline_menu())
+        await update.message.reply_text(f"❌ Edit failed: {e}", reply_markup=get_main_menu_keyboard())
 
 async def handle_multimodal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -1336,6 +1453,30 @@ async def handle_multimodal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await file.download_to_drive(save_path)
     await status_msg.edit_text(f"✅ {msg_type.capitalize()} saved.", reply_markup=get_main_menu_keyboard())
 
+# --- Text dispatch tables ---
+# Reply-keyboard labels -> command handlers
+_SHORTCUTS = {
+    "✅ Done": done_command,
+    "🏁 Start": start,
+    "📋 Unscheduled": list_unscheduled_command,
+    "🔄 Refresh Context": refresh_context,
+    "📈 Stats": stats_command,
+}
+
+# context.user_data["state"] -> handler for the next text message
+_STATE_HANDLERS = {
+    "AWAITING_ADD_TASK": _on_add_task,
+    "AWAITING_DONE_ID": _on_done_id,
+    "AWAITING_DONE_SEARCH": _on_done_search,
+    "AWAITING_EDIT_ID": _on_edit_id,
+    "AWAITING_EDIT_SEARCH": _on_edit_search,
+    "AWAITING_EDIT_INSTRUCTION": _on_edit_instruction,
+    "AWAITING_CUSTOM_COMPLETE_TIME": _on_custom_complete_time,
+    "AWAITING_QUERY": _on_query,
+    "AWAITING_SCHEDULE": _on_schedule,
+    "AWAITING_CLARIFICATION": _on_clarification,
+}
+
 async def post_init(application):
     """Set up bot commands menu after initialization."""
     commands = [
@@ -1353,35 +1494,65 @@ async def post_init(application):
     await application.bot.set_my_commands(commands)
     logger.info("Bot commands menu set successfully")
 
+    if obsidian_writer:
+        global _sync_worker_task
+        _sync_worker_task = application.create_task(_obsidian_sync_worker())
+
     # Initialize check-in system
     global check_in_manager, check_in_scheduler
     check_in_manager = CheckInManager(application.bot)
     check_in_scheduler = CheckInScheduler(application, check_in_manager)
 
     # Scheduler will auto-start if user_config exists
-    if check_in_scheduler.start():
+    if await check_in_scheduler.start():
         logger.info("✅ Check-in scheduler started")
     else:
         logger.info("⚠️ Check-in scheduler waiting for user setup")
 
+async def post_shutdown(application):
+    """Release long-lived resources on shutdown."""
+    if _sync_worker_task:
+        _sync_worker_task.cancel()
+        if _sync_requested.is_set():
+            await execute_full_sync()  # don't drop a pending debounced sync
+    flush_audit_log()
+    close_all()
+
+# One lock per chat: updates within a chat run in order, different chats run concurrently.
+# Weak values: a chat's lock lives only while an update holds or waits on it, so the map stays bounded
+CHAT_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def per_chat(handler):
+    """Wrap a handler so it holds its chat's lock for the duration of the update."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        if chat is None:
+            return await handler(update, context)
+        lock = CHAT_LOCKS.get(chat.id)
+        if lock is None:
+            lock = CHAT_LOCKS[chat.id] = asyncio.Lock()
+        async with lock:
+            return await handler(update, context)
+    return wrapper
+
 def main():
     ensure_dirs()
     if not TOKEN: return
-    application = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("refresh_context", refresh_context))
-    application.add_handler(CommandHandler("add", add_task_command))
-    application.add_handler(CommandHandler("query", query_command))
-    application.add_handler(CommandHandler("unscheduled", list_unscheduled_command))
-    application.add_handler(CommandHandler("unscheduled", list_unscheduled_command))
-    application.add_handler(CommandHandler("schedule", schedule_task_command))
-    application.add_handler(CommandHandler("done", done_command))
-    application.add_handler(CommandHandler("edit", edit_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
-    application.add_handler(MessageHandler(filters.VOICE | filters.PHOTO, handle_multimodal))
+    application = ApplicationBuilder().token(TOKEN).post_init(post_init).post_shutdown(post_shutdown).concurrent_updates(True).build()
+    application.add_handler(CommandHandler("start", per_chat(start)))
+    application.add_handler(CommandHandler("help", per_chat(help_command)))
+    application.add_handler(CommandHandler("refresh_context", per_chat(refresh_context)))
+    application.add_handler(CommandHandler("add", per_chat(add_task_command)))
+    application.add_handler(CommandHandler("query", per_chat(query_command)))
+    application.add_handler(CommandHandler("unscheduled", per_chat(list_unscheduled_command)))
+    application.add_handler(CommandHandler("schedule", per_chat(schedule_task_command)))
+    application.add_handler(CommandHandler("done", per_chat(done_command)))
+    application.add_handler(CommandHandler("edit", per_chat(edit_command)))
+    application.add_handler(CommandHandler("stats", per_chat(stats_command)))
+    application.add_handler(CallbackQueryHandler(per_chat(button_callback)))
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), per_chat(handle_text)))
+    application.add_handler(MessageHandler(filters.VOICE | filters.PHOTO, per_chat(handle_multimodal)))
     logger.info("Kairos Bot starting (v5.1-menu)...")
     application.run_polling()
 
@@ -1,58 +1,62 @@
 """
 CheckInManager: Manages sending check-ins and handling Sleep/Wake buttons
 """
+import asyncio
 import logging
+from functools import lru_cache
 from datetime import datetime, timedelta, time as dt_time
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from src.database import get_connection
+from src.db_pool import fetch_one, write_txn
 
 logger = logging.getLogger(__name__)
 
+# Same message and Sleep/Wake buttons every hour; built once
+_CHECKIN_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("😴 Sleep", callback_data="checkin_sleep"),
+        InlineKeyboardButton("☀️ Wake", callback_data="checkin_wake")
+    ]
+])
+_CHECKIN_TEXT = (
+    "⏰ **Hourly Check-In**\n\n"
+    "What did you do in the last hour?\n\n"
+    "💬 Reply with what you worked on, and I'll analyze how it aligns with your goals."
+)
+
+@lru_cache(maxsize=8)
+def _parse_wake_time(value: str) -> dt_time:
+    """'HH:MM' -> time; the configured wake time rarely changes, so parse it once"""
+    hour, minute = map(int, value.split(':'))
+    return dt_time(hour, minute)
+
+def _sleep_start_from_db(value) -> datetime:
+    """sleep_start_time is stored as unix seconds; rows written before that hold ISO text"""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return datetime.fromtimestamp(value)
+
 class CheckInManager:
     def __init__(self, bot):
         self.bot = bot
         self.pending_check_in_id = None
+        self.config_version = 0  # bumped on every user_config write so cached reads refresh
 
     async def send_check_in(self, chat_id: int):
         """Send hourly check-in message with Sleep/Wake buttons"""
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-
-            # Create check-in record
+            # Create check-in record (the commit runs in a worker thread, off the event loop)
             scheduled_time = datetime.now()
-            cursor.execute(
-                "INSERT INTO check_ins (scheduled_time, sent_time, status) VALUES (?, ?, ?)",
-                (scheduled_time, scheduled_time, 'sent')
-            )
-            check_in_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            check_in_id = await asyncio.to_thread(self._insert_check_in, scheduled_time)
 
             # Store as pending
             self.pending_check_in_id = check_in_id
 
-            # Create inline keyboard with Sleep/Wake buttons
-            keyboard = [
-                [
-                    InlineKeyboardButton("😴 Sleep", callback_data="checkin_sleep"),
-                    InlineKeyboardButton("☀️ Wake", callback_data="checkin_wake")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            # Send check-in message
-            message = (
-                "⏰ **Hourly Check-In**\n\n"
-                "What did you do in the last hour?\n\n"
-                "💬 Reply with what you worked on, and I'll analyze how it aligns with your goals."
-            )
-
+            # Send check-in message with Sleep/Wake buttons
             await self.bot.send_message(
                 chat_id=chat_id,
-                text=message,
+                text=_CHECKIN_TEXT,
                 parse_mode="Markdown",
-                reply_markup=reply_markup
+                reply_markup=_CHECKIN_KEYBOARD
             )
 
             logger.info(f"✅ Check-in {check_in_id} sent to chat {chat_id}")
@@ -62,18 +66,22 @@ class CheckInManager:
             logger.error(f"Failed to send check-in: {e}")
             raise
 
-    def get_pending_check_in(self):
+    def _insert_check_in(self, scheduled_time: datetime) -> int:
+        with write_txn() as conn:
+            cursor = conn.execute(
+                "INSERT INTO check_ins (scheduled_time, sent_time, status) VALUES (?, ?, ?)",
+                (int(scheduled_time.timestamp()), int(scheduled_time.timestamp()), 'sent')
+            )
+            return cursor.lastrowid
+
+    async def get_pending_check_in(self):
         """Get the current pending check-in ID"""
         if not self.pending_check_in_id:
             # Try to find most recent sent check-in
             try:
-                conn = get_connection()
-                cursor = conn.cursor()
-                cursor.execute(
+                row = await fetch_one(
                     "SELECT id FROM check_ins WHERE status = 'sent' ORDER BY sent_time DESC LIMIT 1"
                 )
-                row = cursor.fetchone()
-                conn.close()
                 if row:
                     self.pending_check_in_id = row[0]
             except Exception as e:
@@ -89,33 +97,52 @@ class CheckInManager:
     async def handle_sleep_button(self, chat_id: int):
         """Handle Sleep button press"""
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-
             # Update user config
             now = datetime.now()
-            cursor.execute(
+            await asyncio.to_thread(self._set_sleeping, chat_id, now)
+            self.config_version += 1
+
+            logger.info(f"User {chat_id} entered sleep mode at {now}")
+
+        except Exception as e:
+            logger.error(f"Failed to handle sleep button: {e}")
+            raise
+
+    def _set_sleeping(self, chat_id: int, now: datetime):
+        with write_txn() as conn:
+            conn.execute(
                 """UPDATE user_config
                    SET is_sleeping = 1,
                        sleep_start_time = ?,
                        updated_at = ?
                    WHERE chat_id = ?""",
-                (now, now, chat_id)
+                (int(now.timestamp()), int(now.timestamp()), chat_id)
             )
 
-            conn.commit()
-            conn.close()
+    async def handle_wake_button(self, chat_id: int):
+        """Handle Wake button press and mark retroactive sleep periods"""
+        try:
+            slept = await asyncio.to_thread(self._wake, chat_id)
+            self.config_version += 1
+            if slept is None:
+                logger.warning("No sleep start time found")
+                return 0
+            sleep_start_time, now = slept
 
-            logger.info(f"User {chat_id} entered sleep mode at {now}")
+            # Calculate hours slept
+            hours_slept = (now - sleep_start_time).total_seconds() / 3600
+
+            logger.info(f"User {chat_id} woke up. Slept for {hours_slept:.1f} hours")
+            return round(hours_slept, 1)
 
         except Exception as e:
-            logger.error(f"Failed to handle sleep button: {e}")
+            logger.error(f"Failed to handle wake button: {e}")
             raise
 
-    async def handle_wake_button(self, chat_id: int):
-        """Handle Wake button press and mark retroactive sleep periods"""
-        try:
-            conn = get_connection()
+    def _wake(self, chat_id: int):
+        """Mark the sleep window and wake the user; returns (sleep_start_time, now), or None if not asleep"""
+        # One BEGIN IMMEDIATE transaction: the read-modify-write commits (or rolls back) as a unit
+        with write_txn() as conn:
             cursor = conn.cursor()
 
             # Get sleep start time and default wake time
@@ -126,21 +153,19 @@ class CheckInManager:
             row = cursor.fetchone()
 
             if not row or not row[0]:
-                logger.warning("No sleep start time found")
-                conn.close()
-                return 0
+                return None
 
-            sleep_start_time = datetime.fromisoformat(row[0])
-            default_wake_time_str = row[1] or "08:00"
+            sleep_start_time = _sleep_start_from_db(row[0])
 
             # Calculate default wake time for today
             today = datetime.now().date()
-            wake_hour, wake_min = map(int, default_wake_time_str.split(':'))
-            default_wake_time = datetime.combine(today, dt_time(wake_hour, wake_min))
+            default_wake_time = datetime.combine(today, _parse_wake_time(row[1] or "08:00"))
 
             # Retroactive start is the later of sleep_start_time or default_wake_time
             retroactive_start = max(sleep_start_time, default_wake_time)
             now = datetime.now()
+            # check_ins times are unix seconds
+            range_params = (int(retroactive_start.timestamp()), int(now.timestamp()))
 
             # Mark check-ins as sleeping between retroactive_start and now
             cursor.execute(
@@ -149,33 +174,22 @@ class CheckInManager:
                    WHERE scheduled_time >= ?
                      AND scheduled_time <= ?
                      AND status IN ('missed', 'pending')""",
-                (retroactive_start, now)
+                range_params
             )
 
-            # Create activity_logs entries for sleeping periods
+            # Create activity_logs entries for sleeping periods; check-ins that already
+            # have one are skipped by the unique index on activity_logs(check_in_id)
             cursor.execute(
-                """SELECT id, scheduled_time FROM check_ins
+                """INSERT OR IGNORE INTO activity_logs
+                   (timestamp, activity_summary, productivity_type, check_in_id)
+                   SELECT scheduled_time, 'Sleeping', 'sleeping', id
+                   FROM check_ins
                    WHERE status = 'sleeping'
                      AND scheduled_time >= ?
                      AND scheduled_time <= ?""",
-                (retroactive_start, now)
+                range_params
             )
 
-            sleeping_check_ins = cursor.fetchall()
-            for check_in_id, scheduled_time in sleeping_check_ins:
-                # Check if activity log already exists
-                cursor.execute(
-                    "SELECT id FROM activity_logs WHERE check_in_id = ?",
-                    (check_in_id,)
-                )
-                if not cursor.fetchone():
-                    cursor.execute(
-                        """INSERT INTO activity_logs
-                           (timestamp, activity_summary, productivity_type, check_in_id)
-                           VALUES (?, ?, ?, ?)""",
-                        (scheduled_time, "Sleeping", "sleeping", check_in_id)
-                    )
-
             # Update user config - wake up
             cursor.execute(
                 """UPDATE user_config
@@ -183,41 +197,26 @@ class CheckInManager:
                        last_wake_time = ?,
                        updated_at = ?
                    WHERE chat_id = ?""",
-                (now, now, chat_id)
+                (int(now.timestamp()), int(now.timestamp()), chat_id)
             )
 
-            conn.commit()
-            conn.close()
-
-            # Calculate hours slept
-            hours_slept = (now - sleep_start_time).total_seconds() / 3600
-
-            logger.info(f"User {chat_id} woke up. Slept for {hours_slept:.1f} hours")
-            return round(hours_slept, 1)
-
-        except Exception as e:
-            logger.error(f"Failed to handle wake button: {e}")
-            raise
+        return sleep_start_time, now
 
     def mark_stale_as_missed(self):
         """Mark check-ins older than 90 minutes without response as missed"""
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-
             threshold = datetime.now() - timedelta(minutes=90)
 
-            cursor.execute(
-                """UPDATE check_ins
-                   SET status = 'missed'
-                   WHERE status = 'sent'
-                     AND sent_time < ?""",
-                (threshold,)
-            )
+            with write_txn() as conn:
+                cursor = conn.execute(
+                    """UPDATE check_ins
+                       SET status = 'missed'
+                       WHERE status = 'sent'
+                         AND sent_time < ?""",
+                    (int(threshold.timestamp()),)
+                )
 
-            updated_count = cursor.rowcount
-            conn.commit()
-            conn.close()
+                updated_count = cursor.rowcount
 
             if updated_count > 0:
                 logger.info(f"Marked {updated_count} stale check-ins as missed")
@@ -1,25 +1,38 @@
 """
 CheckInScheduler: APScheduler-based hourly check-in system
 """
+import asyncio
 import logging
-from datetime import datetime
+import time
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from src.database import get_connection
+from src.db_pool import fetch_one
 
 logger = logging.getLogger(__name__)
 
+# Issued on every tick; the pooled connections keep their prepared statements cached by SQL text
+SQL_CONFIGURED_CHAT_ID = "SELECT chat_id FROM user_config WHERE check_ins_enabled = 1 LIMIT 1"
+SQL_IS_SLEEPING = "SELECT is_sleeping FROM user_config WHERE chat_id = ?"
+
+# user_config changes a few times a day; writers bump CheckInManager.config_version to invalidate early
+CONFIG_CACHE_TTL_SECONDS = 30
+
+# Minutes to wait before each re-check while the user is busy; gives up after the last one
+RETRY_DELAYS_MINUTES = (5, 5, 10)
+
 class CheckInScheduler:
     def __init__(self, application, check_in_manager):
         self.application = application
         self.check_in_manager = check_in_manager
         self.scheduler = AsyncIOScheduler()
+        self._config_cache = {}  # key -> (value, expires_at, config_version)
+        self._retry_task = None
 
-    def start(self):
+    async def start(self):
         """Start the scheduler if user config exists"""
         try:
             # Check if user config exists
-            chat_id = self._get_configured_chat_id()
+            chat_id = await self._get_configured_chat_id()
             if not chat_id:
                 logger.info("⏳ Check-in scheduler waiting for user setup (/start)")
                 return False
@@ -51,27 +64,21 @@ class CheckInScheduler:
     async def _send_hourly_check_in(self):
         """Main hourly check-in job"""
         try:
-            chat_id = self._get_configured_chat_id()
+            chat_id = await self._get_configured_chat_id()
             if not chat_id:
                 logger.warning("No chat_id configured, skipping check-in")
                 return
 
             # Check 1: Is user sleeping?
-            if self._is_user_sleeping(chat_id):
+            if await self._is_user_sleeping(chat_id):
                 logger.info("User is sleeping, skipping check-in")
                 return
 
             # Check 2: Is user in a conversation?
-            if self._is_user_busy(chat_id):
+            if await self._is_user_busy(chat_id):
                 logger.info("User is busy, scheduling retry")
-                # Schedule retry in 5 minutes
-                self.scheduler.add_job(
-                    self._retry_check_in,
-                    'date',
-                    run_date=datetime.now().replace(second=0, microsecond=0) + \
-                             __import__('datetime').timedelta(minutes=5),
-                    args=[chat_id, 1]
-                )
+                if self._retry_task is None or self._retry_task.done():
+                    self._retry_task = asyncio.create_task(self._retry_check_in(chat_id))
                 return
 
             # Send check-in
@@ -80,32 +87,21 @@ class CheckInScheduler:
         except Exception as e:
             logger.error(f"Hourly check-in failed: {e}")
 
-    async def _retry_check_in(self, chat_id: int, retry_count: int):
-        """Retry check-in if user was busy"""
+    async def _retry_check_in(self, chat_id: int):
+        """Retry check-in if user was busy (one coroutine sleeping between checks, no scheduler jobs)"""
         try:
-            # Max 3 retries
-            if retry_count > 3:
-                logger.info(f"Max retries reached, marking as missed")
-                return
+            for retry_count, delay in enumerate(RETRY_DELAYS_MINUTES, start=1):
+                await asyncio.sleep(delay * 60)
 
-            # Check if still busy
-            if self._is_user_busy(chat_id):
-                # Schedule next retry (5, 10, 10 minutes intervals)
-                next_interval = 5 if retry_count == 1 else 10
-                logger.info(f"User still busy, retry {retry_count + 1} in {next_interval} mins")
-
-                self.scheduler.add_job(
-                    self._retry_check_in,
-                    'date',
-                    run_date=datetime.now().replace(second=0, microsecond=0) + \
-                             __import__('datetime').timedelta(minutes=next_interval),
-                    args=[chat_id, retry_count + 1]
-                )
-                return
+                if not await self._is_user_busy(chat_id):
+                    # User is free, send check-in
+                    await self.check_in_manager.send_check_in(chat_id)
+                    logger.info(f"Check-in sent after {retry_count} retries")
+                    return
 
-            # User is free, send check-in
-            await self.check_in_manager.send_check_in(chat_id)
-            logger.info(f"Check-in sent after {retry_count} retries")
+                logger.info(f"User still busy after retry {retry_count}")
+
+            logger.info(f"Max retries reached, marking as missed")
 
         except Exception as e:
             logger.error(f"Retry check-in failed: {e}")
@@ -113,37 +109,41 @@ class CheckInScheduler:
     async def _cleanup_stale_check_ins(self):
         """Mark old unanswered check-ins as missed"""
         try:
-            self.check_in_manager.mark_stale_as_missed()
+            await asyncio.to_thread(self.check_in_manager.mark_stale_as_missed)
         except Exception as e:
             logger.error(f"Cleanup failed: {e}")
 
-    def _get_configured_chat_id(self):
+    async def _cached_config(self, key, sql: str, params=()):
+        """Return the first row for a user_config query, re-reading at most every CONFIG_CACHE_TTL_SECONDS"""
+        now = time.monotonic()
+        version = self.check_in_manager.config_version
+        hit = self._config_cache.get(key)
+        if hit and hit[1] > now and hit[2] == version:
+            return hit[0]
+
+        row = await fetch_one(sql, params)
+        self._config_cache[key] = (row, now + CONFIG_CACHE_TTL_SECONDS, version)
+        return row
+
+    async def _get_configured_chat_id(self):
         """Get the configured chat_id from user_config"""
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT chat_id FROM user_config WHERE check_ins_enabled = 1 LIMIT 1")
-            row = cursor.fetchone()
-            conn.close()
+            row = await self._cached_config("chat_id", SQL_CONFIGURED_CHAT_ID)
             return row[0] if row else None
         except Exception as e:
             logger.error(f"Failed to get chat_id: {e}")
             return None
 
-    def _is_user_sleeping(self, chat_id: int):
+    async def _is_user_sleeping(self, chat_id: int):
         """Check if user is in sleep mode"""
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT is_sleeping FROM user_config WHERE chat_id = ?", (chat_id,))
-            row = cursor.fetchone()
-            conn.close()
+            row = await self._cached_config(("is_sleeping", chat_id), SQL_IS_SLEEPING, (chat_id,))
             return row[0] == 1 if row else False
         except Exception as e:
             logger.error(f"Failed to check sleep status: {e}")
             return False
 
-    def _is_user_busy(self, chat_id: int):
+    async def _is_user_busy(self, chat_id: int):
         """Check if user is in a conversation flow"""
         try:
             # Access bot's user_data context
@@ -1,103 +1,188 @@
 import os
 import json
+import asyncio
+import hashlib
 import logging
+import threading
 from pathlib import Path
+from string import Template
 import google.generativeai as genai
-from dotenv import load_dotenv
 from src.obsidian_reader import ObsidianReader
-from src.utils import ensure_dirs, log_audit
+from src.utils import configure_genai, log_audit, parse_json_response
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class ContextManager:
-    def __init__(self):
-        load_dotenv(override=True)
-        self.api_key = os.getenv("GEMINI_API_KEY")
-        self.vault_path = os.getenv("OBSIDIAN_VAULT_PATH")
-        
-        if not self.api_key:
-            raise ValueError("GEMINI_API_KEY not set in .env")
-        if not self.vault_path:
-            raise ValueError("OBSIDIAN_VAULT_PATH not set in .env")
-            
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel('gemini-3-pro-preview')
-        self.reader = ObsidianReader(self.vault_path)
-        
-        # Ensure data directory exists
-        Path("src/data").mkdir(parents=True, exist_ok=True)
-
-    async def generate_context_map(self):
-        """
-        Reads vault via ObsidianReader and prompts Gemini 1.5 Pro to extract context.
-        """
-        logger.info("Starting vault analysis for context...")
-        vault_content = self.reader.get_all_context_text()
-        
-        prompt = f"""
-You are a strategic advisor analyzing a user's knowledge base (Obsidian vault) to extract their current life context and goals.
+CONTEXT_MAP_PATH = Path("src/data/context_map.json")
 
-The user has following primary pillars in their life right now:
-1. Health and fitness.
-2. Career and livelihood goals.
-3. Quality of life and maintenance. 
-
-Analyze the following vault content and extract a structured JSON map.
+# (mtime_ns, parsed context_map.json), shared by every reader of the map in this process
+_context_map_cache = (None, None)
+_context_map_lock = threading.Lock()
 
-VAULT CONTENT:
-{vault_content}
+# Vaults bigger than this are summarized in batches and the partial maps merged
+MAP_REDUCE_THRESHOLD_CHARS = 200_000
 
-OUTPUT FORMAT (JSON ONLY):
-{{
+CONTEXT_MAP_SCHEMA = """{
   "primary_goals": [
-    {{
+    {
       "goal": "Career Growth",
       "deadline": null,
       "description": "...",
       "priority": "HIGH"
-    }},
-    {{
+    },
+    {
        "goal": "Get Fit",
        "deadline": null,
        "description": "...",
        "priority": "HIGH"
-    }}
+    }
   ],
   "active_projects": ["Project Name 1", "Project Name 2"],
   "skill_gaps": ["Skill 1", "Skill 2"],
   "recent_focus_areas": ["Area 1", "Area 2"],
   "critical_deadlines": [
-    {{ "event": "...", "date": "..." }}
+    { "event": "...", "date": "..." }
   ],
   "identity_context": "Brief summary of who the user is and what they value based on their files."
-}}
+}"""
+
+CONTEXT_PROMPT = Template("""
+You are a strategic advisor analyzing a user's knowledge base (Obsidian vault) to extract their current life context and goals.
+
+The user has following primary pillars in their life right now:
+1. Health and fitness.
+2. Career and livelihood goals.
+3. Quality of life and maintenance. 
+
+Analyze the following vault content and extract a structured JSON map.
+
+VAULT CONTENT:
+$vault_content
+
+OUTPUT FORMAT (JSON ONLY):
+$schema
 
 Focus on accuracy. If information isn't found, use null or an empty list.
-"""
+""")
+
+REDUCE_PROMPT = Template("""
+You are a strategic advisor. The user's Obsidian vault was too large to read at once, so each part below was
+analyzed separately into a partial context map. Merge them into ONE map: combine and deduplicate lists,
+keep the most specific goal descriptions and deadlines, and write a single identity_context.
+
+PARTIAL MAPS:
+$partial_maps
+
+OUTPUT FORMAT (JSON ONLY):
+$schema
+""")
+
+def load_context_map():
+    """Return the saved context map (None if there isn't one), re-parsing the file only when its mtime changes."""
+    global _context_map_cache
+    try:
+        mtime = CONTEXT_MAP_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _context_map_lock:
+        if _context_map_cache[0] != mtime:
+            with open(CONTEXT_MAP_PATH, "r", encoding='utf-8') as f:
+                _context_map_cache = (mtime, json.load(f))
+        return _context_map_cache[1]
+
+def _batch_chunks(chunks, limit: int):
+    """Group file sections into batches of at most ~limit characters (a single huge file is its own batch)."""
+    batch, size = [], 0
+    for chunk in chunks:
+        if batch and size + len(chunk) > limit:
+            yield batch
+            batch, size = [], 0
+        batch.append(chunk)
+        size += len(chunk)
+    if batch:
+        yield batch
+
+class ContextManager:
+    def __init__(self):
+        self.api_key = configure_genai()
+        self.vault_path = os.getenv("OBSIDIAN_VAULT_PATH")
         
-        try:
-            response = self.model.generate_content(prompt)
-            # Find the JSON block in the response
-            content = response.text
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
+        if not self.vault_path:
+            raise ValueError("OBSIDIAN_VAULT_PATH not set in .env")
             
-            context_map = json.loads(content)
+        self.model = genai.GenerativeModel('gemini-3-pro-preview')
+        self.reader = ObsidianReader(self.vault_path)
+        
+        # Ensure data directory exists
+        Path("src/data").mkdir(parents=True, exist_ok=True)
+
+        # Content hash of the vault text behind the last map; an unchanged vault skips Gemini
+        self._vault_fingerprint = None
+        self._context_map = None
+
+    async def _extract(self, prompt: str):
+        """One Gemini call, parsed to a dict."""
+        response = await self.model.generate_content_async(prompt)
+        return parse_json_response(response.text)
+
+    def _vault_digest(self):
+        """Content hash of the vault sections (the reads also warm the reader's file cache)."""
+        digest = hashlib.blake2b(digest_size=16)
+        for chunk in self.reader.iter_context_chunks():
+            digest.update(chunk.encode("utf-8"))
+        return digest.hexdigest()
+
+    async def generate_context_map(self):
+        """
+        Reads vault via ObsidianReader and prompts Gemini 1.5 Pro to extract context.
+        Large vaults are map-reduced: each batch of files gets its own partial map, then one call merges them.
+        """
+        logger.info("Starting vault analysis for context...")
+
+        # The vault walk and file reads block, so they run in a worker thread
+        fingerprint = await asyncio.to_thread(self._vault_digest)
+        if self._context_map is not None and fingerprint == self._vault_fingerprint:
+            logger.info("Vault content unchanged since the last analysis; reusing the context map")
+            return self._context_map
+
+        partial_tasks = []
+        try:
+            # Batches are pulled one at a time and each goes to Gemini as soon as it is built, so only
+            # the batch being assembled is held here; the partial analyses run concurrently
+            batches = _batch_chunks(self.reader.iter_context_chunks(), MAP_REDUCE_THRESHOLD_CHARS)
+            while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+                prompt = CONTEXT_PROMPT.substitute(vault_content="\n".join(batch), schema=CONTEXT_MAP_SCHEMA)
+                partial_tasks.append(asyncio.create_task(self._extract(prompt)))
+
+            if not partial_tasks:
+                context_map = await self._extract(CONTEXT_PROMPT.substitute(vault_content="", schema=CONTEXT_MAP_SCHEMA))
+            elif len(partial_tasks) == 1:
+                # The whole vault fit in one prompt, so its analysis is the map
+                context_map = await partial_tasks[0]
+            else:
+                logger.info(f"Vault is large; analyzed it in {len(partial_tasks)} parts")
+                partial_maps = await asyncio.gather(*partial_tasks)
+                context_map = await self._extract(REDUCE_PROMPT.substitute(
+                    partial_maps=json.dumps(partial_maps, indent=2), schema=CONTEXT_MAP_SCHEMA
+                ))
             
-            # Save to src/data/context_map.json
-            save_path = Path("src/data/context_map.json")
-            with open(save_path, "w", encoding='utf-8') as f:
+            # Save to src/data/context_map.json via a temp file + os.replace, so readers
+            # never see a half-written map
+            save_path = CONTEXT_MAP_PATH
+            tmp_path = save_path.with_name(save_path.name + ".tmp")
+            with open(tmp_path, "w", encoding='utf-8') as f:
                 json.dump(context_map, f, indent=2)
+            os.replace(tmp_path, save_path)
             
+            self._vault_fingerprint, self._context_map = fingerprint, context_map
             logger.info(f"Context map successfully generated and saved to {save_path}")
             log_audit("context_refresh", "Regenerated context_map.json from vault analysis.")
             return context_map
             
         except Exception as e:
+            for task in partial_tasks:
+                task.cancel()
             logger.error(f"Error generating context map: {e}")
             return None
 
@@ -7,13 +7,71 @@ load_dotenv()
 
 DB_PATH = os.getenv("DB_PATH", "kairos.db")
 
-def get_connection():
-    return sqlite3.connect(DB_PATH)
+# Applied once to long-lived connections; WAL lets readers run alongside the writer.
+# synchronous=NORMAL skips the fsync on each commit (the WAL is synced at checkpoints):
+# the database can't corrupt, but a power loss may drop the last few commits, e.g. the
+# most recent audit_logs batch. That's an acceptable trade for this bot's write rate.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Bump whenever init_db or the check-in migration changes the schema; databases already
+# at this version skip the whole migration pass
+SCHEMA_VERSION = 7
+
+def get_connection(**kwargs):
+    return sqlite3.connect(DB_PATH, **kwargs)
+
+def configure_connection(conn):
+    """Apply performance PRAGMAs to a connection that will be reused."""
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def init_todos_fts(cursor):
+    """Full-text index over todos.task, kept in sync by triggers (skipped if FTS5 is unavailable)."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='todos_fts'")
+    if cursor.fetchone():
+        return
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE todos_fts USING fts5(task, content='todos', content_rowid='id')")
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 unavailable, task search will use LIKE: {e}")
+        return
+
+    cursor.executescript('''
+    CREATE TRIGGER IF NOT EXISTS todos_fts_ai AFTER INSERT ON todos BEGIN
+        INSERT INTO todos_fts(rowid, task) VALUES (new.id, new.task);
+    END;
+    CREATE TRIGGER IF NOT EXISTS todos_fts_ad AFTER DELETE ON todos BEGIN
+        INSERT INTO todos_fts(todos_fts, rowid, task) VALUES ('delete', old.id, old.task);
+    END;
+    CREATE TRIGGER IF NOT EXISTS todos_fts_au AFTER UPDATE OF task ON todos BEGIN
+        INSERT INTO todos_fts(todos_fts, rowid, task) VALUES ('delete', old.id, old.task);
+        INSERT INTO todos_fts(rowid, task) VALUES (new.id, new.task);
+    END;
+    ''')
+    # Index rows that existed before the table was created
+    cursor.execute("INSERT INTO todos_fts(todos_fts) VALUES ('rebuild')")
+    print("Migration: Created 'todos_fts' full-text index")
 
 def init_db():
     conn = get_connection()
     cursor = conn.cursor()
 
+    cursor.execute("PRAGMA user_version")
+    if cursor.fetchone()[0] >= SCHEMA_VERSION:
+        conn.close()
+        print(f"Database at {DB_PATH} is up to date (schema v{SCHEMA_VERSION})")
+        return
+
+    # WAL is stored in the database file, so every later connection (pooled or per-call) uses it
+    cursor.execute("PRAGMA journal_mode=WAL")
+
     # Todos Table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS todos (
@@ -49,6 +107,30 @@ def init_db():
         cursor.execute("ALTER TABLE todos ADD COLUMN recurrence TEXT")
         print("Migration: Added 'recurrence' column to todos table")
 
+    # Serves the analyzer's active-todo lookup (status + priority range, due_date order)
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_todos_status_priority_due
+    ON todos(status, priority, due_date)
+    ''')
+
+    # Serve the Obsidian sync snapshot (per-status range scans already in output order)
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_todos_status_created
+    ON todos(status, created_at DESC)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_todos_status_completed
+    ON todos(status, completed_at DESC)
+    ''')
+
+    # Recent-tasks context for /query (ORDER BY created_at DESC LIMIT n)
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_todos_created
+    ON todos(created_at)
+    ''')
+
+    init_todos_fts(cursor)
+
     # Patterns Table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS patterns (
@@ -100,6 +182,12 @@ def init_db():
         migration.migrate()
     except Exception as e:
         print(f"Check-in migration: {e}")
+        return
+
+    # Only stamp the version once every step succeeded, so a failed run retries next time
+    conn = get_connection()
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.close()
 
 if __name__ == "__main__":
     init_db()
@@ -0,0 +1,120 @@
+"""
+db_pool: Long-lived SQLite connections shared by the bot's handlers
+"""
+import asyncio
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from src.database import get_connection, configure_connection
+
+READ_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256  # room for every distinct statement the handlers issue
+
+_conn = None
+_read_pool = None
+_init_lock = threading.Lock()
+
+# Held around every write on the shared connection; never hold it across an await
+write_lock = threading.Lock()
+
+
+def _open():
+    conn = configure_connection(get_connection(check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE))
+    conn.row_factory = sqlite3.Row  # still indexable and unpackable like a tuple
+    return conn
+
+
+def get_conn():
+    """Return the shared connection, opened once with the WAL PRAGMAs"""
+    global _conn
+    if _conn is None:
+        with _init_lock:
+            if _conn is None:
+                _conn = _open()
+    return _conn
+
+
+@contextmanager
+def write_txn():
+    """Run the block as one BEGIN IMMEDIATE transaction on the shared connection
+
+    The write lock is taken up front, so other connections wait rather than fail
+    mid-transaction; batch rows with executemany inside one block to share the commit.
+    """
+    conn = get_conn()
+    with write_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+@contextmanager
+def read_conn():
+    """Borrow a pooled read-only connection; under WAL these read alongside the writer"""
+    global _read_pool
+    if _read_pool is None:
+        with _init_lock:
+            if _read_pool is None:
+                pool = queue.Queue(maxsize=READ_POOL_SIZE)
+                for _ in range(READ_POOL_SIZE):
+                    pool.put(_open())
+                _read_pool = pool
+
+    conn = _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put(conn)
+
+
+def _fetch(sql, params, one):
+    with read_conn() as conn:
+        cursor = conn.execute(sql, params)
+        return cursor.fetchone() if one else cursor.fetchall()
+
+
+def _write(sql, params, returning):
+    with write_txn() as conn:
+        cursor = conn.execute(sql, params)
+        if returning:
+            # Every RETURNING row must be read before the commit, or the statement stays active
+            rows = cursor.fetchall()
+            return rows[0] if rows else None
+        return cursor.rowcount
+
+
+async def fetch_one(sql, params=()):
+    """Run a read on a pooled connection in a worker thread; returns the first row or None"""
+    return await asyncio.to_thread(_fetch, sql, params, True)
+
+
+async def fetch_all(sql, params=()):
+    """Run a read on a pooled connection in a worker thread; returns all rows"""
+    return await asyncio.to_thread(_fetch, sql, params, False)
+
+
+async def execute_write(sql, params=(), *, returning=False):
+    """Run one write in its own transaction in a worker thread
+
+    Returns the number of rows changed, or the first RETURNING row (None if no rows)
+    if returning=True; use RETURNING id where the new rowid is needed.
+    """
+    return await asyncio.to_thread(_write, sql, params, returning)
+
+
+def close_all():
+    """Close the shared and pooled connections (call on shutdown)"""
+    global _conn, _read_pool
+    with _init_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+        if _read_pool is not None:
+            while not _read_pool.empty():
+                _read_pool.get_nowait().close()
+            _read_pool = None
@@ -0,0 +1,224 @@
+"""
+LLMCache: Exact + semantic cache for Gemini responses
+"""
+import hashlib
+import json
+import logging
+import math
+import operator
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Optional, Protocol
+from src.db_pool import read_conn, write_txn
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_SECONDS = 3600  # Matches Gemini's default context cache window
+SIMILARITY_THRESHOLD = 0.92
+PRUNE_INTERVAL_SECONDS = 600  # How often the SQLite backend drops expired rows
+
+
+def make_cache_key(payload: dict) -> str:
+    """Stable SHA256 key for a JSON-serializable payload"""
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def l2_normalize(vector) -> array:
+    """Unit-length float32 copy of vector, so cosine similarity becomes a dot product"""
+    vec = array("f", vector)
+    norm = math.sqrt(sum(map(operator.mul, vec, vec)))
+    if norm:
+        vec = array("f", (x / norm for x in vec))
+    return vec
+
+
+def dot(a, b) -> float:
+    """Dot product of two equal-length vectors (cosine similarity when both are normalized)"""
+    return sum(map(operator.mul, a, b))
+
+
+class CacheBackend(Protocol):
+    def get(self, key: str) -> Optional[tuple]:
+        """Return the live (ts, scope, embedding, value) entry for key, or None"""
+        ...
+
+    def set(self, key: str, value: dict, scope: str = None, embedding: list = None, ts: float = None): ...
+
+    def delete(self, key: str): ...
+
+    def candidates(self, scope: str) -> list:
+        """Return (key, embedding, value) tuples stored under scope"""
+        ...
+
+
+class MemoryBackend:
+    """In-process LRU backend"""
+
+    def __init__(self, maxsize: int = 256, ttl: int = DEFAULT_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (ts, scope, embedding, value)
+        # Callers run in worker threads; guards the LRU reordering against concurrent scans
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, value: dict, scope: str = None, embedding: list = None, ts: float = None):
+        with self._lock:
+            self._entries[key] = (time.time() if ts is None else ts, scope, embedding, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def candidates(self, scope: str) -> list:
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            return [
+                (key, embedding, value)
+                for key, (ts, entry_scope, embedding, value) in self._entries.items()
+                if entry_scope == scope and embedding is not None and ts >= cutoff
+            ]
+
+
+class SQLiteBackend:
+    """Persistent backend stored in the llm_cache table (on the shared db_pool connections)"""
+
+    def __init__(self, ttl: int = DEFAULT_TTL_SECONDS):
+        self.ttl = ttl
+        self._next_prune = 0.0
+        try:
+            with write_txn() as conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS llm_cache (
+                           key TEXT PRIMARY KEY,
+                           scope TEXT,
+                           embedding BLOB,
+                           response TEXT,
+                           ts REAL
+                       )"""
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_scope ON llm_cache(scope, ts)")
+        except Exception as e:
+            logger.error(f"Failed to initialize llm_cache table: {e}")
+
+    def get(self, key: str) -> Optional[tuple]:
+        try:
+            with read_conn() as conn:
+                row = conn.execute(
+                    "SELECT ts, scope, embedding, response FROM llm_cache WHERE key = ? AND ts >= ?",
+                    (key, time.time() - self.ttl)
+                ).fetchone()
+            if row is None:
+                return None
+            ts, scope, blob, response = row
+            return ts, scope, array("f", blob) if blob is not None else None, json.loads(response)
+        except Exception as e:
+            logger.error(f"LLM cache read failed: {e}")
+            return None
+
+    def set(self, key: str, value: dict, scope: str = None, embedding: list = None, ts: float = None):
+        blob = array("f", embedding).tobytes() if embedding is not None else None
+        now = time.time()
+        try:
+            with write_txn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, scope, embedding, response, ts) VALUES (?, ?, ?, ?, ?)",
+                    (key, scope, blob, json.dumps(value), now if ts is None else ts)
+                )
+                # Expired rows are never served, so they only need dropping now and then
+                if now >= self._next_prune:
+                    conn.execute("DELETE FROM llm_cache WHERE ts < ?", (now - self.ttl,))
+                    self._next_prune = now + PRUNE_INTERVAL_SECONDS
+        except Exception as e:
+            logger.error(f"LLM cache write failed: {e}")
+
+    def delete(self, key: str):
+        try:
+            with write_txn() as conn:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+        except Exception as e:
+            logger.error(f"LLM cache delete failed: {e}")
+
+    def candidates(self, scope: str) -> list:
+        try:
+            with read_conn() as conn:
+                rows = conn.execute(
+                    """SELECT key, embedding, response FROM llm_cache
+                       WHERE scope = ? AND ts >= ? AND embedding IS NOT NULL""",
+                    (scope, time.time() - self.ttl)
+                ).fetchall()
+        except Exception as e:
+            logger.error(f"LLM cache scan failed: {e}")
+            return []
+
+        return [(key, array("f", blob), json.loads(response)) for key, blob, response in rows]
+
+
+class LLMCache:
+    """
+    Two-tier response cache: exact key lookup first, then cosine similarity
+    over embeddings stored under the same scope.
+    """
+
+    def __init__(self, backends: list = None, threshold: float = SIMILARITY_THRESHOLD):
+        # Ordered fastest-first; hits in a slower tier are promoted upwards
+        self.backends = backends if backends is not None else [MemoryBackend(), SQLiteBackend()]
+        self.threshold = threshold
+
+    def get(self, key: str) -> Optional[dict]:
+        for i, backend in enumerate(self.backends):
+            entry = backend.get(key)
+            if entry is not None:
+                ts, scope, embedding, value = entry
+                # Keep the original timestamp so a promoted entry still expires on schedule,
+                # and its scope/embedding so semantic lookups in the faster tier see it
+                for faster in self.backends[:i]:
+                    faster.set(key, value, scope=scope, embedding=embedding, ts=ts)
+                return value
+        return None
+
+    def get_similar(self, scope: str, embedding: list) -> Optional[dict]:
+        """Return the cached value whose embedding is closest above threshold"""
+        query = l2_normalize(embedding)
+        best_score, best_value = 0.0, None
+        seen = set()
+        for backend in self.backends:
+            for key, cached_embedding, value in backend.candidates(scope):
+                if key in seen:
+                    continue
+                seen.add(key)
+                score = dot(query, cached_embedding)
+                if score > best_score:
+                    best_score, best_value = score, value
+
+        if best_score >= self.threshold:
+            logger.info(f"Semantic cache hit (similarity {best_score:.3f})")
+            return best_value
+        return None
+
+    def set(self, key: str, value: dict, scope: str = None, embedding: list = None):
+        # Normalize once at insert so every later scan is a plain dot product
+        if embedding is not None:
+            embedding = l2_normalize(embedding)
+        for backend in self.backends:
+            backend.set(key, value, scope=scope, embedding=embedding)
+
+    def delete(self, key: str):
+        for backend in self.backends:
+            backend.delete(key)
@@ -85,27 +85,119 @@ def migrate():
         ''')
 
         # Create indexes for performance
+        # Day-range reports filter on timestamp and group by type/category, so the
+        # aggregation reads only the index
         cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_activity_timestamp
-        ON activity_logs(timestamp)
+        CREATE INDEX IF NOT EXISTS idx_activity_ts_type_cat
+        ON activity_logs(timestamp, productivity_type, category)
         ''')
 
+        # Covered by the leading column of idx_activity_ts_type_cat
+        cursor.execute("DROP INDEX IF EXISTS idx_activity_timestamp")
+
         cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_activity_type
         ON activity_logs(productivity_type)
         ''')
 
+        # One activity log per check-in. Keep the newest row if older versions left
+        # duplicates, then let the unique index replace the plain one.
+        cursor.execute('''
+        DELETE FROM activity_logs
+        WHERE check_in_id IS NOT NULL
+          AND id NOT IN (
+              SELECT MAX(id) FROM activity_logs
+              WHERE check_in_id IS NOT NULL
+              GROUP BY check_in_id
+          )
+        ''')
+
+        cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_activity_checkin
+        ON activity_logs(check_in_id)
+        ''')
+
+        cursor.execute("DROP INDEX IF EXISTS idx_activity_logs_check_in")
+
         cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_checkin_scheduled
         ON check_ins(scheduled_time)
         ''')
 
+        # Status + range predicates (wake: status/scheduled_time, stale sweep and
+        # pending lookup: status/sent_time) seek straight to their rows
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_checkin_status_sched
+        ON check_ins(status, scheduled_time)
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_checkin_status_sent
+        ON check_ins(status, sent_time)
+        ''')
+
+        # Covered by the leading column of both composites
+        cursor.execute("DROP INDEX IF EXISTS idx_checkin_status")
+
+        # One metrics row per period, so save_daily_metrics can upsert on it. Keep the
+        # newest row if older versions left duplicates.
+        cursor.execute('''
+        DELETE FROM productivity_metrics
+        WHERE id NOT IN (
+            SELECT MAX(id) FROM productivity_metrics
+            GROUP BY period_type, period_start
+        )
+        ''')
+
+        cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_metrics_period
+        ON productivity_metrics(period_type, period_start)
+        ''')
+
+        cursor.execute("DROP INDEX IF EXISTS idx_metrics_period")
+
+        # sleep_start_time is now unix seconds; convert ISO text left by older versions
+        # (values were naive local times, hence the 'utc' modifier)
         cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_checkin_status
-        ON check_ins(status)
+        UPDATE user_config
+        SET sleep_start_time = CAST(strftime('%s', sleep_start_time, 'utc') AS INTEGER)
+        WHERE typeof(sleep_start_time) = 'text'
+        ''')
+
+        # Check-in and activity times are unix seconds too: integer keys are smaller and
+        # compare faster in the range indexes than the datetime text older versions stored
+        for table, column in (
+            ("check_ins", "scheduled_time"),
+            ("check_ins", "sent_time"),
+            ("check_ins", "response_time"),
+            ("activity_logs", "timestamp"),
+        ):
+            cursor.execute(f'''
+            UPDATE {table}
+            SET {column} = CAST(strftime('%s', {column}, 'utc') AS INTEGER)
+            WHERE typeof({column}) = 'text'
+            ''')
+
+        # user_config wake/update times follow suit. Python wrote them as naive local times,
+        # but an updated_at still equal to created_at is the CURRENT_TIMESTAMP default (UTC)
+        cursor.execute('''
+        UPDATE user_config
+        SET last_wake_time = CAST(strftime('%s', last_wake_time, 'utc') AS INTEGER)
+        WHERE typeof(last_wake_time) = 'text'
+        ''')
+        cursor.execute('''
+        UPDATE user_config
+        SET updated_at = CASE
+            WHEN updated_at = created_at THEN CAST(strftime('%s', updated_at) AS INTEGER)
+            ELSE CAST(strftime('%s', updated_at, 'utc') AS INTEGER)
+        END
+        WHERE typeof(updated_at) = 'text'
         ''')
 
         conn.commit()
+
+        # Refresh planner statistics so the new indexes are picked for the range queries
+        cursor.execute("ANALYZE")
         print("[OK] Check-in system migration completed successfully")
         print("   - user_config table created")
         print("   - check_ins table created")
@@ -1,73 +1,89 @@
 import os
-import glob
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+READ_WORKERS = 16  # file reads are syscall-bound, so overlapping them scales well
+
+# Top-level folders whose notes are all included
+PRIORITY_FOLDERS = {"Job", "Projects"}
+# Files that may be anywhere but have high signal
+KEY_FILENAME_RE = re.compile(r"(README|Identity|.*Fitness.*|.*Health.*)\.md")
+# Priority notes under these are skipped; key files inside them are still picked up
+EXCLUDE_DIRS = {"venv", ".venv", "node_modules", ".git", ".gemini", "data"}
+
 class ObsidianReader:
     def __init__(self, vault_path: str):
         self.vault_path = Path(vault_path)
         if not self.vault_path.exists():
             raise ValueError(f"Vault path does not exist: {self.vault_path}")
+        # path -> (mtime_ns, size, text); unchanged files aren't re-read on the next scan
+        self._cache = {}
 
     def get_priority_files(self):
         """
         Finds markdown files in priority folders: Job, Projects, Identity.
         Also looks for fitness-related keywords.
+        One scandir walk classifies every file.
         """
-        # Define priority subfolders (case-insensitive globbing)
-        priority_patterns = [
-            "Job/**/*.md",
-            "Projects/**/*.md",
-        ]
-        
-        # Files that may be anywhere but have high signal
-        key_filenames = [
-            "README.md",
-            "Identity.md",
-            "*Fitness*.md",
-            "*Health*.md",
-        ]
-
-        files = set()
-        
-        # 1. Search priority folders
-        exclude_dirs = ["venv", ".venv", "node_modules", ".git", ".gemini", "data"]
-        
-        for pattern in priority_patterns:
-            for p in self.vault_path.glob(pattern):
-                if p.is_file():
-                    # Check if any part of the path is in exclude_dirs
-                    if not any(part in p.parts for part in exclude_dirs):
-                        files.add(p)
-        
-        # 2. Search for key filenames anywhere in the vault
-        for pattern in key_filenames:
-            for p in self.vault_path.rglob(pattern):
-                if p.is_file():
-                    files.add(p)
+        files = []
+        # (directory, whether it sits inside a priority folder, whether it sits inside an excluded folder)
+        stack = [(self.vault_path, False, False)]
+        while stack:
+            directory, in_priority, excluded = stack.pop()
+            try:
+                entries = os.scandir(directory)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        top_level = directory == self.vault_path
+                        stack.append((
+                            Path(entry.path),
+                            in_priority or (top_level and entry.name in PRIORITY_FOLDERS),
+                            excluded or entry.name in EXCLUDE_DIRS,
+                        ))
+                    elif (in_priority and not excluded and entry.name.endswith(".md")) or KEY_FILENAME_RE.fullmatch(entry.name):
+                        if entry.is_file():
+                            files.append(Path(entry.path))
 
-        return list(files)
+        return files
 
     def read_file_content(self, file_path: Path):
-        """Reads file content with basic error handling."""
+        """Reads file content with basic error handling, reusing the cached text if the file is unchanged."""
         try:
+            st = file_path.stat()
+            cached = self._cache.get(file_path)
+            if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                return cached[2]
+
             with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
+                text = f.read()
+            self._cache[file_path] = (st.st_mtime_ns, st.st_size, text)
+            return text
         except Exception as e:
+            self._cache.pop(file_path, None)
             return f"Error reading {file_path}: {e}"
 
+    def iter_context_chunks(self):
+        """
+        Yields one "--- FILE: ... ---" section per priority file, in file order.
+        """
+        priority_files = self.get_priority_files()
+        if not priority_files:
+            return
+
+        # Read concurrently; map() keeps the results in file order
+        with ThreadPoolExecutor(max_workers=min(READ_WORKERS, len(priority_files))) as pool:
+            for file, content in zip(priority_files, pool.map(self.read_file_content, priority_files)):
+                yield f"--- FILE: {file.relative_to(self.vault_path)} ---\n{content}\n"
+
     def get_all_context_text(self):
         """
         Reads all priority files and aggregates them into a structured string.
         """
-        priority_files = self.get_priority_files()
-        aggregated_text = []
-        
-        for file in priority_files:
-            rel_path = file.relative_to(self.vault_path)
-            content = self.read_file_content(file)
-            aggregated_text.append(f"--- FILE: {rel_path} ---\n{content}\n")
-            
-        return "\n".join(aggregated_text)
+        return "\n".join(self.iter_context_chunks())
 
 if __name__ == "__main__":
     # Test script
@@ -1,6 +1,54 @@
+import asyncio
+import json
 import os
+import threading
+from functools import lru_cache
 from pathlib import Path
-from datetime import datetime
+from datetime import date, datetime
+
+# Due dates/times repeat across tasks, so each distinct string is parsed once (bounded)
+@lru_cache(maxsize=512)
+def _fmt_date(raw) -> str:
+    """YYYY-MM-DD or a date -> DD-MM-YYYY (as-is if it doesn't parse)"""
+    if isinstance(raw, date):
+        return raw.strftime("%d-%m-%Y")
+    try:
+        return datetime.strptime(raw, "%Y-%m-%d").strftime("%d-%m-%Y")
+    except ValueError:
+        return raw
+
+@lru_cache(maxsize=512)
+def _fmt_time(raw: str) -> str:
+    """HH:MM (24hr) -> 12hr AM/PM (as-is if it doesn't parse)"""
+    try:
+        return datetime.strptime(raw, "%H:%M").strftime("%I:%M %p").lstrip("0")
+    except ValueError:
+        return raw
+
+ACTIVE_HEADER = (
+    "# 📋 TO-DO List\n\n"
+    "| ID | Task | Priority | Status | Category | Due Date | Due Time | Reasoning |\n"
+    "| :--- | :--- | :--- | :--- | :--- | :--- | :--- | :--- |\n"
+)
+COMPLETED_HEADER = (
+    "# ✅ Completed Tasks\n\n"
+    "| ID | Task | Completed At | Category | Priority |\n"
+    "| :--- | :--- | :--- | :--- | :--- |\n"
+)
+WRITE_BUFFER_SIZE = 1 << 20
+
+def _encode(text: str) -> bytes:
+    """Encode once for a binary write, with the newlines text mode would have written"""
+    if os.linesep != "\n":
+        text = text.replace("\n", os.linesep)
+    return text.encode("utf-8")
+
+ACTIVE_ROW_FMT = "| {} | {} | {} | {} | {} | {} | {} | {} |\n"
+COMPLETED_ROW_FMT = "| {} | {} | {} | {} | {} |\n"
+
+# Only free-text fields (task name, reasoning) can contain table pipes or newlines
+_PIPE_ESCAPE = str.maketrans({"|": "\\|"})
+_REASONING_ESCAPE = str.maketrans({"|": "\\|", "\n": " ", "\r": " "})
 
 class ObsidianWriter:
     def __init__(self, vault_path: str):
@@ -11,118 +59,196 @@ class ObsidianWriter:
         # Aligning with PRD requirements (Section 6.2 Step 6)
         self.inbox_path = self.vault_path / "To Do" / "TO-DO List.md"
         self.completed_path = self.vault_path / "To Do" / "Completed Tasks.md"
+        # Which completed task IDs are already in Completed Tasks.md
+        self.state_path = self.vault_path / ".kairos_state.json"
         
         # Ensure target directory exists
         self.inbox_path.parent.mkdir(parents=True, exist_ok=True)
 
+        # Inbox handle held open inside a `with writer:` block
+        self._fh = None
+        # Set once TO-DO List.md is known to exist with its header, so appends skip the stat()
+        self._inbox_initialized = False
+        # Writes come from several worker threads; one TO-DO List.md write at a time, so a
+        # full rewrite can't land between an upsert's read and its write
+        self._inbox_lock = threading.Lock()
+        # Completed Tasks.md is append-only and deduplicated through the state file, so the
+        # load-state/append/save-state sequence must not overlap (it would append rows twice)
+        self._completed_lock = threading.Lock()
+
+    def __enter__(self):
+        """Open TO-DO List.md once so append_task calls in the block share the handle."""
+        is_new = not self._inbox_initialized and not self.inbox_path.exists()
+        self._fh = open(self.inbox_path, "ab", buffering=WRITE_BUFFER_SIZE)
+        if is_new:
+            self._fh.write(_encode(ACTIVE_HEADER))
+        self._inbox_initialized = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._fh.close()
+        self._fh = None
+        return False
+
     def append_task(self, task_data: dict):
         """
         Appends a formatted task as a table row to the TO-DO List.md file.
         Format: | Task | Priority | Status | Category | Due Date | Due Time | Reasoning |
         """
+        return self.append_tasks([task_data])
+
+    def append_tasks(self, tasks: list):
+        """
+        Appends several task rows to TO-DO List.md with one open and one write.
+        """
         try:
-            # Create file with header if it doesn't exist
-            if not self.inbox_path.exists():
-                with open(self.inbox_path, "w", encoding='utf-8') as f:
-                    f.write("# 📋 TO-DO List\n\n")
-                    f.write("| ID | Task | Priority | Status | Category | Due Date | Due Time | Reasoning |\n")
-                    f.write("| :--- | :--- | :--- | :--- | :--- | :--- | :--- | :--- |\n")
-
-            category = task_data.get("category", "General")
-            priority = task_data.get("priority", "MEDIUM")
-            name = task_data.get("task_name", "Untitled Task")
-            reasoning = task_data.get("reasoning", "").replace("\n", " ") # Keep on one line
-            status = task_data.get("status", "Pending")
-            
-            # Handle due date/time formatting
-            raw_due_date = task_data.get("due_date")
-            raw_due_time = task_data.get("due_time")
-            is_scheduled = task_data.get("is_scheduled", True)
-            
-            if not is_scheduled or not raw_due_date:
-                date_display = "📅 Unscheduled"
-                time_display = "—"
-            else:
-                # Convert YYYY-MM-DD to DD-MM-YYYY
-                try:
-                    d = datetime.strptime(raw_due_date, "%Y-%m-%d")
-                    date_display = d.strftime("%d-%m-%Y")
-                except ValueError:
-                    date_display = raw_due_date  # Use as-is if parsing fails
-                
-                # Convert HH:MM (24hr) to 12hr AM/PM
-                if raw_due_time:
-                    try:
-                        t = datetime.strptime(raw_due_time, "%H:%M")
-                        time_display = t.strftime("%I:%M %p").lstrip("0")
-                    except ValueError:
-                        time_display = raw_due_time  # Use as-is if parsing fails
-                else:
-                    time_display = "—"
-            
-            # Escape any pipe characters in the text
-            name = name.replace("|", "\\|")
-            reasoning = reasoning.replace("|", "\\|")
+            entries = [self._format_task_row(t) for t in tasks]
+            with self._inbox_lock:
+                if self._fh is not None:
+                    self._fh.write(_encode("".join(entries)))
+                    return True
+
+                # Create file with header if it doesn't exist
+                if not self._inbox_initialized and not self.inbox_path.exists():
+                    entries.insert(0, ACTIVE_HEADER)
 
-            entry = f"| {task_data.get('id', '—')} | {name} | {priority} | {status} | {category} | {date_display} | {time_display} | {reasoning} |\n"
+                with open(self.inbox_path, "ab") as f:
+                    f.write(_encode("".join(entries)))
+                self._inbox_initialized = True
 
-            with open(self.inbox_path, "a", encoding='utf-8') as f:
-                f.write(entry)
-                
             return True
         except Exception as e:
             print(f"Error writing to Obsidian: {e}")
             return False
 
-    def sync_all_tasks(self, active_tasks: list, completed_tasks: list):
+    def upsert_task(self, task_data: dict):
+        """
+        Rewrites the TO-DO List.md row for task_data['id'] in place, appending it if absent.
+        Touches only the active list, so an edit doesn't need a full DB sync.
+        """
+        try:
+            row = self._format_task_row(task_data)
+            prefix = f"| {task_data.get('id', '—')} | "
+            with self._inbox_lock:
+                if not self.inbox_path.exists():
+                    with open(self.inbox_path, "wb") as f:
+                        f.write(_encode(ACTIVE_HEADER + row))
+                    self._inbox_initialized = True
+                    return True
+
+                with open(self.inbox_path, "r", encoding='utf-8') as f:
+                    lines = f.readlines()
+
+                for i, line in enumerate(lines):
+                    if line.startswith(prefix):
+                        lines[i] = row
+                        break
+                else:
+                    lines.append(row)
+
+                with open(self.inbox_path, "wb") as f:
+                    f.write(_encode("".join(lines)))
+            return True
+        except Exception as e:
+            print(f"Error updating Obsidian task: {e}")
+            return False
+
+    def sync_all_tasks(self, active_tasks: list, completed_tasks: list, force_rewrite: bool = False):
         """
         Refreshes both Active and Completed lists in separate files.
+        force_rewrite regenerates Completed Tasks.md instead of appending new completions.
         """
         try:
-            # 1. Update Active Tasks (Overwrite TO-DO List.md)
-            with open(self.inbox_path, "w", encoding='utf-8') as f:
-                f.write("# 📋 TO-DO List\n\n")
-                f.write("| ID | Task | Priority | Status | Category | Due Date | Due Time | Reasoning |\n")
-                f.write("| :--- | :--- | :--- | :--- | :--- | :--- | :--- | :--- |\n")
-                
-                for task in active_tasks:
-                    line = self._format_task_row(task)
-                    f.write(line)
-            
-            # 2. Update Completed Tasks (Overwrite or Append to Completed Tasks.md)
-            # For now, we'll overwrite with the latest 10-20 passed from DB to keep it clean,
-            # but ideally this file could grow. Since we pass 'completed_tasks' which is limited by query,
-            # we overwrite to ensure the list matches the DB's "Recently Completed" view.
-            if completed_tasks:
-                with open(self.completed_path, "w", encoding='utf-8') as f:
-                    f.write("# ✅ Recently Completed\n\n")
-                    f.write("| ID | Task | Completed At | Category | Priority |\n")
-                    f.write("| :--- | :--- | :--- | :--- | :--- |\n")
-                    
-                    for task in completed_tasks:
-                        tid = task.get('id', '—')
-                        comp_time = task.get('completed_at', '—')
-                        name = task.get('task_name', 'Untitled').replace("|", "\\|")
-                        cat = task.get('category', 'General')
-                        prio = task.get('priority', 'MEDIUM')
-                        
-                        f.write(f"| {tid} | {name} | {comp_time} | {cat} | {prio} |\n")
-                        
+            self._write_active(active_tasks)
+            self._write_completed(completed_tasks, force_rewrite)
+            return True
+        except Exception as e:
+            print(f"Error syncing to Obsidian: {e}")
+            return False
+
+    async def sync_all_tasks_async(self, active_tasks: list, completed_tasks: list, force_rewrite: bool = False):
+        """
+        Same as sync_all_tasks, but writes both files concurrently in worker threads.
+        """
+        try:
+            await asyncio.gather(
+                asyncio.to_thread(self._write_active, active_tasks),
+                asyncio.to_thread(self._write_completed, completed_tasks, force_rewrite)
+            )
             return True
         except Exception as e:
             print(f"Error syncing to Obsidian: {e}")
             return False
 
+    def _write_active(self, active_tasks: list):
+        """Update Active Tasks (Overwrite TO-DO List.md)"""
+        parts = [ACTIVE_HEADER]
+        parts.extend(self._format_task_row(task) for task in active_tasks)
+        with self._inbox_lock:
+            with open(self.inbox_path, "wb") as f:
+                f.write(_encode("".join(parts)))
+            self._inbox_initialized = True
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self.state_path, "r", encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_state(self, state: dict):
+        # Temp file + os.replace, so a crash never leaves a half-written state file
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _write_completed(self, completed_tasks: list, force_rewrite: bool = False):
+        """Update Completed Tasks (append new completions to Completed Tasks.md)"""
+        # completed_tasks is the DB's recent-completions window (newest first). Rows already
+        # in the file are skipped, so the file grows by the delta and keeps older history.
+        # IDs rather than a max-ID cursor, since tasks aren't completed in ID order.
+        if not completed_tasks:
+            return
+        with self._completed_lock:
+            state = self._load_state()
+            # Regenerate if asked, or if the file/state is missing (e.g. written by an older version)
+            rewrite = force_rewrite or "completed_ids" not in state or not self.completed_path.exists()
+            written = set() if rewrite else set(state["completed_ids"])
+
+            new_tasks = [t for t in completed_tasks if t.get('id') not in written]
+            if not new_tasks:
+                return
+
+            parts = [COMPLETED_HEADER] if rewrite else []
+            fmt = COMPLETED_ROW_FMT.format
+            # Oldest first, so appended rows stay in completion order
+            for task in reversed(new_tasks):
+                parts.append(fmt(
+                    task.get('id', '—'),
+                    task.get('task_name', 'Untitled').translate(_PIPE_ESCAPE),
+                    task.get('completed_at', '—'),
+                    task.get('category', 'General'),
+                    task.get('priority', 'MEDIUM'),
+                ))
+
+            with open(self.completed_path, "wb" if rewrite else "ab") as f:
+                f.write(_encode("".join(parts)))
+
+            written.update(t.get('id') for t in new_tasks)
+            state["completed_ids"] = sorted(written)
+            self._save_state(state)
+
     def _format_task_row(self, task_data: dict) -> str:
         """Helper to format a single task row."""
         tid = task_data.get("id", "—")
         category = task_data.get("category", "General")
         priority = task_data.get("priority", "MEDIUM")
-        name = task_data.get("task_name", "Untitled Task").replace("|", "\\|")
+        name = task_data.get("task_name", "Untitled Task").translate(_PIPE_ESCAPE)
         if task_data.get("recurrence"):
             name += " 🔁"
             
-        reasoning = task_data.get("reasoning", "").replace("\n", " ").replace("|", "\\|")
+        reasoning = task_data.get("reasoning", "").translate(_REASONING_ESCAPE)
         status = task_data.get("status", "Pending")
         
         # Handle due date/time formatting
@@ -134,22 +260,10 @@ class ObsidianWriter:
             date_display = "📅 Unscheduled"
             time_display = "—"
         else:
-            try:
-                d = datetime.strptime(raw_due_date, "%Y-%m-%d")
-                date_display = d.strftime("%d-%m-%Y")
-            except ValueError:
-                date_display = raw_due_date
-            
-            if raw_due_time:
-                try:
-                    t = datetime.strptime(raw_due_time, "%H:%M")
-                    time_display = t.strftime("%I:%M %p").lstrip("0")
-                except ValueError:
-                    time_display = raw_due_time
-            else:
-                time_display = "—"
-
-        return f"| {tid} | {name} | {priority} | {status} | {category} | {date_display} | {time_display} | {reasoning} |\n"
+            date_display = _fmt_date(raw_due_date)
+            time_display = _fmt_time(raw_due_time) if raw_due_time else "—"
+
+        return ACTIVE_ROW_FMT.format(tid, name, priority, status, category, date_display, time_display, reasoning)
 
 if __name__ == "__main__":
     # Test script
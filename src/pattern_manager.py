@@ -2,33 +2,50 @@ import os
 import json
 import logging
 import sqlite3
+import time
+from contextlib import closing
+from string import Template
 import google.generativeai as genai
-from dotenv import load_dotenv
-from src.utils import get_connection, log_audit
+from src.database import get_connection
+from src.utils import configure_genai, log_audit
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Patterns only change when analyze_overrides saves one, which clears the cache
+PATTERN_CACHE_TTL_SECONDS = 60
+
+OVERRIDE_PATTERN_PROMPT = Template("""
+Analyze the following list of tasks that the user FORCED to sync, overriding my strategic pushback.
+Identify if there is a recurring theme or pattern (e.g., "The user always wants to sync grocery lists despite low career alignment").
+
+OVERRIDDEN TASKS:
+$overrides
+
+If a pattern is found, output a single sentence description of the pattern.
+If no clear pattern is found, output "NONE".
+
+Format: A simple string.
+""")
+
 class PatternManager:
     def __init__(self):
-        load_dotenv(override=True)
-        self.api_key = os.getenv("GEMINI_API_KEY")
-        if not self.api_key:
-            raise ValueError("GEMINI_API_KEY not set in .env")
-            
-        genai.configure(api_key=self.api_key)
+        self.api_key = configure_genai()
         self.model = genai.GenerativeModel('gemini-3-flash-preview')
+        self._patterns_cache = None  # (monotonic time fetched, patterns)
 
     def get_active_patterns(self):
-        """Retrieves list of active patterns from the DB."""
+        """Retrieves list of active patterns from the DB (cached for PATTERN_CACHE_TTL_SECONDS)."""
+        cached = self._patterns_cache
+        if cached and time.monotonic() - cached[0] < PATTERN_CACHE_TTL_SECONDS:
+            return list(cached[1])
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT pattern_data FROM patterns WHERE confidence > 0.7")
-            rows = cursor.fetchall()
-            conn.close()
-            return [row[0] for row in rows]
+            with closing(get_connection()) as conn:
+                rows = conn.execute("SELECT pattern_data FROM patterns WHERE confidence > 0.7").fetchall()
+            patterns = [row[0] for row in rows]
+            self._patterns_cache = (time.monotonic(), patterns)
+            return list(patterns)
         except Exception as e:
             logger.error(f"Failed to fetch patterns: {e}")
             return []
@@ -40,47 +57,39 @@ class PatternManager:
         logger.info("Analyzing manual overrides for pattern detection...")
         
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            # Find recent manual syncs
-            cursor.execute("""
-                SELECT details FROM audit_logs 
-                WHERE event_type = 'manual_sync' 
-                ORDER BY timestamp DESC LIMIT 20
-            """)
-            overrides = cursor.fetchall()
-            
-            if len(overrides) < 3:
-                logger.info("Not enough overrides to detect patterns yet.")
-                conn.close()
-                return
-            
-            # Fetch the actual tasks for these overrides
-            override_details = []
-            for (detail,) in overrides:
-                todo_id = detail.split("todo ")[1]
-                cursor.execute("SELECT task, category, reasoning FROM todos WHERE id = ?", (todo_id,))
-                task = cursor.fetchone()
-                if task:
-                    override_details.append(f"Task: {task[0]} | Category: {task[1]} | AI Reasoning: {task[2]}")
-            
-            conn.close()
+            with closing(get_connection()) as conn:
+                cursor = conn.cursor()
+                # Find recent manual syncs
+                cursor.execute("""
+                    SELECT details FROM audit_logs 
+                    WHERE event_type = 'manual_sync' 
+                    ORDER BY timestamp DESC LIMIT 20
+                """)
+                overrides = cursor.fetchall()
+                
+                if len(overrides) < 3:
+                    logger.info("Not enough overrides to detect patterns yet.")
+                    return
+                
+                # Fetch the actual tasks for these overrides in one query, keeping override order
+                todo_ids = [detail.rpartition("todo ")[2] for (detail,) in overrides]
+                placeholders = ",".join("?" * len(todo_ids))
+                cursor.execute(
+                    f"SELECT id, task, category, reasoning FROM todos WHERE id IN ({placeholders})",
+                    todo_ids
+                )
+                tasks = {str(row[0]): row[1:] for row in cursor.fetchall()}
+
+                override_details = []
+                for todo_id in todo_ids:
+                    task = tasks.get(todo_id)
+                    if task:
+                        override_details.append(f"Task: {task[0]} | Category: {task[1]} | AI Reasoning: {task[2]}")
             
             if not override_details:
                 return
 
-            prompt = f"""
-Analyze the following list of tasks that the user FORCED to sync, overriding my strategic pushback.
-Identify if there is a recurring theme or pattern (e.g., "The user always wants to sync grocery lists despite low career alignment").
-
-OVERRIDDEN TASKS:
-{chr(10).join(override_details)}
-
-If a pattern is found, output a single sentence description of the pattern.
-If no clear pattern is found, output "NONE".
-
-Format: A simple string.
-"""
+            prompt = OVERRIDE_PATTERN_PROMPT.substitute(overrides="\n".join(override_details))
             response = self.model.generate_content(prompt)
             pattern_text = response.text.strip()
             
@@ -95,15 +104,13 @@ Format: A simple string.
     def _save_pattern(self, pattern_text):
         """Saves or updates a pattern in the database."""
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            # Deduplication logic could go here, for now just insert
-            cursor.execute("""
-                INSERT INTO patterns (pattern_type, pattern_data, confidence, usage_count)
-                VALUES (?, ?, ?, ?)
-            """, ("Override", pattern_text, 0.8, 1))
-            conn.commit()
-            conn.close()
+            with closing(get_connection()) as conn, conn:
+                # Deduplication logic could go here, for now just insert
+                conn.execute("""
+                    INSERT INTO patterns (pattern_type, pattern_data, confidence, usage_count)
+                    VALUES (?, ?, ?, ?)
+                """, ("Override", pattern_text, 0.8, 1))
+            self._patterns_cache = None
         except Exception as e:
             logger.error(f"Failed to save pattern: {e}")
 
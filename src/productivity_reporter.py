@@ -3,10 +3,23 @@ ProductivityReporter: Generate daily/weekly productivity reports
 """
 import logging
 from datetime import datetime, date, timedelta
-from src.database import get_connection
+from src.db_pool import read_conn, write_txn
 
 logger = logging.getLogger(__name__)
 
+_MIN_T = datetime.min.time()
+_MAX_T = datetime.max.time()
+
+def _day_range(target_date: date):
+    """[start, end) unix seconds for target_date's local midnight-to-midnight
+
+    check_ins and activity_logs store times as unix seconds. The end is the next day's
+    midnight, not start + 86400, so DST-change days keep their real length.
+    """
+    start = datetime.combine(target_date, _MIN_T)
+    end = datetime.combine(target_date + timedelta(days=1), _MIN_T)
+    return int(start.timestamp()), int(end.timestamp())
+
 class ProductivityReporter:
     def format_daily_report(self, target_date: date = None):
         """Generate user-friendly daily productivity report"""
@@ -14,9 +27,16 @@ class ProductivityReporter:
             target_date = date.today()
 
         try:
-            stats = self._get_daily_stats(target_date)
-
-            if stats['total_check_ins'] == 0:
+            # One pooled connection and two queries cover both the stats and the category breakdown;
+            # days without check-ins stop at a single index probe
+            start_ts, end_ts = _day_range(target_date)
+            with read_conn() as conn:
+                if self._has_check_ins(conn, start_ts, end_ts):
+                    stats, category_breakdown = self._get_daily_bundle(conn, start_ts, end_ts)
+                else:
+                    stats = None
+
+            if stats is None or stats['total_check_ins'] == 0:
                 return (
                     "📊 **Daily Productivity Report**\n"
                     f"Date: {target_date.strftime('%Y-%m-%d')}\n\n"
@@ -55,11 +75,12 @@ class ProductivityReporter:
                     report += f"**Productivity Ratio:** {stats['productivity_ratio']:.0f}%\n\n"
 
                 # Category breakdown
-                category_breakdown = self._get_category_breakdown(target_date)
                 if category_breakdown:
                     report += "**Time by Category:**\n"
-                    for category, hours in category_breakdown.items():
-                        report += f"- {category}: {hours} hour{'s' if hours != 1 else ''}\n"
+                    report += "".join(
+                        f"- {category}: {hours} hour{'s' if hours != 1 else ''}\n"
+                        for category, hours in category_breakdown.items()
+                    )
 
             # Missed check-ins
             if stats['missed_check_ins'] > 0:
@@ -71,44 +92,60 @@ class ProductivityReporter:
             logger.error(f"Failed to generate daily report: {e}")
             return "❌ Failed to generate report. Please try again."
 
-    def _get_daily_stats(self, target_date: date):
-        """Query database for daily statistics"""
+    def _has_check_ins(self, conn, start_ts: int, end_ts: int):
+        """Whether any check-in is scheduled in [start_ts, end_ts)"""
+        row = conn.execute(
+            """SELECT 1 FROM check_ins
+               WHERE scheduled_time >= ? AND scheduled_time < ?
+               LIMIT 1""",
+            (start_ts, end_ts)
+        ).fetchone()
+        return row is not None
+
+    def _get_daily_bundle(self, conn, start_ts: int, end_ts: int):
+        """Daily stats and category breakdown from one check_ins and one activity_logs query
+
+        Returns (stats, categories) for [start_ts, end_ts) using the caller's connection.
+        """
         try:
-            conn = get_connection()
             cursor = conn.cursor()
 
-            # Date range for the day
-            start_datetime = datetime.combine(target_date, datetime.min.time())
-            end_datetime = datetime.combine(target_date, datetime.max.time())
-
             # Count check-ins by status
             cursor.execute(
                 """SELECT status, COUNT(*) FROM check_ins
-                   WHERE scheduled_time >= ? AND scheduled_time <= ?
+                   WHERE scheduled_time >= ? AND scheduled_time < ?
                    GROUP BY status""",
-                (start_datetime, end_datetime)
+                (start_ts, end_ts)
             )
             status_counts = {row[0]: row[1] for row in cursor.fetchall()}
 
-            # Count activities by type
+            # Activity counts and alignment totals per (type, category); rolled up below
             cursor.execute(
-                """SELECT productivity_type, COUNT(*) FROM activity_logs
-                   WHERE timestamp >= ? AND timestamp <= ?
-                   GROUP BY productivity_type""",
-                (start_datetime, end_datetime)
+                """SELECT productivity_type, category, COUNT(*),
+                          SUM(alignment_score), COUNT(alignment_score)
+                   FROM activity_logs
+                   WHERE timestamp >= ? AND timestamp < ?
+                   GROUP BY productivity_type, category""",
+                (start_ts, end_ts)
             )
-            activity_counts = {row[0]: row[1] for row in cursor.fetchall()}
 
-            # Calculate average alignment score
-            cursor.execute(
-                """SELECT AVG(alignment_score) FROM activity_logs
-                   WHERE timestamp >= ? AND timestamp <= ?
-                     AND productivity_type != 'sleeping'""",
-                (start_datetime, end_datetime)
-            )
-            avg_score = cursor.fetchone()[0]
-
-            conn.close()
+            activity_counts = {}
+            category_counts = {}
+            score_sum = 0
+            score_count = 0
+            for ptype, category, count, group_score_sum, group_score_count in cursor.fetchall():
+                activity_counts[ptype] = activity_counts.get(ptype, 0) + count
+                # NULL types are excluded too, matching SQL's `productivity_type != 'sleeping'`
+                if ptype is None or ptype == 'sleeping':
+                    continue
+                if group_score_count:
+                    score_sum += group_score_sum
+                    score_count += group_score_count
+                if category is not None:
+                    category_counts[category] = category_counts.get(category, 0) + count
+
+            avg_score = score_sum / score_count if score_count else None
+            categories = dict(sorted(category_counts.items(), key=lambda item: item[1], reverse=True))
 
             # Calculate totals
             total_check_ins = sum(status_counts.values())
@@ -126,7 +163,7 @@ class ProductivityReporter:
             if responded > 0:
                 productivity_ratio = (productive_hours / responded) * 100
 
-            return {
+            stats = {
                 'total_check_ins': total_check_ins,
                 'responded_check_ins': responded,
                 'missed_check_ins': missed,
@@ -137,6 +174,7 @@ class ProductivityReporter:
                 'avg_alignment_score': avg_score,
                 'productivity_ratio': productivity_ratio
             }
+            return stats, categories
 
         except Exception as e:
             logger.error(f"Failed to get daily stats: {e}")
@@ -150,74 +188,28 @@ class ProductivityReporter:
                 'wasted_activities': 0,
                 'avg_alignment_score': None,
                 'productivity_ratio': None
-            }
-
-    def _get_category_breakdown(self, target_date: date):
-        """Get time spent by category"""
-        try:
-            conn = get_connection()
-            cursor = conn.cursor()
-
-            start_datetime = datetime.combine(target_date, datetime.min.time())
-            end_datetime = datetime.combine(target_date, datetime.max.time())
-
-            cursor.execute(
-                """SELECT category, COUNT(*) FROM activity_logs
-                   WHERE timestamp >= ? AND timestamp <= ?
-                     AND category IS NOT NULL
-                     AND productivity_type != 'sleeping'
-                   GROUP BY category
-                   ORDER BY COUNT(*) DESC""",
-                (start_datetime, end_datetime)
-            )
-
-            categories = {}
-            for row in cursor.fetchall():
-                categories[row[0]] = row[1]
-
-            conn.close()
-            return categories
-
-        except Exception as e:
-            logger.error(f"Failed to get category breakdown: {e}")
-            return {}
+            }, {}
 
     def save_daily_metrics(self, target_date: date = None):
         """Aggregate and save daily metrics to productivity_metrics table"""
         if target_date is None:
             target_date = date.today()
+        self.save_daily_metrics_range(target_date, target_date)
 
-        try:
-            stats = self._get_daily_stats(target_date)
-
-            conn = get_connection()
-            cursor = conn.cursor()
-
-            start_datetime = datetime.combine(target_date, datetime.min.time())
-            end_datetime = datetime.combine(target_date, datetime.max.time())
-
-            # Check if metrics already exist for this day
-            cursor.execute(
-                """SELECT id FROM productivity_metrics
-                   WHERE period_start = ? AND period_type = 'daily'""",
-                (start_datetime,)
-            )
+    def save_daily_metrics_range(self, start_date: date, end_date: date):
+        """Aggregate and save daily metrics for every day from start_date to end_date (inclusive)
 
-            if cursor.fetchone():
-                # Update existing
-                cursor.execute(
-                    """UPDATE productivity_metrics
-                       SET total_check_ins = ?,
-                           responded_check_ins = ?,
-                           missed_check_ins = ?,
-                           sleeping_check_ins = ?,
-                           aligned_activities = ?,
-                           beneficial_activities = ?,
-                           wasted_activities = ?,
-                           avg_alignment_score = ?,
-                           productivity_ratio = ?
-                       WHERE period_start = ? AND period_type = 'daily'""",
-                    (
+        All days are upserted in one transaction, so a backfill commits once.
+        """
+        try:
+            rows = []
+            with read_conn() as conn:
+                day = start_date
+                while day <= end_date:
+                    stats = self._get_daily_bundle(conn, *_day_range(day))[0]
+                    # productivity_metrics keeps its datetime period bounds
+                    rows.append((
+                        datetime.combine(day, _MIN_T), datetime.combine(day, _MAX_T), 'daily',
                         stats['total_check_ins'],
                         stats['responded_check_ins'],
                         stats['missed_check_ins'],
@@ -226,36 +218,36 @@ class ProductivityReporter:
                         stats['beneficial_activities'],
                         stats['wasted_activities'],
                         stats['avg_alignment_score'],
-                        stats['productivity_ratio'],
-                        start_datetime
-                    )
-                )
-            else:
-                # Insert new
-                cursor.execute(
+                        stats['productivity_ratio']
+                    ))
+                    day += timedelta(days=1)
+
+            # Insert, or overwrite each day's existing row (unique on period_type, period_start)
+            with write_txn() as conn:
+                conn.executemany(
                     """INSERT INTO productivity_metrics
                        (period_start, period_end, period_type,
                         total_check_ins, responded_check_ins, missed_check_ins, sleeping_check_ins,
                         aligned_activities, beneficial_activities, wasted_activities,
                         avg_alignment_score, productivity_ratio)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (
-                        start_datetime, end_datetime, 'daily',
-                        stats['total_check_ins'],
-                        stats['responded_check_ins'],
-                        stats['missed_check_ins'],
-                        stats['sleeping_check_ins'],
-                        stats['aligned_activities'],
-                        stats['beneficial_activities'],
-                        stats['wasted_activities'],
-                        stats['avg_alignment_score'],
-                        stats['productivity_ratio']
-                    )
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(period_type, period_start) DO UPDATE SET
+                           total_check_ins = excluded.total_check_ins,
+                           responded_check_ins = excluded.responded_check_ins,
+                           missed_check_ins = excluded.missed_check_ins,
+                           sleeping_check_ins = excluded.sleeping_check_ins,
+                           aligned_activities = excluded.aligned_activities,
+                           beneficial_activities = excluded.beneficial_activities,
+                           wasted_activities = excluded.wasted_activities,
+                           avg_alignment_score = excluded.avg_alignment_score,
+                           productivity_ratio = excluded.productivity_ratio""",
+                    rows
                 )
 
-            conn.commit()
-            conn.close()
-            logger.info(f"Daily metrics saved for {target_date}")
+            if start_date == end_date:
+                logger.info(f"Daily metrics saved for {start_date}")
+            else:
+                logger.info(f"Daily metrics saved for {start_date} to {end_date}")
 
         except Exception as e:
             logger.error(f"Failed to save daily metrics: {e}")
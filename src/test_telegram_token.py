@@ -1,6 +1,6 @@
 import os
 import asyncio
-from telegram import Bot
+import httpx  # installed with python-telegram-bot
 from dotenv import load_dotenv
 
 # Force reload of .env
@@ -16,11 +16,16 @@ async def verify_token():
     print(f"Attempting to verify token: {token[:5]}...{token[-5:]}")
     
     try:
-        bot = Bot(token=token)
-        me = await bot.get_me()
+        # A single getMe call; no need to build the full telegram.Bot object graph
+        async with httpx.AsyncClient(timeout=5) as client:
+            r = await client.get(f"https://api.telegram.org/bot{token}/getMe")
+        data = r.json()
+        if not data.get("ok"):
+            raise RuntimeError(data.get("description", f"HTTP {r.status_code}"))
+        me = data["result"]
         print(f"SUCCESS! Connected to Telegram.")
-        print(f"Bot Name: {me.first_name}")
-        print(f"Bot Username: @{me.username}")
+        print(f"Bot Name: {me['first_name']}")
+        print(f"Bot Username: @{me['username']}")
     except Exception as e:
         print(f"FAILED to connect to Telegram: {e}")
 
@@ -1,87 +1,36 @@
 import os
+import re
 import json
+import asyncio
 import logging
+import time
+from datetime import date, timedelta
+from functools import lru_cache
 from typing import Optional, Dict, Any
+from string import Template
 import google.generativeai as genai
-from dotenv import load_dotenv
+from google.api_core import exceptions as google_exceptions
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 from src.pattern_manager import PatternManager
+from src.context_manager import load_context_map
+from src.utils import configure_genai, parse_json_response
 
-class TriageEngine:
-    def __init__(self):
-        load_dotenv(override=True)
-        self.api_key = os.getenv("GEMINI_API_KEY")
-        if not self.api_key:
-            raise ValueError("GEMINI_API_KEY not set in .env")
-            
-        genai.configure(api_key=self.api_key)
-        # Using 3-flash-preview for low-latency
-        self.model = genai.GenerativeModel('gemini-3-flash-preview')
-        self.context_path = "src/data/context_map.json"
-        self.pm = PatternManager()
+TRIAGE_MODEL = 'gemini-3-flash-preview'
 
-    def _load_context(self) -> str:
-        """Loads the context map as a string."""
-        if not os.path.exists(self.context_path):
-            logger.warning("Context map not found. Triage will be less accurate.")
-            return "No context available."
-        
-        try:
-            with open(self.context_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        except Exception as e:
-            logger.error(f"Error loading context map: {e}")
-            return "Error loading context."
+# Explicit Gemini cache for the rules + context; recreated shortly before it expires
+PROMPT_CACHE_TTL_SECONDS = 300
+PROMPT_CACHE_REFRESH_MARGIN_SECONDS = 30
 
-    async def triage_task(self, user_input: str, media_paths: Optional[list] = None) -> Dict[str, Any]:
-        """
-        Triages a task based on user input and cached context.
-        Supports multimodal input if media_paths are provided.
-        Detects 'human override' keyword to respect user's explicit values.
-        """
-        context_string = self._load_context()
-        patterns = self.pm.get_active_patterns()
-        patterns_str = "\n".join([f"- {p}" for p in patterns]) if patterns else "No recurring patterns detected yet."
-        
-        from datetime import datetime
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        current_day = datetime.now().strftime("%A")  # e.g., "Wednesday"
-        
-        # Human Override Detection
-        is_override = "human override" in user_input.lower()
-        override_instruction = ""
-        if is_override:
-            override_instruction = """
-HUMAN OVERRIDE ACTIVE: The user has explicitly invoked "human override". 
-You MUST:
-1. Respect ANY priority, category, or date the user specifies - do NOT override their choice
-2. Set pushback to null (no pushback when user overrides)
-3. Set suggested_alternative to null
-4. If user says "priority HIGH", set priority to HIGH regardless of your analysis
-5. Still parse dates correctly
-"""
-            logger.info("Human override detected in input")
-        
-        prompt = f"""
+# Identical for every triage call; the per-call values come after it in TRIAGE_INPUT_PROMPT
+TRIAGE_RULES_PROMPT = """
 You are an intelligent triage agent for "Kairos - Life Sorter". 
 Your goal is to categorize and prioritize a new task based on the user's strategic context and learned patterns.
+The user's strategic context, learned patterns, the CURRENT DATE and the NEW INPUT follow these instructions.
 
-CURRENT DATE: {current_date} ({current_day})
-
-USER STRATEGIC CONTEXT:
-{context_string}
-
-LEARNED USER PATTERNS (Overrides):
-{patterns_str}
-
-NEW INPUT:
-{user_input}
-
-{override_instruction}
 ANALYSIS RULES:
 1. Alignment: Does this align with "Get Fit", "Career Growth", or "Live a Good Quality Life" (daily maintenance/hygiene)?
 2. Priority:
@@ -95,16 +44,17 @@ ANALYSIS RULES:
 4. Alternatives: If priority is LOW and task is a distraction, suggest 1-2 specific high-priority alternatives.
 
 DATE PARSING RULES:
-- ALWAYS convert natural language dates to YYYY-MM-DD format using the CURRENT DATE above as reference.
-- "saturday" or "coming saturday" → Calculate the next Saturday from {current_date}
-- "tomorrow" → {current_date} + 1 day
-- "next week" → {current_date} + 7 days
-- "day after tomorrow" → {current_date} + 2 days
+- ALWAYS convert natural language dates to YYYY-MM-DD format using the CURRENT DATE given below as reference.
+- "saturday" or "coming saturday" → Calculate the next Saturday from the CURRENT DATE
+- "tomorrow" → CURRENT DATE + 1 day
+- "next week" → CURRENT DATE + 7 days
+- "day after tomorrow" → CURRENT DATE + 2 days
+- If KNOWN DATE MAPPINGS (given below) cover the phrase, use that date as-is.
 - If a date is mentioned (even informally like "friday", "this weekend"), you MUST return a valid YYYY-MM-DD. If unable, ask user for clarification.
 - Only return null if the user explicitly says "no date", "unscheduled", or truly never mentions any timeframe.
 
 OUTPUT FORMAT (JSON ONLY):
-{{
+{
   "task_name": "Concise version of the task",
   "category": "Career | Fitness | Projects | Personal | Hobby",
   "priority": "HIGH | MEDIUM | LOW",
@@ -117,85 +67,370 @@ OUTPUT FORMAT (JSON ONLY):
   "pushback": "Message to user if priority is LOW or alignment is weak, otherwise null",
   "suggested_alternative": "A suggested high-priority task based on context, otherwise null",
   "clarification_needed": "Ask a specific question if the task purpose is unclear, otherwise null"
-}}
+}
+"""
+
+# Context changes only when the vault is re-scanned, so it follows the rules and is
+# cached together with them when possible
+TRIAGE_CONTEXT_PROMPT = Template("""
+USER STRATEGIC CONTEXT:
+$context
+""")
+
+TRIAGE_INPUT_PROMPT = Template("""
+LEARNED USER PATTERNS (Overrides):
+$patterns
+
+CURRENT DATE: $current_date ($current_day)
+KNOWN DATE MAPPINGS:
+$date_hints
+$override_instruction
+NEW INPUT:
+$user_input
+""")
+
+TRIAGE_BATCH_PROMPT = Template("""
+LEARNED USER PATTERNS (Overrides):
+$patterns
+
+CURRENT DATE: $current_date ($current_day)
+KNOWN DATE MAPPINGS:
+$date_hints
+$override_instruction
+NEW INPUTS (triage each one independently):
+$inputs
+
+Return a JSON list with exactly one object in the OUTPUT FORMAT above per input, in the same order.
+""")
+
+EDIT_PARSE_PROMPT = Template("""
+You are a helper parsing edit requests for a todo list task.
+CURRENT DATE: $current_date
+KNOWN DATE MAPPINGS:
+$date_hints
+
+USER INSTRUCTION: "$edit_instruction"
+
+Extract the fields the user wants to change.
+Fields allowed: task_name, priority (HIGH/MEDIUM/LOW), category, due_date (YYYY-MM-DD), due_time (HH:MM).
+
+- If user mentions "tomorrow", "friday", etc., calculate the YYYY-MM-DD date based on Current Date.
+- Return ONLY a JSON object with the fields that need updating.
+- Ignore polite conversational text.
+
+Example Input: "change priority to high and move to personal category"
+Example Output: { "priority": "HIGH", "category": "Personal" }
+
+Output JSON:
+""")
+
+HUMAN_OVERRIDE_INSTRUCTION = """
+HUMAN OVERRIDE ACTIVE: The user has explicitly invoked "human override". 
+You MUST:
+1. Respect ANY priority, category, or date the user specifies - do NOT override their choice
+2. Set pushback to null (no pushback when user overrides)
+3. Set suggested_alternative to null
+4. If user says "priority HIGH", set priority to HIGH regardless of your analysis
+5. Still parse dates correctly
 """
+
+# What a Gemini call plus reply parse can fail with: API/transport errors, and ValueError
+# for a blocked/empty reply or bad JSON (json.JSONDecodeError is a ValueError)
+MODEL_CALL_ERRORS = (google_exceptions.GoogleAPIError, ValueError)
+
+# Case-insensitive search, so long inputs aren't lowercased just to find the keyword
+_OVERRIDE_RE = re.compile(r"human override", re.IGNORECASE)
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+@lru_cache(maxsize=2)
+def _relative_dates(today: date) -> Dict[str, str]:
+    """Common relative date phrases resolved to YYYY-MM-DD for today."""
+    dates = {
+        "tomorrow": today + timedelta(days=1),
+        "day after tomorrow": today + timedelta(days=2),
+        "next week": today + timedelta(days=7),
+        "this weekend": today + timedelta(days=(5 - today.weekday() - 1) % 7 + 1),
+    }
+    # A bare weekday is its next occurrence after today (same rule as /schedule)
+    for wd, name in enumerate(WEEKDAYS):
+        dates[name] = today + timedelta(days=(wd - today.weekday() - 1) % 7 + 1)
+    return {phrase: d.isoformat() for phrase, d in dates.items()}
+
+@lru_cache(maxsize=2)
+def _date_values(today: date) -> Dict[str, str]:
+    """Prompt date fields for today, with common relative phrases resolved to YYYY-MM-DD."""
+    return {
+        "current_date": today.isoformat(),
+        "current_day": today.strftime("%A"),  # e.g., "Wednesday"
+        "date_hints": "\n".join(f"- {phrase}: {d}" for phrase, d in _relative_dates(today).items()),
+    }
+
+# Simple edit instructions ("priority high", "move to personal", "due friday 15:30") are
+# parsed locally; anything these don't fully account for goes to the model
+_EDIT_PRIORITY_RE = re.compile(r"\bpriority\s+(?:to\s+)?(high|medium|low)\b")
+_EDIT_CATEGORY_RE = re.compile(r"\b(?:category|to)\s+(career|fitness|projects|personal|hobby)\b")
+_EDIT_DATE_RE = re.compile(r"\b(today|day after tomorrow|tomorrow|next week|this weekend|" + "|".join(WEEKDAYS) + r")\b")
+_EDIT_TIME_RE = re.compile(r"\b([01]?\d|2[0-3]):([0-5]\d)\b")
+_EDIT_WORD_RE = re.compile(r"[a-z0-9:]+")
+_EDIT_FILLER_WORDS = frozenset(
+    "change set move make update mark to the a it its task priority category due date time "
+    "on at by for and please".split()
+)
+
+def _quick_parse_edit(edit_instruction: str) -> Optional[Dict[str, Any]]:
+    """Fields for a simple edit instruction, or None if it needs the model."""
+    text = edit_instruction.lower()
+    today = date.today()
+    fields = {}
+    for field, regex, convert in (
+        ("priority", _EDIT_PRIORITY_RE, lambda m: m.group(1).upper()),
+        ("category", _EDIT_CATEGORY_RE, lambda m: m.group(1).title()),
+        ("due_date", _EDIT_DATE_RE, lambda m: today.isoformat() if m.group(1) == "today"
+                                              else _relative_dates(today)[m.group(1)]),
+        ("due_time", _EDIT_TIME_RE, lambda m: f"{int(m.group(1)):02d}:{m.group(2)}"),
+    ):
+        m = regex.search(text)
+        if m:
+            fields[field] = convert(m)
+            text = text[:m.start()] + " " + text[m.end():]
+
+    # Any word left over (a new name, "3pm", a second date...) means it isn't a simple edit
+    if not fields or any(w not in _EDIT_FILLER_WORDS for w in _EDIT_WORD_RE.findall(text)):
+        return None
+    return fields
+
+async def _generate_json(model, contents):
+    """
+    Streams the model's reply and returns its parsed JSON as soon as the text received so
+    far holds a complete value, instead of waiting for any trailing text or closing fence.
+    """
+    response = await model.generate_content_async(contents, stream=True)
+    stream = response.__aiter__()
+    chunks = []
+    try:
+        async for chunk in stream:
+            if not chunk.parts:  # e.g. the final chunk that only carries the finish reason
+                continue
+            text = chunk.text
+            chunks.append(text)
+            # A JSON object/list can only be complete once a closing bracket has arrived
+            if "}" in text or "]" in text:
+                try:
+                    return parse_json_response("".join(chunks))
+                except ValueError:
+                    pass
+    finally:
+        # An early return leaves the rest of the reply unread: close the SDK's chunk generator and
+        # the RPC stream it pulls from, rather than leaving both open until garbage collection
+        await stream.aclose()
+        rpc_stream = getattr(response, "_iterator", None)
+        if hasattr(rpc_stream, "aclose"):
+            await rpc_stream.aclose()
+    return parse_json_response("".join(chunks))
+
+def _fallback_triage(user_input: str, error) -> Dict[str, Any]:
+    """Minimal triage result used when the model call or parse fails."""
+    return {
+        "task_name": user_input[:50],
+        "category": "Unknown",
+        "priority": "MEDIUM",
+        "reasoning": f"Triage engine error: {error}",
+        "alignment_score": 0,
+        "pushback": None,
+        "clarification_needed": None
+    }
+
+@lru_cache(maxsize=1)
+def get_triage_engine() -> "TriageEngine":
+    """The process-wide TriageEngine, so its model, PatternManager and caches are reused."""
+    return TriageEngine()
+
+class TriageEngine:
+    def __init__(self):
+        self.api_key = configure_genai()
+        # Using 3-flash-preview for low-latency
+        self.model = genai.GenerativeModel(TRIAGE_MODEL)
+        self.pm = PatternManager()
+        # Prompt text for the last context map seen; re-serialized only when the map is reloaded
+        self._ctx_map = None
+        self._ctx_cache = None
+        # Model bound to a CachedContent of (rules, context); keyed on the context text
+        self._cached_model = None
+        self._cached_context = None
+        self._cache_expires = 0.0
+        self._cache_failed_context = None
+        # One cache (re)build at a time when triage calls overlap
+        self._cache_lock = asyncio.Lock()
+
+    def _load_context(self) -> str:
+        """Loads the context map as a string (cached until the file changes)."""
+        try:
+            context_map = load_context_map()
+        except Exception as e:
+            logger.error(f"Error loading context map: {e}")
+            return "Error loading context."
+
+        if context_map is None:
+            logger.warning("Context map not found. Triage will be less accurate.")
+            return "No context available."
+
+        if context_map is not self._ctx_map:
+            # Same layout ContextManager writes the file with
+            self._ctx_map, self._ctx_cache = context_map, json.dumps(context_map, indent=2)
+        return self._ctx_cache
+
+    def _get_cached_model(self, context_string: str):
+        """
+        Returns a model whose cached content already holds the rules and context, or None
+        to send them inline. The cache is rebuilt when the context changes or nears expiry.
+        """
+        now = time.monotonic()
+        if (self._cached_model is not None and context_string == self._cached_context
+                and now < self._cache_expires - PROMPT_CACHE_REFRESH_MARGIN_SECONDS):
+            return self._cached_model
+
+        # Creation fails e.g. when the prompt is below the API's minimum cacheable size;
+        # don't retry until the context changes
+        if context_string == self._cache_failed_context:
+            return None
+
+        try:
+            cache = genai.caching.CachedContent.create(
+                model=TRIAGE_MODEL,
+                system_instruction=TRIAGE_RULES_PROMPT,
+                contents=[TRIAGE_CONTEXT_PROMPT.substitute(context=context_string)],
+                ttl=PROMPT_CACHE_TTL_SECONDS
+            )
+        except Exception as e:
+            logger.info(f"Prompt cache unavailable, sending the full prompt: {e}")
+            self._cached_model = None
+            self._cache_failed_context = context_string
+            return None
+
+        self._cached_model = genai.GenerativeModel.from_cached_content(cache)
+        self._cached_context = context_string
+        self._cache_expires = now + PROMPT_CACHE_TTL_SECONDS
+        self._cache_failed_context = None
+        return self._cached_model
+
+    async def _model_and_contents(self, context_string: str, dynamic_prompt: str):
+        """The model to call and its contents: cached rules + context if available, else all inline."""
+        async with self._cache_lock:
+            # Creating the cache is a blocking SDK call
+            model = await asyncio.to_thread(self._get_cached_model, context_string)
+        if model is not None:
+            return model, [dynamic_prompt]
+        contents = [TRIAGE_RULES_PROMPT, TRIAGE_CONTEXT_PROMPT.substitute(context=context_string), dynamic_prompt]
+        return self.model, contents
+
+    async def triage_task(self, user_input: str, media_paths: Optional[list] = None) -> Dict[str, Any]:
+        """
+        Triages a task based on user input and cached context.
+        Supports multimodal input if media_paths are provided.
+        Detects 'human override' keyword to respect user's explicit values.
+        """
+        context_string = self._load_context()
+        patterns = self.pm.get_active_patterns()
+        patterns_str = "\n".join([f"- {p}" for p in patterns]) if patterns else "No recurring patterns detected yet."
+        
+        # Human Override Detection
+        is_override = _OVERRIDE_RE.search(user_input) is not None
+        override_instruction = ""
+        if is_override:
+            override_instruction = HUMAN_OVERRIDE_INSTRUCTION
+            logger.info("Human override detected in input")
+        
+        # Static rules first and per-call values last, so the shared prefix is identical
+        # across requests and can be served from Gemini's prompt cache
+        dynamic_prompt = TRIAGE_INPUT_PROMPT.substitute(
+            patterns=patterns_str,
+            override_instruction=override_instruction,
+            user_input=user_input,
+            **_date_values(date.today())
+        )
         
         try:
+            model, contents = await self._model_and_contents(context_string, dynamic_prompt)
+
             # Handle multimodal if paths provided
-            contents = [prompt]
             if media_paths:
                 for path in media_paths:
                     if os.path.exists(path):
                         # Simple implementation for now, assuming image/voice handling is implemented in Phase 2
                         pass
             
-            response = self.model.generate_content(contents)
-            
-            # Extract JSON
-            text = response.text
-            if "```json" in text:
-                text = text.split("```json")[1].split("```")[0].strip()
-            elif "```" in text:
-                text = text.split("```")[1].split("```")[0].strip()
-            
-            return json.loads(text)
+            return await _generate_json(model, contents)
             
+        except MODEL_CALL_ERRORS as e:
+            logger.error("Triage failed: %s", e)
+            return _fallback_triage(user_input, e)
         except Exception as e:
-            logger.error(f"Triage failed: {e}")
-            return {
-                "task_name": user_input[:50],
-                "category": "Unknown",
-                "priority": "MEDIUM",
-                "reasoning": f"Triage engine error: {e}",
-                "alignment_score": 0,
-                "pushback": None,
-                "clarification_needed": None
-            }
+            # Anything else is a bug or an unexpected SDK error; keep the traceback, still fall back
+            logger.exception("Unexpected triage error: %s", e)
+            return _fallback_triage(user_input, e)
 
-    async def parse_edit_request(self, edit_instruction: str) -> Dict[str, Any]:
+    async def triage_tasks_batch(self, user_inputs: list) -> list:
         """
-        Parses a natural language edit instruction and returns structured fields to update.
-        Example: "change priority to high" -> {"priority": "HIGH"}
+        Triages several inputs with one Gemini request, so the rules and context are sent
+        (or read from the prompt cache) once. Returns one result per input, in order.
         """
-        from datetime import datetime
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        
-        prompt = f"""
-You are a helper parsing edit requests for a todo list task.
-CURRENT DATE: {current_date}
+        if not user_inputs:
+            return []
 
-USER INSTRUCTION: "{edit_instruction}"
+        context_string = self._load_context()
+        patterns = self.pm.get_active_patterns()
+        patterns_str = "\n".join([f"- {p}" for p in patterns]) if patterns else "No recurring patterns detected yet."
 
-Extract the fields the user wants to change.
-Fields allowed: task_name, priority (HIGH/MEDIUM/LOW), category, due_date (YYYY-MM-DD), due_time (HH:MM).
+        override_instruction = ""
+        if any(_OVERRIDE_RE.search(text) for text in user_inputs):
+            override_instruction = "(Only for the inputs that contain \"human override\")" + HUMAN_OVERRIDE_INSTRUCTION
 
-- If user mentions "tomorrow", "friday", etc., calculate the YYYY-MM-DD date based on Current Date.
-- Return ONLY a JSON object with the fields that need updating.
-- Ignore polite conversational text.
+        dynamic_prompt = TRIAGE_BATCH_PROMPT.substitute(
+            patterns=patterns_str,
+            override_instruction=override_instruction,
+            inputs="\n".join(f"{i}. {text}" for i, text in enumerate(user_inputs, 1)),
+            **_date_values(date.today())
+        )
 
-Example Input: "change priority to high and move to personal category"
-Example Output: {{ "priority": "HIGH", "category": "Personal" }}
+        try:
+            model, contents = await self._model_and_contents(context_string, dynamic_prompt)
+            results = await _generate_json(model, contents)
+            if not isinstance(results, list) or len(results) != len(user_inputs):
+                raise ValueError(f"expected a list of {len(user_inputs)} results")
+            return results
 
-Output JSON:
-"""
+        except MODEL_CALL_ERRORS as e:
+            logger.error("Batch triage failed: %s", e)
+            return [_fallback_triage(text, e) for text in user_inputs]
+        except Exception as e:
+            logger.exception("Unexpected batch triage error: %s", e)
+            return [_fallback_triage(text, e) for text in user_inputs]
+
+    async def parse_edit_request(self, edit_instruction: str) -> Dict[str, Any]:
+        """
+        Parses a natural language edit instruction and returns structured fields to update.
+        Example: "change priority to high" -> {"priority": "HIGH"}
+        """
+        fields = _quick_parse_edit(edit_instruction)
+        if fields is not None:
+            return fields
+
+        prompt = EDIT_PARSE_PROMPT.substitute(edit_instruction=edit_instruction, **_date_values(date.today()))
         try:
-            response = self.model.generate_content(prompt)
-            text = response.text.strip()
-            if "```json" in text:
-                text = text.split("```json")[1].split("```")[0].strip()
-            elif "```" in text:
-                text = text.split("```")[1].split("```")[0].strip()
-            
-            return json.loads(text)
+            return await _generate_json(self.model, prompt)
+        except MODEL_CALL_ERRORS as e:
+            logger.error("Edit parse failed: %s", e)
+            return {}
         except Exception as e:
-            logger.error(f"Edit parse failed: {e}")
+            logger.exception("Unexpected edit parse error: %s", e)
             return {}
 
 if __name__ == "__main__":
     import asyncio
     
     async def test():
-        engine = TriageEngine()
+        engine = get_triage_engine()
         test_inputs = [
             "Submit application for a target role",
             "Learn how to bake sourdough bread",
@@ -203,9 +438,10 @@ if __name__ == "__main__":
             "Research AWS Security best practices"
         ]
         
-        for inp in test_inputs:
+        # Independent requests, so run them concurrently
+        results = await asyncio.gather(*(engine.triage_task(inp) for inp in test_inputs))
+        for inp, result in zip(test_inputs, results):
             print(f"\n--- Testing: {inp} ---")
-            result = await engine.triage_task(inp)
             print(json.dumps(result, indent=2))
             
     asyncio.run(test())
@@ -1,7 +1,16 @@
 import os
+import re
+import json
+import atexit
 import logging
-from datetime import datetime
-from src.database import get_connection
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+import google.generativeai as genai
+from dotenv import load_dotenv
+from src.db_pool import write_txn
 
 # Configure logging
 logging.basicConfig(
@@ -10,27 +19,104 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Audit events are queued and written in batches by a background thread
+AUDIT_BATCH_WINDOW_SECONDS = 0.2  # after the first queued event, wait this long for more
+
+_audit_queue = queue.SimpleQueue()
+_audit_thread = None
+_audit_thread_lock = threading.Lock()
+# Held by the writer while it has a batch in hand, so flush_audit_log waits for it
+_audit_batch_lock = threading.Lock()
+
 def log_audit(event_type, details):
-    """Log an event to the audit_logs table."""
+    """Queue an event for the audit_logs table; returns without touching the DB."""
+    # Same UTC layout as the column's CURRENT_TIMESTAMP default, taken when the event happens
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    _audit_queue.put((event_type, details, timestamp))
+
+    global _audit_thread
+    if _audit_thread is None:
+        with _audit_thread_lock:
+            if _audit_thread is None:
+                _audit_thread = threading.Thread(target=_audit_writer, name="audit-writer", daemon=True)
+                _audit_thread.start()
+
+def _drain_audit_queue(rows: list) -> list:
+    while True:
+        try:
+            rows.append(_audit_queue.get_nowait())
+        except queue.Empty:
+            return rows
+
+def flush_audit_log():
+    """Write every queued audit event in one transaction."""
+    with _audit_batch_lock:
+        _write_audit_rows(_drain_audit_queue([]))
+
+def _write_audit_rows(rows: list):
+    if not rows:
+        return
+
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO audit_logs (event_type, details) VALUES (?, ?)",
-            (event_type, details)
-        )
-        conn.commit()
-        conn.close()
+        with write_txn() as conn:
+            conn.executemany(
+                "INSERT INTO audit_logs (event_type, details, timestamp) VALUES (?, ?, ?)",
+                rows
+            )
     except Exception as e:
-        logger.error(f"Failed to log audit event: {e}")
+        logger.error(f"Failed to log {len(rows)} audit event(s): {e}")
+
+def _audit_writer():
+    while True:
+        # Sleeps in get() while the queue is empty, so an idle bot doesn't wake this thread
+        first = _audit_queue.get()
+        with _audit_batch_lock:
+            time.sleep(AUDIT_BATCH_WINDOW_SECONDS)
+            _write_audit_rows(_drain_audit_queue([first]))
+
+# Scripts that log and exit still get their events written
+atexit.register(flush_audit_log)
+
+# Captures the body of a ```json ... ``` (or bare ```) fenced block
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.S)
+
+def unwrap_json_fence(text: str) -> str:
+    """Return the body of a ```json fenced block in a model's reply, or the reply itself if unfenced."""
+    match = _FENCE_RE.search(text)
+    if match:
+        return match.group(1)
+    # A truncated reply can open a fence without closing it
+    return text.strip().removeprefix("```json").removeprefix("```")
+
+def parse_json_response(text: str):
+    """Parse a model's JSON reply, unwrapping a ```json fenced block if present."""
+    return json.loads(unwrap_json_fence(text))
+
+# genai.configure drops the SDK's cached service clients (and their open gRPC channels),
+# so it runs once per process and every Gemini caller reuses the same clients
+_genai_configured = False
+_genai_lock = threading.Lock()
+
+def configure_genai():
+    """Load .env and configure genai on first use; returns the API key."""
+    global _genai_configured
+    if not _genai_configured:
+        with _genai_lock:
+            if not _genai_configured:
+                load_dotenv(override=True)
+                api_key = os.getenv("GEMINI_API_KEY")
+                if not api_key:
+                    raise ValueError("GEMINI_API_KEY not set in .env")
+                genai.configure(api_key=api_key)
+                _genai_configured = True
+    return os.getenv("GEMINI_API_KEY")
 
+@lru_cache(maxsize=1)
 def ensure_dirs():
-    """Ensure required directories exist."""
+    """Ensure required directories exist (once per process)."""
     dirs = ["src/data/temp"]
     for d in dirs:
-        if not os.path.exists(d):
-            os.makedirs(d)
-            logger.info(f"Created directory: {d}")
+        os.makedirs(d, exist_ok=True)
 
 def get_temp_path(file_id, extension):
     """Generate a consistent temp path for media files."""
@@ -66,10 +66,17 @@ except ImportError as e:
 # Test 4: Verify bot.py imports
 print("\n[4/5] Verifying bot.py integration...")
 try:
-    # Just compile check, don't run
+    # Just compile check, don't run; skipped while __pycache__ holds a bytecode file
+    # at least as new as the source
     import py_compile
-    py_compile.compile('src/bot.py', doraise=True)
-    print("[OK] bot.py compiles without errors")
+    import importlib.util
+    source = 'src/bot.py'
+    cached = importlib.util.cache_from_source(source)
+    if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(source):
+        print("[OK] bot.py unchanged since last compile")
+    else:
+        py_compile.compile(source, doraise=True)
+        print("[OK] bot.py compiles without errors")
 except Exception as e:
     print(f"[ERROR] bot.py has errors: {e}")
     sys.exit(1)